@@ -0,0 +1,192 @@
+"""Backfill AI notes over the existing letter archive.
+
+    python backfill.py [--token-budget 6000] [--concurrency 4] [--rate 30]
+                       [--checkpoint backfill_checkpoint.log] [--fake-model]
+
+Letters are packed several to a prompt within a token budget, penpals are
+processed concurrently under a per-minute rate limit, and each prompt's
+notes are written in one batch. Progress is checkpointed after every
+batch, so an interrupted run resumes where it stopped.
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from extraction import (NOTE_TOKEN_BUDGET, FakeModel, build_batch_prompt, estimate_tokens, filter_new_notes,
+                        load_model, parse_batch_response, select_notes)
+from jobs import RateLimiter
+
+CHECKPOINT_FILE = 'backfill_checkpoint.log'
+
+
+def letter_key(penpal_name, letter):
+    """Stable identity for a letter across backends"""
+    digest = hashlib.sha256()
+    for part in (penpal_name, letter.get("date_received") or '', letter["content"]):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def plan_batches(penpal_name, letters, token_budget):
+    """Group letters into prompts that stay within ``token_budget`` tokens.
+
+    Room is left for a full note context. A letter too large for the budget
+    on its own gets a prompt to itself.
+    """
+    overhead = estimate_tokens(build_batch_prompt(penpal_name, [], [])) + NOTE_TOKEN_BUDGET
+    batches, current, used = [], [], overhead
+    for letter in letters:
+        cost = estimate_tokens(letter["content"]) + 10
+        if current and used + cost > token_budget:
+            batches.append(current)
+            current, used = [], overhead
+        current.append(letter)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+class Checkpoint:
+    """Set of processed letter keys, appended to a log one key per line after each batch.
+
+    Each batch costs one write and an fsync however large the set grows.
+    A line torn by a crash is dropped on the next start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        self._fh = None
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if data.startswith(b'{'):
+            # Older versions saved one JSON document; rewrite it as a log
+            self.done = set(json.loads(data)["done"])
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(''.join(f"{key}\n" for key in sorted(self.done)))
+            os.replace(tmp_path, self.path)
+            return
+        end = data.rfind(b'\n') + 1
+        self.done = set(data[:end].decode('utf-8').split())
+        if end < len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def add(self, keys):
+        with self._lock:
+            new = [key for key in keys if key not in self.done]
+            self.done.update(new)
+            if not self.path or not new:
+                return
+            if self._fh is None:
+                self._fh = open(self.path, 'a', encoding='utf-8')
+            self._fh.write(''.join(f"{key}\n" for key in new))
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+
+
+def backfill_penpal(letter_manager, model, limiter, checkpoint, penpal_name, token_budget, prefix):
+    """Extract notes for one penpal's unprocessed letters; returns (letters, notes) counts"""
+    penpal = letter_manager.get_penpal(penpal_name)
+    if not penpal:
+        return 0, 0
+    existing_notes = [note['note'] for note in penpal.get('notes', [])]
+    pending = [letter for letter in penpal.get('letters', [])
+               if letter_key(penpal_name, letter) not in checkpoint]
+
+    letters_done = notes_added = 0
+    for batch in plan_batches(penpal_name, pending, token_budget):
+        contents = [letter["content"] for letter in batch]
+        context = select_notes('\n'.join(contents), existing_notes)
+        limiter.acquire()
+        response = model.generate_content(build_batch_prompt(penpal_name, contents, context))
+        extracted = parse_batch_response(response.text, len(batch))
+
+        candidates = [note for number in sorted(extracted) for note in extracted[number]]
+        new_notes = [f"{prefix}{note}" for note in filter_new_notes(candidates, existing_notes)]
+        if new_notes and not letter_manager.add_notes(penpal_name, new_notes):
+            raise RuntimeError(f"Could not save notes for {penpal_name}")
+
+        existing_notes.extend(new_notes)
+        checkpoint.add(letter_key(penpal_name, letter) for letter in batch)
+        letters_done += len(batch)
+        notes_added += len(new_notes)
+    return letters_done, notes_added
+
+
+def run_backfill(letter_manager, model, token_budget=6000, concurrency=4, rate_per_minute=30,
+                 checkpoint_path=CHECKPOINT_FILE, prefix='[AI] '):
+    """Backfill every penpal; returns a summary dict"""
+    checkpoint = Checkpoint(checkpoint_path)
+    limiter = RateLimiter(rate_per_minute)
+    penpal_names = [penpal['name'] for penpal in letter_manager.get_all_penpals()]
+    summary = {"penpals": len(penpal_names), "letters": 0, "notes": 0, "errors": 0}
+
+    # One task per penpal keeps each penpal's batches in order, so later
+    # prompts see the notes extracted by earlier ones.
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {
+                executor.submit(backfill_penpal, letter_manager, model, limiter, checkpoint,
+                                name, token_budget, prefix): name
+                for name in penpal_names
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    letters_done, notes_added = future.result()
+                except Exception as e:
+                    print(f"Backfill failed for {name}: {e}")
+                    summary["errors"] += 1
+                    continue
+                summary["letters"] += letters_done
+                summary["notes"] += notes_added
+                print(f"{name}: {letters_done} letters, {notes_added} new notes")
+    finally:
+        checkpoint.close()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract AI notes for every archived letter")
+    parser.add_argument('--token-budget', type=int, default=6000, help="approximate tokens per prompt")
+    parser.add_argument('--concurrency', type=int, default=4, help="penpals processed in parallel")
+    parser.add_argument('--rate', type=int, default=30, help="model requests per minute (0 for no limit)")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE, help="resume file")
+    parser.add_argument('--prefix', default='[AI] ', help="prefix added to each note")
+    parser.add_argument('--fake-model', action='store_true', help="use the offline FakeModel")
+    args = parser.parse_args(argv)
+
+    model = FakeModel() if args.fake_model else load_model()
+    if model is None:
+        parser.error("GEMINI_API_KEY is not set (use --fake-model to run offline)")
+
+    from letters import LetterManager
+    summary = run_backfill(LetterManager(), model, args.token_budget, args.concurrency,
+                           args.rate, args.checkpoint, args.prefix)
+    print(json.dumps(summary))
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,342 @@
+"""Benchmarks for LetterManager and the web routes over a synthetic archive.
+
+    python bench.py [--backends json,journal,sharded,sqlite] [--penpals 50] [--letters 200]
+                    [--notes 20] [--repeat 50] [--requests 500] [--seed 1]
+                    [--postgres-url postgresql://user@localhost/postgres?sslmode=disable]
+                    [--output bench_results.json] [--compare baseline.json] [--threshold 0.2]
+
+Each backend gets a fresh store in a temporary directory, loaded with the
+same seeded corpus through ``importer``. Every LetterManager operation is
+timed ``--repeat`` times, then a weighted mix of HTTP routes is replayed
+through the Flask test client. For Postgres, a throwaway database is
+created through ``--postgres-url`` and dropped afterwards.
+
+Results are written as JSON. With --compare, operations whose median is
+more than --threshold slower than the baseline's are flagged, and the exit
+status is 1.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, urlunparse
+
+from importer import import_records
+
+COUNTRIES = ['Japan', 'Brazil', 'France', 'Canada', 'India', 'Germany', 'Kenya', 'Mexico',
+             'Norway', 'Vietnam', 'Italy', 'Chile', 'Egypt', 'Australia', 'Poland', 'Korea']
+# Ordered roughly by frequency; words are drawn with Zipf-like weights
+VOCABULARY = '''
+    the and to of a in that it is was for my you with on this but have be at so
+    not all are as we from they me your day like just about what time when one
+    today really think know there would letter write writing reply people some
+    very week weather home little family friend friends work school city morning
+    evening night weekend summer winter spring autumn rain snow sun coffee tea
+    breakfast dinner cooking recipe music song guitar piano concert book reading
+    novel poetry movie film painting drawing photography garden flowers walk hike
+    mountain river ocean beach island travel trip train airport museum festival
+    holiday birthday wedding sister brother mother father grandmother cousin dog
+    cat puppy kitten university exam studies teacher student office job project
+    language learning practice dream hope memory stamp postcard market bakery
+    bicycle football tennis swimming yoga cathedral temple village harbour lantern
+'''.split()
+WEIGHTS = [1 / (rank + 1) ** 0.9 for rank in range(len(VOCABULARY))]
+SEARCH_TERMS = ['letter', 'coffee', 'mountain', 'grandmother', 'festival', 'guitar', 'lantern', 'weather']
+
+
+def letter_words(rng):
+    """Letter length in words: log-normal around 220, as real letters vary widely"""
+    return max(20, min(3000, int(rng.lognormvariate(math.log(220), 0.6))))
+
+
+def generate_corpus(penpals=50, letters_per_penpal=200, notes_per_penpal=20, seed=1):
+    """Yield importer records for a deterministic synthetic archive.
+
+    The same arguments always produce the same penpals, letters and notes.
+    Letters per penpal vary around ``letters_per_penpal``.
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    names = [f"Penpal {i:04d}" for i in range(penpals)]
+    for name in names:
+        yield {"type": "penpal", "name": name, "country": rng.choice(COUNTRIES),
+               "created_date": start.isoformat()}
+    for name in names:
+        count = max(1, int(rng.gauss(letters_per_penpal, letters_per_penpal / 4)))
+        received = start
+        for _ in range(count):
+            received += timedelta(hours=rng.randint(12, 24 * 14))
+            words = rng.choices(VOCABULARY, WEIGHTS, k=letter_words(rng))
+            yield {"type": "letter", "penpal": name, "content": ' '.join(words),
+                   "date_received": received.isoformat()}
+        for i in range(notes_per_penpal):
+            yield {"type": "note", "penpal": name,
+                   "note": f"Likes {' '.join(rng.choices(VOCABULARY[40:], k=3))} ({i})"}
+
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "median_ms": round(statistics.median(ordered) * 1000, 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+    }
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def bench_operations(manager, repeat, seed):
+    """Time each LetterManager operation ``repeat`` times; returns {op: summary}"""
+    rng = random.Random(seed)
+    names = [penpal["name"] for penpal in manager.get_all_penpals()]
+    results = {}
+
+    def run(op, fn, setup=None):
+        samples = []
+        for _ in range(repeat):
+            args = setup() if setup else ()
+            samples.append(timed(lambda: fn(*args)))
+        results[op] = summarize(samples)
+
+    def pick():
+        return (rng.choice(names),)
+
+    def uncached_stats():
+        manager.stats.invalidate()
+        return manager.get_stats()
+
+    run('get_all_penpals', manager.get_all_penpals)
+    run('get_penpal', manager.get_penpal, pick)
+    run('get_penpal_header', manager.get_penpal_header, pick)
+    run('get_letters_page', manager.get_letters_page, pick)
+    run('get_notes', manager.get_notes, pick)
+    run('search_letters', lambda query: manager.search_letters_page(query), lambda: (rng.choice(SEARCH_TERMS),))
+    run('get_stats', uncached_stats)
+
+    # Writes: each added letter or note is deleted again so the store stays the same size
+    adds, deletes, note_adds, note_deletes = [], [], [], []
+    for i in range(repeat):
+        name = rng.choice(names)
+        adds.append(timed(lambda: manager.add_letter(name, f"benchmark letter {i}", '2999-01-01T00:00:00')))
+        letter_id = manager.get_letters_page(name, 1)["letters"][0]["id"]
+        deletes.append(timed(lambda: manager.delete_letter(name, letter_id)))
+        note_adds.append(timed(lambda: manager.add_note(name, f"benchmark note {i}")))
+        note_id = manager.get_notes(name)[-1]["id"]
+        note_deletes.append(timed(lambda: manager.delete_note(name, note_id)))
+    results['add_letter'] = summarize(adds)
+    results['delete_letter'] = summarize(deletes)
+    results['add_note'] = summarize(note_adds)
+    results['delete_note'] = summarize(note_deletes)
+    return results
+
+
+def route_mix(rng, names):
+    """(weight, label, method, url, form) choices for one replayed request"""
+    name = rng.choice(names)
+    term = rng.choice(SEARCH_TERMS)
+    return [
+        (20, 'GET /', 'GET', '/', None),
+        (30, 'GET /penpal', 'GET', f'/penpal/{name}', None),
+        (10, 'GET /letters', 'GET', f'/letters/{name}', None),
+        (15, 'GET /search', 'GET', f'/search?q={term}', None),
+        (10, 'GET /api/v1/penpals/<name>', 'GET', f'/api/v1/penpals/{name}', None),
+        (10, 'GET /api/v1/penpals/<name>/letters', 'GET', f'/api/v1/penpals/{name}/letters', None),
+        (5, 'POST /add_letter', 'POST', '/add_letter',
+         {"penpal_name": name, "content": "benchmark letter", "date_received": "2999-01-01"}),
+    ]
+
+
+def bench_http(manager, requests, seed):
+    """Replay a weighted route mix through the Flask test client; returns per-route summaries"""
+    import main
+    main.letter_manager = manager
+    client = main.app.test_client()
+    rng = random.Random(seed)
+    names = [penpal["name"] for penpal in manager.get_all_penpals()]
+    samples = {}
+    started = time.perf_counter()
+    for _ in range(requests):
+        choices = route_mix(rng, names)
+        _, label, method, url, form = rng.choices(choices, [choice[0] for choice in choices])[0]
+        elapsed = timed(lambda: client.open(url, method=method, data=form))
+        samples.setdefault(label, []).append(elapsed)
+    total = time.perf_counter() - started
+    results = {label: summarize(values) for label, values in sorted(samples.items())}
+    results['all'] = dict(summarize([s for values in samples.values() for s in values]),
+                          requests_per_s=round(requests / total, 1))
+    return results
+
+
+@contextmanager
+def throwaway_postgres(admin_url):
+    """Create an empty database next to ``admin_url``'s and drop it afterwards; yields its URL"""
+    from storage.pool import get_pool, load_psycopg2
+    name = f"letters_bench_{uuid.uuid4().hex[:8]}"
+    admin = load_psycopg2().connect(admin_url)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute(f'CREATE DATABASE "{name}"')
+        url = urlunparse(urlparse(admin_url)._replace(path=f"/{name}"))
+        try:
+            yield url
+        finally:
+            get_pool(url).closeall()
+            with admin.cursor() as cur:
+                cur.execute(f'DROP DATABASE IF EXISTS "{name}"')
+    finally:
+        admin.close()
+
+
+@contextmanager
+def open_backend(backend, directory, postgres_url=None):
+    """Yield a LetterManager over a fresh, empty store of the given kind"""
+    from letters import LetterManager
+    if backend == 'postgres':
+        from storage.postgres import PostgresEngine
+        with throwaway_postgres(postgres_url) as url:
+            yield LetterManager(PostgresEngine(url))
+        return
+
+    path = os.path.join(directory, backend)
+    os.makedirs(path)
+    if backend == 'sqlite':
+        from storage.sqlite import SQLiteEngine
+        engine = SQLiteEngine(os.path.join(path, 'letters.db'))
+    else:
+        from storage.files import FileEngine
+        if backend == 'journal':
+            from storage.journal import JournalStore
+            engine = FileEngine(JournalStore.from_env(os.path.join(path, 'journal')),
+                                os.path.join(path, 'journal', 'index'))
+        elif backend == 'sharded':
+            from storage.sharded import ShardedStore
+            engine = FileEngine(ShardedStore(os.path.join(path, 'shards')), os.path.join(path, 'shards', 'index'))
+        else:
+            from storage.filestore import JsonDocumentStore
+            engine = FileEngine(JsonDocumentStore(os.path.join(path, 'letters_data.json')),
+                                os.path.join(path, 'letters_index'))
+    yield LetterManager(engine)
+
+
+def run_backend(backend, args, directory):
+    with open_backend(backend, directory, args.postgres_url) as manager:
+        corpus = generate_corpus(args.penpals, args.letters, args.notes, args.seed)
+        load_started = time.perf_counter()
+        loaded = import_records(manager, corpus)
+        load_seconds = time.perf_counter() - load_started
+        return {
+            "load": {"seconds": round(load_seconds, 3), "letters": loaded["letters"], "notes": loaded["notes"]},
+            "operations": bench_operations(manager, args.repeat, args.seed),
+            "http": bench_http(manager, args.requests, args.seed),
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """List (backend, section, name, baseline_ms, current_ms) whose median regressed past ``threshold``"""
+    regressions = []
+    for backend, current in results["backends"].items():
+        previous = baseline.get("backends", {}).get(backend)
+        if not previous:
+            continue
+        for section in ("operations", "http"):
+            for name, stats in current[section].items():
+                old = previous.get(section, {}).get(name)
+                if old and old["median_ms"] > 0 and stats["median_ms"] > old["median_ms"] * (1 + threshold):
+                    regressions.append((backend, section, name, old["median_ms"], stats["median_ms"]))
+    return regressions
+
+
+def print_results(results):
+    for backend, result in results["backends"].items():
+        print(f"\n{backend}: loaded {result['load']['letters']} letters in {result['load']['seconds']}s")
+        for section in ("operations", "http"):
+            for name, stats in result[section].items():
+                print(f"  {name:<36} median {stats['median_ms']:>9.3f}ms  p95 {stats['p95_ms']:>9.3f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark LetterManager and the web routes")
+    parser.add_argument('--backends', default='json,journal,sharded,sqlite',
+                        help="comma-separated: json, journal, sharded, sqlite, postgres")
+    parser.add_argument('--penpals', type=int, default=50)
+    parser.add_argument('--letters', type=int, default=200, help="average letters per penpal")
+    parser.add_argument('--notes', type=int, default=20, help="notes per penpal")
+    parser.add_argument('--repeat', type=int, default=50, help="timed runs per operation")
+    parser.add_argument('--requests', type=int, default=500, help="HTTP requests replayed per backend")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--postgres-url', default=os.getenv('BENCH_POSTGRES_URL'),
+                        help="server used to create a throwaway database (needs CREATE DATABASE)")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed median slowdown (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    backends = [backend.strip() for backend in args.backends.split(',') if backend.strip()]
+    if 'postgres' in backends and not args.postgres_url:
+        parser.error("the postgres backend needs --postgres-url or BENCH_POSTGRES_URL")
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "corpus": {"penpals": args.penpals, "letters": args.letters, "notes": args.notes, "seed": args.seed},
+            "repeat": args.repeat,
+            "requests": args.requests,
+        },
+        "backends": {},
+    }
+    with tempfile.TemporaryDirectory(prefix='letters_bench_') as directory:
+        # Keep schema-version cache files out of the shared temp dir
+        os.environ['LETTERS_SCHEMA_CACHE_DIR'] = directory
+        for backend in backends:
+            print(f"Benchmarking {backend}...")
+            # The engines print a line per write; keep that out of the report
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                results["backends"][backend] = run_backend(backend, args, directory)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print_results(results)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for backend, section, name, old, new in regressions:
+            print(f"REGRESSION {backend} {section} {name}: {old:.3f}ms -> {new:.3f}ms")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%} against {args.compare}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,80 @@
+"""gzip and Brotli compression of HTML, JSON and other text responses.
+
+``compress_response`` runs after every request. A response is compressed
+when its mimetype is in COMPRESSIBLE, it is at least
+RESPONSE_COMPRESSION_MIN_BYTES (default 1024) long and the client accepts
+an encoding: Brotli if the brotli package is installed, otherwise gzip.
+Streamed responses (exports, which gzip themselves) are left alone.
+RESPONSE_COMPRESSION=off turns it off, e.g. behind a proxy that already
+compresses.
+
+Sizes before and after are counted in ``metrics.RESPONSE_BYTES``, so
+/metrics shows the achieved ratio per encoding.
+"""
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import request
+
+from metrics import RESPONSE_BYTES
+
+ENABLED = os.getenv('RESPONSE_COMPRESSION', 'on').lower() not in ('off', '0', 'false')
+MIN_BYTES = int(os.getenv('RESPONSE_COMPRESSION_MIN_BYTES', '1024'))
+GZIP_LEVEL = 6
+# Brotli's higher qualities are far too slow to run per request
+BROTLI_QUALITY = 5
+COMPRESSIBLE = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'application/x-ndjson', 'image/svg+xml',
+}
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+
+def encoded_etag(etag, encoding):
+    """Strong ETag of the ``encoding`` copy of a response tagged ``etag``"""
+    return f"{etag}-{encoding}"
+
+
+def etag_variants(etag):
+    """``etag`` and the ETag of each compressed copy it may have been sent as"""
+    return [etag] + [encoded_etag(etag, encoding) for encoding in ('br', 'gzip')]
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL)
+
+
+def compress_response(response):
+    """after_request hook: compress ``response`` in the best encoding the client accepts"""
+    if (not ENABLED or response.direct_passthrough or response.is_streamed or
+            response.status_code != 200 or response.mimetype not in COMPRESSIBLE or
+            'Content-Encoding' in response.headers):
+        return response
+    # Caches must keep compressed and plain copies apart
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < MIN_BYTES:
+        return response
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if not encoding:
+        return response
+    compressed = compress(data, encoding)
+    RESPONSE_BYTES.inc(len(data), encoding=encoding, state='raw')
+    RESPONSE_BYTES.inc(min(len(compressed), len(data)), encoding=encoding, state='sent')
+    if len(compressed) >= len(data):
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes are a representation of their own, so they get
+    # their own strong ETag; etags.conditional recognises it on revalidation
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(encoded_etag(etag, encoding))
+    return response
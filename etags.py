@@ -0,0 +1,104 @@
+"""Conditional GET support: strong ETags and Last-Modified from penpal versions.
+
+Every write to a penpal's letters or notes bumps that penpal's version
+(``LetterManager.get_versions``), so a page or API response built from a
+penpal can be validated from its version alone, and one built from the
+whole archive from all of them, without reading any letters.
+"""
+import hashlib
+import os
+
+from flask import make_response, request
+
+from compression import etag_variants
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# What a response depends on besides the data: markup, assets and the code that shapes it
+SOURCE_DIRS = ('templates', 'static', '.', 'storage')
+SOURCE_EXTENSIONS = ('.html', '.css', '.js', '.py')
+
+
+def source_fingerprint():
+    """Hash of the templates, static assets and Python modules.
+
+    The same in every worker and across cold starts of one deploy, and
+    different once any of them changes.
+    """
+    digest = hashlib.sha256()
+    for directory in SOURCE_DIRS:
+        path = os.path.join(APP_ROOT, directory)
+        if not os.path.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, name)
+            if not name.endswith(SOURCE_EXTENSIONS) or not os.path.isfile(file_path):
+                continue
+            digest.update(f"{directory}/{name}\0".encode('utf-8'))
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+# Part of every ETag so a deploy (new templates or response shapes)
+# invalidates what clients cached from the previous one
+APP_VERSION = os.getenv('APP_VERSION') or os.getenv('VERCEL_GIT_COMMIT_SHA') or source_fingerprint()
+
+
+def make_etag(*parts):
+    digest = hashlib.sha256(APP_VERSION.encode('utf-8'))
+    for part in parts:
+        digest.update(b'\0' + str(part).encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+def penpal_validators(name, version, *parts):
+    """(etag, last_modified) for a response built from one penpal's data"""
+    return make_etag('penpal', name, version["version"], *parts), version["updated_at"]
+
+
+def archive_validators(versions, *parts):
+    """(etag, last_modified) for a response built from every penpal's data"""
+    etag = make_etag('archive', *[f"{name}={versions[name]['version']}" for name in sorted(versions)], *parts)
+    modified = [version["updated_at"] for version in versions.values() if version["updated_at"]]
+    return etag, max(modified) if modified else None
+
+
+def fresh_etag(etag, last_modified):
+    """The validator of the client's copy if it is still current, else None.
+
+    If-None-Match is compared strongly against ``etag`` and the per-encoding
+    ETags ``compression`` gives compressed copies of it; failing that,
+    If-Modified-Since is checked and ``etag`` itself returned.
+    """
+    if request.if_none_match:
+        for candidate in etag_variants(etag):
+            if request.if_none_match.contains(candidate):
+                return candidate
+        return None
+    if request.if_modified_since and last_modified:
+        if last_modified.replace(microsecond=0) <= request.if_modified_since:
+            return etag
+    return None
+
+
+def conditional(etag, last_modified, render):
+    """304 if the client's copy is current, else ``render()`` with validators attached.
+
+    ``render`` is only called on a miss, so a 304 costs nothing beyond the
+    version lookup that produced the validators. A 304 carries the ETag of
+    the copy the client holds, compressed or not.
+    """
+    matched = fresh_etag(etag, last_modified)
+    if matched:
+        response = make_response('', 304)
+        response.set_etag(matched)
+    else:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Let clients keep a copy but check it on every use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,75 @@
+"""Streaming export of the letter archive.
+
+Turns the records from ``LetterManager.iter_records`` into NDJSON, CSV or
+JSON text chunks (optionally gzipped) without holding more than one chunk
+in memory. The output reads back with ``importer``.
+"""
+import csv
+import io
+import json
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+CSV_FIELDS = ['type', 'penpal', 'name', 'country', 'created_date', 'id',
+              'content', 'date_received', 'date_added', 'note']
+
+
+def buffered(pieces, chunk_size=CHUNK_SIZE):
+    """Join small strings into chunks of about ``chunk_size`` characters"""
+    parts, size = [], 0
+    for piece in pieces:
+        parts.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(parts)
+            parts, size = [], 0
+    if parts:
+        yield ''.join(parts)
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def csv_lines(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def json_lines(records):
+    """A JSON array of records, written one element at a time"""
+    yield '['
+    for i, record in enumerate(records):
+        yield (',\n' if i else '\n') + json.dumps(record, ensure_ascii=False)
+    yield '\n]\n'
+
+
+WRITERS = {'ndjson': ndjson_lines, 'csv': csv_lines, 'json': json_lines}
+
+
+def export_chunks(records, fmt):
+    """Yield the export of ``records`` in ``fmt`` as text chunks"""
+    return buffered(WRITERS[fmt](records))
+
+
+def gzip_chunks(chunks):
+    """Gzip a stream of text chunks into a stream of bytes"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,282 @@
+import math
+import os
+import re
+import threading
+from types import SimpleNamespace
+
+from metrics import LLM_ERRORS, LLM_SECONDS, LLM_TOKENS
+from storage.search_index import tokenize
+
+GEMINI_MODEL = 'gemini-pro'
+NO_NEW_INFO = "No new information to extract."
+
+FOCUS = """
+    Focus on:
+    - Personal preferences (favorite colors, foods, hobbies, etc.)
+    - Interests and activities they enjoy
+    - Their profession, studies, or work
+    - Family members or pets mentioned
+    - Places they've been or want to visit
+    - Important life events or milestones
+    - Personality traits or characteristics
+    - Cultural details about their country/city
+"""
+
+# Existing notes are ranked by relevance to the letter and only the best
+# ones that fit this many (estimated) tokens go into the prompt
+NOTE_TOKEN_BUDGET = int(os.getenv('EXTRACTION_NOTE_BUDGET', '400'))
+NOTE_TOP_K = int(os.getenv('EXTRACTION_NOTE_TOP_K', '25'))
+# Extracted notes whose terms overlap an existing note's this much are dropped
+DUPLICATE_THRESHOLD = float(os.getenv('EXTRACTION_DUPLICATE_THRESHOLD', '0.5'))
+
+STOPWORDS = frozenset("""
+    a an and are as at be but by for from has have her his i in is it its my of on or our she
+    that the their they this to was we were with you your likes loves about also has had
+    named called very really lot
+""".split())
+TAG_RE = re.compile(r'^\s*(\[[^\]]*\]\s*)+')
+SUFFIXES = ('ing', 'ed', 'es', 's')
+
+BATCH_LETTER_RE = re.compile(r'<letter id="(\d+)">\n(.*?)\n</letter>', re.DOTALL)
+BATCH_LINE_RE = re.compile(r'^\s*\[?(\d+)\]?\s*[:.)-]\s*(.+)$')
+
+
+def load_model():
+    """Return the configured extraction model, or None if extraction is disabled.
+
+    EXTRACTION_FAKE_MODEL=1 selects the offline FakeModel; otherwise a
+    LazyModel is returned when GEMINI_API_KEY is set.
+    """
+    if os.getenv('EXTRACTION_FAKE_MODEL') == '1':
+        return FakeModel()
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        return None
+    return LazyModel(api_key)
+
+
+class LazyModel:
+    """``genai.GenerativeModel`` that is imported and configured on first use.
+
+    Importing google.generativeai is slow, so doing it at startup would add
+    to every serverless cold start, including ones that never extract.
+    """
+
+    def __init__(self, api_key, model_name=GEMINI_MODEL):
+        self.api_key = api_key
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=self.api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+            return self._model
+
+    def generate_content(self, prompt):
+        model = self._load()
+        LLM_TOKENS.inc(estimate_tokens(prompt), model=self.model_name, direction='prompt')
+        try:
+            with LLM_SECONDS.time(model=self.model_name):
+                response = model.generate_content(prompt)
+        except Exception:
+            LLM_ERRORS.inc(model=self.model_name)
+            raise
+        try:
+            text = response.text
+        except ValueError:
+            # Blocked responses have no text; callers report that themselves
+            text = ''
+        LLM_TOKENS.inc(estimate_tokens(text), model=self.model_name, direction='response')
+        return response
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token)"""
+    return len(text) // 4 + 1
+
+
+def stem(token):
+    """Strip a common English suffix so "plays" and "playing" match "play" """
+    for suffix in SUFFIXES:
+        if len(token) > len(suffix) + 2 and token.endswith(suffix):
+            return token[:-len(suffix)]
+    return token
+
+
+def note_terms(text):
+    """Stemmed content words of a note or letter, ignoring tags like "[AI] " """
+    return {
+        stem(token) for token in tokenize(TAG_RE.sub('', text))
+        if len(token) > 1 and token not in STOPWORDS
+    }
+
+
+def select_notes(letter_content, notes, token_budget=NOTE_TOKEN_BUDGET, top_k=NOTE_TOP_K):
+    """Pick the existing notes most relevant to a letter.
+
+    Notes are scored by IDF-weighted term overlap with the letter (ties go
+    to the newest note), and the best ``top_k`` that fit ``token_budget``
+    are returned in their original order.
+    """
+    letter = note_terms(letter_content)
+    terms = [note_terms(note) for note in notes]
+    document_frequency = {}
+    for note in terms:
+        for term in note:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+
+    def score(i):
+        shared = terms[i] & letter
+        weight = sum(math.log(1 + len(notes) / document_frequency[term]) for term in shared)
+        return weight / math.sqrt(len(terms[i])) if shared else 0.0
+
+    chosen, used = [], 0
+    for i in sorted(range(len(notes)), key=lambda i: (score(i), i), reverse=True):
+        if len(chosen) == top_k:
+            break
+        cost = estimate_tokens(notes[i])
+        if used + cost > token_budget:
+            continue
+        chosen.append(i)
+        used += cost
+    return [notes[i] for i in sorted(chosen)]
+
+
+def is_near_duplicate(terms, other_terms, threshold=DUPLICATE_THRESHOLD):
+    """Jaccard similarity test between two note term sets"""
+    if not terms or not other_terms:
+        return terms == other_terms
+    return len(terms & other_terms) / len(terms | other_terms) >= threshold
+
+
+def filter_new_notes(candidates, existing_notes, threshold=DUPLICATE_THRESHOLD):
+    """Drop candidates that repeat an existing note or an earlier candidate"""
+    seen = [note_terms(note) for note in existing_notes]
+    kept = []
+    for note in candidates:
+        terms = note_terms(note)
+        if any(is_near_duplicate(terms, other, threshold) for other in seen):
+            continue
+        seen.append(terms)
+        kept.append(note)
+    return kept
+
+
+def build_prompt(letter_content, penpal_name, existing_notes):
+    """Prompt asking for new notes about ``penpal_name`` from one letter"""
+    existing_notes_text = ' '.join(existing_notes)
+    return f"""
+    Analyze this letter from my pen pal {penpal_name} and extract key personal information that I should remember about them.
+{FOCUS}
+    Letter content:
+    {letter_content}
+
+    Existing notes I already have about {penpal_name}:
+    {existing_notes_text}
+
+    Please provide 3-5 short, concise bullet points of NEW information (avoid duplicating existing notes).
+    Each point should be a single sentence, like "Loves Italian food" or "Studies architecture at university" or "Has a cat named Luna".
+
+    If there's no significant new personal information to extract, respond with "{NO_NEW_INFO}"
+
+    Format your response as a simple list, one item per line. CRITICALLY IMPORTANT: DO NOT use any bullet points, hyphens, numbers, or any other prefixes before each item.
+    """
+
+
+def build_batch_prompt(penpal_name, letters, existing_notes):
+    """Prompt covering several letters at once.
+
+    ``letters`` is a list of letter contents; the model is asked to prefix
+    each note with the number of the letter it came from.
+    """
+    existing_notes_text = ' '.join(existing_notes)
+    letter_blocks = '\n'.join(
+        f'<letter id="{i}">\n{content}\n</letter>' for i, content in enumerate(letters, 1)
+    )
+    return f"""
+    Analyze these letters from my pen pal {penpal_name} and extract key personal information that I should remember about them.
+{FOCUS}
+{letter_blocks}
+
+    Existing notes I already have about {penpal_name}:
+    {existing_notes_text}
+
+    For each letter, provide up to 5 short, concise points of NEW information (avoid duplicating existing notes or each other).
+    Each point should be a single sentence, like "Loves Italian food" or "Has a cat named Luna".
+
+    Format your response as one item per line, starting with the letter's number and a colon, for example:
+    1: Loves Italian food
+    2: Has a cat named Luna
+
+    Leave out letters with no significant new personal information.
+    """
+
+
+def clean_extracted_notes(result):
+    """Turn the model's line-per-note reply into a list of notes"""
+    if NO_NEW_INFO.rstrip('.') in result:
+        return []
+
+    # Split into individual notes and clean them up
+    notes = [note.strip() for note in result.split('\n') if note.strip()]
+    # Remove any bullet points or numbers that might have been added
+    cleaned_notes = []
+    for note in notes:
+        # Remove common bullet point prefixes
+        note = note.lstrip('•-*123456789. ')
+        if note and len(note) > 5:  # Only keep substantial notes
+            cleaned_notes.append(note)
+
+    return cleaned_notes[:5]  # Limit to 5 notes max
+
+
+def parse_batch_response(result, letter_count):
+    """Split a batch reply into ``{letter_number: [notes]}``"""
+    notes = {i: [] for i in range(1, letter_count + 1)}
+    for line in result.split('\n'):
+        match = BATCH_LINE_RE.match(line)
+        if not match:
+            continue
+        number = int(match.group(1))
+        note = match.group(2).strip().lstrip('•-* ')
+        if number in notes and len(note) > 5 and len(notes[number]) < 5:
+            notes[number].append(note)
+    return notes
+
+
+class FakeModel:
+    """Offline stand-in for ``genai.GenerativeModel``.
+
+    Answers both prompt formats by picking first-person sentences out of each
+    letter, so the extraction pipeline can run without network access.
+    """
+
+    PATTERN = re.compile(r"\b(I am|I'm|I have|I love|I like|My)\b[^.!?\n]*", re.IGNORECASE)
+
+    def __init__(self, max_notes=3):
+        self.max_notes = max_notes
+        self.calls = 0
+
+    def _notes(self, content):
+        notes = []
+        for match in self.PATTERN.finditer(content):
+            sentence = match.group().strip()
+            if len(sentence) > 5 and sentence not in notes:
+                notes.append(sentence[0].upper() + sentence[1:])
+            if len(notes) == self.max_notes:
+                break
+        return notes
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        batch = BATCH_LETTER_RE.findall(prompt)
+        if batch:
+            lines = [f"{number}: {note}" for number, content in batch for note in self._notes(content)]
+        else:
+            content = prompt.split('Letter content:', 1)[-1].split('Existing notes I already have', 1)[0]
+            lines = self._notes(content)
+        return SimpleNamespace(text='\n'.join(lines) if lines else NO_NEW_INFO)
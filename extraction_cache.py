@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# The app directory is read-only on Vercel, so the cache lives in the temp dir by default
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'slowly_letters_extraction_cache.db')
+
+
+class ExtractionCache:
+    """Persistent cache of Gemini extraction results.
+
+    Entries are keyed by a hash of the model name, the penpal's name (it is
+    part of the prompt), the letter content and the penpal's current note
+    set, so an identical request is answered without calling the model. Each entry keeps the raw model output alongside the
+    cleaned notes. Entries expire after ``ttl`` seconds and the least recently
+    used ones are evicted beyond ``max_entries``.
+
+    If the database can't be opened (a read-only filesystem, say) the cache
+    turns itself off: every lookup misses and results aren't stored.
+    """
+
+    def __init__(self, path, ttl=30 * 24 * 3600, max_entries=1000, model_name=''):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self.disabled = False
+
+    @classmethod
+    def from_env(cls, model_name=''):
+        return cls(
+            os.getenv('EXTRACTION_CACHE_PATH') or DEFAULT_PATH,
+            ttl=float(os.getenv('EXTRACTION_CACHE_TTL', str(30 * 24 * 3600))),
+            max_entries=int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', '1000')),
+            model_name=model_name,
+        )
+
+    def _connect(self):
+        """The open connection, or None once the database has failed to open"""
+        if self._conn is None and not self.disabled:
+            try:
+                conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS extractions (
+                        key TEXT PRIMARY KEY,
+                        raw TEXT,
+                        notes TEXT NOT NULL,
+                        created REAL NOT NULL,
+                        last_used REAL NOT NULL
+                    )
+                ''')
+                conn.execute("CREATE INDEX IF NOT EXISTS extractions_last_used_idx ON extractions (last_used)")
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Extraction cache disabled, cannot open {self.path}: {e}")
+                self.disabled = True
+                return None
+            self._conn = conn
+        return self._conn
+
+    def key(self, penpal_name, letter_content, notes):
+        """Cache key for extracting ``penpal_name``'s ``letter_content`` given the existing ``notes``"""
+        digest = hashlib.sha256()
+        for part in [self.model_name, penpal_name, letter_content] + sorted(notes):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return {"raw": str or None, "notes": [...]} or None on a miss"""
+        try:
+            with self._lock:
+                conn = self._connect()
+                if conn is None:
+                    self.misses += 1
+                    return None
+                row = conn.execute(
+                    "SELECT raw, notes, created FROM extractions WHERE key = ?", (key,)
+                ).fetchone()
+                now = time.time()
+                if row and now - row[2] > self.ttl:
+                    conn.execute("DELETE FROM extractions WHERE key = ?", (key,))
+                    conn.commit()
+                    row = None
+                if not row:
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE extractions SET last_used = ? WHERE key = ?", (now, key))
+                conn.commit()
+                self.hits += 1
+                return {"raw": row[0], "notes": json.loads(row[1])}
+        except Exception as e:
+            print(f"Extraction cache error: {e}")
+            return None
+
+    def put(self, key, raw, notes):
+        """Store an extraction result, evicting least recently used entries"""
+        try:
+            with self._lock:
+                conn = self._connect()
+                if conn is None:
+                    return
+                now = time.time()
+                conn.execute(
+                    "INSERT OR REPLACE INTO extractions (key, raw, notes, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, raw, json.dumps(notes, ensure_ascii=False), now, now)
+                )
+                conn.execute('''
+                    DELETE FROM extractions WHERE key IN (
+                        SELECT key FROM extractions ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,))
+                conn.commit()
+        except Exception as e:
+            print(f"Extraction cache error: {e}")
+
+    def stats(self):
+        with self._lock:
+            try:
+                entries = self._connect().execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+            except Exception:
+                entries = None
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": entries,
+                "disabled": self.disabled
+            }
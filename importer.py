@@ -0,0 +1,254 @@
+"""Bulk import of exported letter archives.
+
+    python importer.py archive.ndjson [--format ndjson|csv|json] [--batch-size N]
+
+Accepts NDJSON or CSV with one penpal, letter or note per record, and JSON
+holding either a list of such records or a letters_data.json document.
+Files ending in .gz are decompressed on the fly. NDJSON and CSV are
+streamed and written in batches, one transaction per batch; the file
+backends, which hold the whole document in memory anyway, take it in a
+single save. JSON has no streaming parser in the standard library, so it
+is parsed whole.
+
+A record's kind comes from its "type" field ("penpal", "letter" or
+"note") or, failing that, from its fields: "content" makes a letter,
+"note" a note, and "name" plus "country" a penpal. Letters and notes name
+their penpal in "penpal" (or "penpal_name"). Letters already stored for a
+penpal, or repeated in the file, are skipped by content hash; notes are
+skipped when the penpal already has the same text.
+"""
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import sys
+import time
+from datetime import datetime
+
+FORMATS = ('ndjson', 'csv', 'json')
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith('.json'):
+        return 'json'
+    return None
+
+
+def text_stream(binary, gzipped=False):
+    """Wrap a binary stream (an upload, stdin) as UTF-8 text"""
+    if gzipped:
+        binary = gzip.GzipFile(fileobj=binary)
+    return io.TextIOWrapper(binary, encoding='utf-8', newline='')
+
+
+def open_text(path):
+    """Open ``path`` (or '-' for stdin) as text, decompressing .gz files"""
+    if path == '-':
+        return text_stream(sys.stdin.buffer)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def read_records(f, fmt):
+    """Yield raw record dicts from an open text file"""
+    if fmt == 'ndjson':
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    elif fmt == 'csv':
+        for row in csv.DictReader(f):
+            # Empty CSV cells mean "not given"
+            yield {key: value for key, value in row.items() if key and value != ''}
+    elif fmt == 'json':
+        data = json.load(f)
+        if isinstance(data, list):
+            yield from data
+        elif isinstance(data.get("penpals"), dict):
+            yield from document_records(data)
+        else:
+            for kind in ("penpals", "letters", "notes"):
+                yield from data.get(kind, [])
+    else:
+        raise ValueError(f"Unknown import format {fmt!r}")
+
+
+def document_records(data):
+    """Flatten a letters_data.json document into penpal, letter and note records"""
+    for name, penpal in data["penpals"].items():
+        yield {"type": "penpal", "name": name, "country": penpal.get("country"),
+               "created_date": penpal.get("created_date")}
+        for letter in penpal.get("letters", []):
+            yield dict(letter, type="letter", penpal=name)
+        for note in penpal.get("notes", []):
+            yield dict(note, type="note", penpal=name)
+
+
+def normalize(record, now):
+    """Return (kind, record) in the shape import_batch expects, or None if unusable"""
+    kind = record.get("type")
+    if kind is None:
+        if "content" in record:
+            kind = "letter"
+        elif "note" in record:
+            kind = "note"
+        elif "name" in record and "country" in record:
+            kind = "penpal"
+    penpal = record.get("penpal") or record.get("penpal_name")
+
+    if kind == "penpal" and record.get("name"):
+        return kind, {
+            "name": record["name"],
+            "country": record.get("country") or "Unknown",
+            "created_date": record.get("created_date") or now
+        }
+    if kind == "letter" and penpal and record.get("content"):
+        return kind, {
+            "penpal": penpal,
+            "content": record["content"],
+            "date_received": record.get("date_received") or now,
+            "date_added": record.get("date_added") or now
+        }
+    if kind == "note" and penpal and record.get("note"):
+        return kind, {"penpal": penpal, "note": record["note"], "date_added": record.get("date_added") or now}
+    return None
+
+
+def content_hash(penpal_name, content):
+    return hashlib.sha256(f"{penpal_name}\0{content}".encode('utf-8')).hexdigest()
+
+
+class Deduplicator:
+    """Tracks what each penpal already has, loading a penpal's stored letters and notes once"""
+
+    def __init__(self, letter_manager):
+        self.letter_manager = letter_manager
+        self.known = {}
+
+    def penpal(self, name):
+        """Existing hashes and note texts for ``name``; None if the penpal doesn't exist yet"""
+        if name not in self.known:
+            stored = self.letter_manager.get_penpal(name)
+            self.known[name] = stored and {
+                "letters": {content_hash(name, letter["content"]) for letter in stored["letters"]},
+                "notes": {note["note"] for note in stored["notes"]}
+            }
+        return self.known[name]
+
+    def add_penpal(self, name):
+        """True if ``name`` is new; it then counts as existing for later records"""
+        if self.penpal(name) is not None:
+            return False
+        self.known[name] = {"letters": set(), "notes": set()}
+        return True
+
+    def add(self, kind, record):
+        """'new', 'duplicate' or 'missing' (penpal unknown) for a letter or note record"""
+        seen = self.penpal(record["penpal"])
+        if seen is None:
+            return 'missing'
+        key = content_hash(record["penpal"], record["content"]) if kind == "letter" else record["note"]
+        bucket = seen["letters" if kind == "letter" else "notes"]
+        if key in bucket:
+            return 'duplicate'
+        bucket.add(key)
+        return 'new'
+
+
+def import_records(letter_manager, records, batch_size=None, progress=None):
+    """Import an iterable of raw records; returns a summary dict.
+
+    Records are deduplicated and written ``batch_size`` at a time (default:
+    the engine's ``import_batch_size``) through
+    ``letter_manager.import_batch``. ``progress`` is called with the running
+    summary after each batch.
+    """
+    batch_size = batch_size or letter_manager.engine.import_batch_size
+    summary = {"penpals": 0, "letters": 0, "notes": 0, "duplicates": 0, "skipped": 0,
+               "errors": 0, "records": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    dedup = Deduplicator(letter_manager)
+    now = datetime.now().isoformat()
+    batch = {"penpal": [], "letter": [], "note": []}
+
+    def flush():
+        size = sum(len(items) for items in batch.values())
+        if not size:
+            return
+        written = letter_manager.import_batch(batch["penpal"], batch["letter"], batch["note"])
+        if written is None:
+            summary["errors"] += size
+            # Nothing from the batch was stored, so forget it for dedup
+            dedup.known.clear()
+        else:
+            for kind in ("penpals", "letters", "notes"):
+                summary[kind] += written[kind]
+        for items in batch.values():
+            items.clear()
+        summary["seconds"] = round(time.perf_counter() - started, 3)
+        if progress:
+            progress(summary)
+
+    for raw in records:
+        summary["records"] += 1
+        normalized = normalize(raw, now) if isinstance(raw, dict) else None
+        if normalized is None:
+            summary["skipped"] += 1
+            continue
+        kind, record = normalized
+        if kind == "penpal":
+            status = 'new' if dedup.add_penpal(record["name"]) else 'duplicate'
+        else:
+            status = dedup.add(kind, record)
+        if status == 'duplicate':
+            summary["duplicates"] += 1
+        elif status == 'missing':
+            summary["skipped"] += 1
+        else:
+            batch[kind].append(record)
+            if batch_size and sum(len(items) for items in batch.values()) >= batch_size:
+                flush()
+    flush()
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def import_file(letter_manager, path, fmt=None, batch_size=None, progress=None):
+    """Import an export file; ``fmt`` defaults to one guessed from the extension"""
+    fmt = fmt or detect_format(path)
+    if fmt is None:
+        raise ValueError(f"Can't tell the format of {path}; pass one of {', '.join(FORMATS)}")
+    with open_text(path) as f:
+        return import_records(letter_manager, read_records(f, fmt), batch_size, progress)
+
+
+def print_progress(summary):
+    rate = summary["records"] / summary["seconds"] if summary["seconds"] else 0
+    print(f"{summary['records']} records read, {summary['letters']} letters, {summary['notes']} notes, "
+          f"{summary['penpals']} penpals written ({rate:.0f} records/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import penpals, letters and notes from an export file")
+    parser.add_argument('path', help="file to import ('-' reads NDJSON or CSV from stdin with --format)")
+    parser.add_argument('--format', choices=FORMATS, help="input format (default: from the file extension)")
+    parser.add_argument('--batch-size', type=int, help="records per transaction (default: per storage engine)")
+    args = parser.parse_args(argv)
+    if args.format is None and detect_format(args.path) is None:
+        parser.error("can't tell the input format; pass --format")
+
+    from letters import LetterManager
+    summary = import_file(LetterManager(), args.path, args.format, args.batch_size, print_progress)
+    print(json.dumps(summary))
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
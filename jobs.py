@@ -0,0 +1,180 @@
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+
+class RateLimiter:
+    """Sliding-window limiter allowing ``per_minute`` calls in any 60 seconds"""
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed"""
+        if not self.per_minute:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= 60:
+                    self._calls.popleft()
+                if len(self._calls) < self.per_minute:
+                    self._calls.append(now)
+                    return
+                wait = 60 - (now - self._calls[0])
+            time.sleep(wait)
+
+
+class JobQueue:
+    """Bounded background job queue with a fixed worker pool.
+
+    Failed jobs are retried with exponential backoff (plus jitter) up to
+    ``max_retries`` times, and every attempt first waits on the rate limiter.
+    Worker threads start on the first submission. With ``workers=0`` jobs run
+    inline in ``submit``, which suits serverless hosts that freeze the
+    process once the response is sent.
+    """
+
+    def __init__(self, workers=2, maxsize=100, max_retries=3, backoff=2.0,
+                 rate_per_minute=30, keep=500):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate_per_minute)
+        self.keep = keep
+
+        self._queue = queue.Queue(maxsize)
+        self._jobs = OrderedDict()
+        self._inflight = {}  # dedupe key -> id of a queued or running job
+        self._lock = threading.Lock()
+        self._threads = []
+
+    @classmethod
+    def from_env(cls):
+        """Build a queue from the EXTRACTION_* environment variables.
+
+        EXTRACTION_WORKERS defaults to 0 on Vercel (VERCEL is set there),
+        where worker threads would be frozen with the queued jobs, and to 2
+        elsewhere.
+        """
+        default_workers = '0' if os.getenv('VERCEL') else '2'
+        return cls(
+            workers=int(os.getenv('EXTRACTION_WORKERS', default_workers)),
+            maxsize=int(os.getenv('EXTRACTION_QUEUE_SIZE', '100')),
+            max_retries=int(os.getenv('EXTRACTION_MAX_RETRIES', '3')),
+            backoff=float(os.getenv('EXTRACTION_BACKOFF', '2')),
+            rate_per_minute=int(os.getenv('EXTRACTION_RATE_PER_MINUTE', '30')),
+        )
+
+    def _start_workers(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args, dedupe_key=None, **kwargs):
+        """Queue ``func(*args, **kwargs)`` and return the new job's id.
+
+        If a job with the same ``dedupe_key`` is still queued or running, its
+        id is returned instead of queueing a duplicate. Raises ``queue.Full``
+        if the queue is at capacity.
+        """
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "attempts": 0,
+            "result": None,
+            "error": None,
+            "created": time.time(),
+            "updated": time.time(),
+        }
+        with self._lock:
+            if dedupe_key is not None and dedupe_key in self._inflight:
+                return self._inflight[dedupe_key]
+            self._jobs[job_id] = job
+            if dedupe_key is not None:
+                self._inflight[dedupe_key] = job_id
+                job["dedupe_key"] = dedupe_key
+            self._prune()
+
+        if self.workers <= 0:
+            self._run(job, func, args, kwargs, inline=True)
+            return job_id
+
+        try:
+            self._queue.put_nowait((job, func, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+                self._inflight.pop(dedupe_key, None)
+            raise
+        self._start_workers()
+        return job_id
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields, updated=time.time())
+            if job["status"] in ("done", "failed"):
+                self._inflight.pop(job.get("dedupe_key"), None)
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond ``keep``"""
+        excess = len(self._jobs) - self.keep
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id]["status"] in ("done", "failed"):
+                del self._jobs[job_id]
+                excess -= 1
+
+    def _work(self):
+        while True:
+            job, func, args, kwargs = self._queue.get()
+            try:
+                self._run(job, func, args, kwargs)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job, func, args, kwargs, inline=False):
+        while True:
+            self.limiter.acquire()
+            self._update(job, status="running", attempts=job["attempts"] + 1)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                print(f"Job {job['id']} attempt {job['attempts']} failed: {e}")
+                if job["attempts"] > self.max_retries:
+                    self._update(job, status="failed", error=str(e))
+                    return
+                delay = self.backoff * 2 ** (job["attempts"] - 1) * random.uniform(0.5, 1.5)
+                self._update(job, status="retrying", error=str(e))
+                if inline:
+                    time.sleep(delay)
+                    continue
+                # Re-queue after the delay instead of holding this worker
+                timer = threading.Timer(delay, self._requeue, (job, func, args, kwargs))
+                timer.daemon = True
+                timer.start()
+                return
+            self._update(job, status="done", result=result, error=None)
+            return
+
+    def _requeue(self, job, func, args, kwargs):
+        try:
+            self._queue.put_nowait((job, func, args, kwargs))
+        except queue.Full:
+            self._update(job, status="failed", error="Queue full on retry")
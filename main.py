@@ -1,32 +1,89 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify
-import json
-import os
-from datetime import datetime
-from letters import LetterManager
-import google.generativeai as genai
+from startup import StartupTimer
+startup = StartupTimer()
+
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, g
+import hashlib
+import queue
+import time
+from werkzeug.utils import secure_filename
+from compression import compress_response
+from extraction import GEMINI_MODEL, build_prompt, clean_extracted_notes, filter_new_notes, load_model, select_notes
+from extraction_cache import ExtractionCache
+from etags import archive_validators, conditional, penpal_validators
+from exporter import MIMETYPES, export_chunks, gzip_chunks
+from jobs import JobQueue
+from importer import detect_format, import_records, read_records, text_stream
+from letters import LetterManager, LETTERS_PAGE_SIZE, SEARCH_PAGE_SIZE
+import metrics
+startup.mark('imports')
 
 app = Flask(__name__)
+# Nothing below connects to the database or loads the Gemini client; both
+# happen on first use
 letter_manager = LetterManager()
+extraction_jobs = JobQueue.from_env()
 
 # Configure Gemini AI
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-pro')
-else:
-    model = None
+model = load_model()
+extraction_cache = ExtractionCache.from_env(model_name=GEMINI_MODEL)
+startup.mark('init')
+
+profiler = metrics.SamplingProfiler.from_env()
+
+@app.before_request
+def start_request():
+    g.request_started = time.perf_counter()
+    g.profiler = profiler.start()
+
+@app.after_request
+def finish_request(response):
+    """Record the request's latency, and print cold-start timings after the first one"""
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_SECONDS.observe(elapsed, method=request.method, route=route, status=response.status_code)
+    if g.profiler:
+        profiler.stop(g.profiler, f"{request.method} {route}")
+    if not startup.reported:
+        startup.report('first_request', elapsed)
+    return response
+
+# Registered after finish_request so it runs first and its time is counted
+app.after_request(compress_response)
 
 @app.route('/')
 def index():
-    penpals = letter_manager.get_all_penpals()
-    return render_template('index.html', penpals=penpals, letter_manager=letter_manager)
+    etag, last_modified = archive_validators(letter_manager.get_versions(), 'index')
+    return conditional(etag, last_modified, lambda: render_template(
+        'index.html', penpals=letter_manager.get_all_penpals(), stats=letter_manager.get_stats()))
 
 @app.route('/penpal/<path:penpal_name>')
 def penpal_details(penpal_name):
-    penpal = letter_manager.get_penpal(penpal_name)
-    if not penpal:
+    version = letter_manager.get_versions(penpal_name).get(penpal_name)
+    if version is None:
         return redirect(url_for('index'))
-    return render_template('penpal.html', penpal=penpal, gemini_available=bool(model))
+    
+    def render():
+        # Only the newest page of letters is loaded; older ones come from /letters
+        penpal = letter_manager.get_penpal_page(penpal_name, LETTERS_PAGE_SIZE)
+        if not penpal:
+            return redirect(url_for('index'))
+        return render_template('penpal.html', penpal=penpal, penpal_name=penpal["name"],
+                               letters=penpal["letters"], next_cursor=penpal["next_cursor"],
+                               gemini_available=bool(model), job_id=request.args.get('job'))
+    
+    etag, last_modified = penpal_validators(penpal_name, version, 'page', request.args.get('job'), bool(model))
+    return conditional(etag, last_modified, render)
+
+@app.route('/letters/<path:penpal_name>')
+def letters_page(penpal_name):
+    """HTML fragment with the next page of older letters for the penpal page"""
+    cursor = request.args.get('cursor')
+    page = letter_manager.get_letters_page(penpal_name, LETTERS_PAGE_SIZE, cursor)
+    return render_template('letters_page.html', penpal_name=penpal_name,
+                           letters=page["letters"], next_cursor=page["next_cursor"],
+                           gemini_available=bool(model))
 
 @app.route('/add_penpal', methods=['GET', 'POST'])
 def add_penpal():
@@ -39,102 +96,107 @@ def add_penpal():
 
 @app.route('/add_letter', methods=['POST'])
 def add_letter():
-    print("=== /add_letter called ===")
     penpal_name = request.form['penpal_name']
     content = request.form['content']
     date_received = request.form['date_received']
     auto_extract = request.form.get('auto_extract') == 'on'
-
-    print(f"Submitted penpal_name: '{penpal_name}'")
-    print(f"Existing penpals: {[p['name'] for p in letter_manager.get_all_penpals()]}")
     
     success = letter_manager.add_letter(penpal_name, content, date_received)
     if not success:
         # flash a message, or render a template with an error
         return "Penpal not found or error adding letter.", 400
     
-    # Add the letter first
-    letter_manager.add_letter(penpal_name, content, date_received)
-    
     # If auto-extract is enabled and Gemini is configured, extract information
+    # in the background so the redirect doesn't wait on the model
+    job_id = None
     if auto_extract and model:
-        try:
-            extracted_info = extract_info_from_letter(content, penpal_name)
-            if extracted_info:
-                for info in extracted_info:
-                    letter_manager.add_note(penpal_name, info)
-        except Exception as e:
-            print(f"Error extracting info with Gemini: {e}")
+        job_id = queue_extraction(penpal_name, content)
     
-    return redirect(url_for('penpal_details', penpal_name=penpal_name))
+    return redirect(url_for('penpal_details', penpal_name=penpal_name, job=job_id))
 
-def extract_info_from_letter(letter_content, penpal_name):
-    """Extract key information from letter using Gemini AI"""
+def queue_extraction(penpal_name, letter_content, prefix=''):
+    """Submit a background extraction job; returns its id, or None if the queue is full"""
+    # A double-submitted letter joins the job already in flight
+    dedupe_key = hashlib.sha256(f"{penpal_name}\0{prefix}\0{letter_content}".encode('utf-8')).hexdigest()
+    try:
+        return extraction_jobs.submit(extract_and_save_notes, penpal_name, letter_content, prefix,
+                                      dedupe_key=dedupe_key)
+    except queue.Full:
+        print(f"Extraction queue full, skipping extraction for {penpal_name}")
+        return None
+
+def extract_and_save_notes(penpal_name, letter_content, prefix=''):
+    """Job body: extract notes from a letter and store them"""
+    existing_notes = [note['note'] for note in letter_manager.get_notes(penpal_name) or []]
+    extracted_info = extract_info_from_letter(letter_content, penpal_name, raise_errors=True,
+                                              existing_notes=existing_notes)
+    saved = [f"{prefix}{info}" for info in extracted_info]
+    if saved and letter_manager.add_notes(penpal_name, saved):
+        # The notes just saved already cover this letter, so extracting it
+        # again against the new note set has nothing new to add.
+        context = select_notes(letter_content, existing_notes + saved)
+        extraction_cache.put(extraction_cache.key(penpal_name, letter_content, context), None, [])
+    return {"notes": extracted_info}
+
+def extract_info_from_letter(letter_content, penpal_name, raise_errors=False, existing_notes=None):
+    """Extract key information from letter using Gemini AI.
+    
+    Only the existing notes most relevant to the letter (within a token
+    budget) go into the prompt, and extracted notes that near-duplicate an
+    existing one are dropped. Results are cached by penpal, letter content
+    and that note context, so repeated extractions skip the model. With raise_errors,
+    API failures propagate so the job queue can retry them.
+    """
     if not model:
         return []
     
     # Get existing notes to avoid duplicates
-    existing_notes = letter_manager.get_penpal(penpal_name).get('notes', [])
-    existing_notes_text = ' '.join([note['note'] for note in existing_notes])
+    if existing_notes is None:
+        existing_notes = [note['note'] for note in letter_manager.get_notes(penpal_name) or []]
+    context = select_notes(letter_content, existing_notes)
     
-    prompt = f"""
-    Analyze this letter from my pen pal {penpal_name} and extract key personal information that I should remember about them. 
-
-    Focus on:
-    - Personal preferences (favorite colors, foods, hobbies, etc.)
-    - Interests and activities they enjoy
-    - Their profession, studies, or work
-    - Family members or pets mentioned
-    - Places they've been or want to visit
-    - Important life events or milestones
-    - Personality traits or characteristics
-    - Cultural details about their country/city
-
-    Letter content:
-    {letter_content}
-
-    Existing notes I already have about {penpal_name}:
-    {existing_notes_text}
-
-    Please provide 3-5 short, concise bullet points of NEW information (avoid duplicating existing notes). 
-    Each point should be a single sentence, like "Loves Italian food" or "Studies architecture at university" or "Has a cat named Luna".
+    cache_key = extraction_cache.key(penpal_name, letter_content, context)
+    cached = extraction_cache.get(cache_key)
+    if cached is not None:
+        return filter_new_notes(cached["notes"], existing_notes)
     
-    If there's no significant new personal information to extract, respond with "No new information to extract."
-
-    Format your response as a simple list, one item per line. CRITICALLY IMPORTANT: DO NOT use any bullet points, hyphens, numbers, or any other prefixes before each item.
-    """
+    prompt = build_prompt(letter_content, penpal_name, context)
     
     try:
         response = model.generate_content(prompt)
         result = response.text.strip()
-        
-        if "No new information to extract" in result:
-            return []
-        
-        # Split into individual notes and clean them up
-        notes = [note.strip() for note in result.split('\n') if note.strip()]
-        # Remove any bullet points or numbers that might have been added
-        cleaned_notes = []
-        for note in notes:
-            # Remove common bullet point prefixes
-            note = note.lstrip('•-*123456789. ')
-            if note and len(note) > 5:  # Only keep substantial notes
-                cleaned_notes.append(note)
-        
-        return cleaned_notes[:5]  # Limit to 5 notes max
+        cleaned_notes = clean_extracted_notes(result)
+        extraction_cache.put(cache_key, result, cleaned_notes)
+        return filter_new_notes(cleaned_notes, existing_notes)
         
     except Exception as e:
         print(f"Gemini API error: {e}")
+        if raise_errors:
+            raise
         return []
 
 @app.route('/delete_letter', methods=['POST'])
 def delete_letter():
     penpal_name = request.form['penpal_name']
-    letter_index = int(request.form['letter_index'])
-    success = letter_manager.delete_letter(penpal_name, letter_index)
+    letter_id = int(request.form['letter_id'])
+    success = letter_manager.delete_letter(penpal_name, letter_id)
     if not success:
-        # Add flash message or error handling
-        flash("Failed to delete letter. Please try again.")
+        return "Letter not found or error deleting letter.", 400
+    return redirect(url_for('penpal_details', penpal_name=penpal_name))
+
+@app.route('/update_letter', methods=['POST'])
+def update_letter():
+    penpal_name = request.form['penpal_name']
+    letter_id = int(request.form['letter_id'])
+    date_received = request.form.get('date_received') or None
+    # The form shows only the date part; an unchanged one would truncate the stored timestamp
+    if date_received == request.form.get('original_date_received'):
+        date_received = None
+    success = letter_manager.update_letter(penpal_name, letter_id,
+                                           content=request.form.get('content') or None,
+                                           date_received=date_received)
+    if not success:
+        return "Letter not found or error updating letter.", 400
     return redirect(url_for('penpal_details', penpal_name=penpal_name))
 
 @app.route('/add_note', methods=['POST'])
@@ -147,32 +209,180 @@ def add_note():
 @app.route('/delete_note', methods=['POST'])
 def delete_note():
     penpal_name = request.form['penpal_name']
-    note_index = int(request.form['note_index'])
-    letter_manager.delete_note(penpal_name, note_index)
+    note_id = int(request.form['note_id'])
+    letter_manager.delete_note(penpal_name, note_id)
+    return redirect(url_for('penpal_details', penpal_name=penpal_name))
+
+@app.route('/update_note', methods=['POST'])
+def update_note():
+    penpal_name = request.form['penpal_name']
+    note_id = int(request.form['note_id'])
+    note = request.form['note'].strip()
+    if note:
+        letter_manager.update_note(penpal_name, note_id, note)
     return redirect(url_for('penpal_details', penpal_name=penpal_name))
 
 @app.route('/search')
 def search():
     query = request.args.get('q', '')
-    results = letter_manager.search_letters(query)
-    return render_template('search_results.html', results=results, query=query)
+    cursor = request.args.get('cursor')
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), 100)
+    page = letter_manager.search_letters_page(query, limit, cursor)
+    return render_template('search_results.html', results=page["results"], query=query,
+                           next_cursor=page["next_cursor"], total=page["total"], limit=limit)
 
 @app.route('/extract_from_letter', methods=['POST'])
 def extract_from_letter():
     """Manually extract information from a specific letter"""
     penpal_name = request.form['penpal_name']
-    letter_content = request.form['letter_content']
+    letter = letter_manager.get_letter(penpal_name, int(request.form['letter_id']))
+    if not letter:
+        return "Letter not found.", 404
     
+    job_id = None
     if model:
-        try:
-            extracted_info = extract_info_from_letter(letter_content, penpal_name)
-            if extracted_info:
-                for info in extracted_info:
-                    letter_manager.add_note(penpal_name, f"[AI] {info}")
-        except Exception as e:
-            print(f"Error extracting info: {e}")
+        job_id = queue_extraction(penpal_name, letter["content"], prefix="[AI] ")
     
-    return redirect(url_for('penpal_details', penpal_name=penpal_name))
+    return redirect(url_for('penpal_details', penpal_name=penpal_name, job=job_id))
+
+@app.route('/import', methods=['POST'])
+def import_archive():
+    """Bulk import an uploaded NDJSON, CSV or JSON export (optionally gzipped)"""
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({"error": "Upload the export as 'file'"}), 400
+    filename = upload.filename or ''
+    fmt = request.form.get('format') or detect_format(filename)
+    if fmt is None:
+        return jsonify({"error": "Unknown format; pass format=ndjson, csv or json"}), 400
+    
+    records = read_records(text_stream(upload.stream, gzipped=filename.endswith('.gz')), fmt)
+    try:
+        summary = import_records(letter_manager, records)
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({"error": f"Could not read the export: {e}"}), 400
+    return jsonify(summary), 500 if summary["errors"] else 200
+
+@app.route('/export')
+def export_archive():
+    """Stream the archive, or one penpal's part of it, as NDJSON, CSV or JSON.
+    
+    ?format= picks the format (default ndjson), ?penpal= limits it to one
+    penpal and ?gzip=1 compresses it.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in MIMETYPES:
+        return jsonify({"error": f"format must be one of {', '.join(MIMETYPES)}"}), 400
+    penpal_name = request.args.get('penpal')
+    if penpal_name and letter_manager.get_penpal_header(penpal_name) is None:
+        return jsonify({"error": "Penpal not found"}), 404
+    
+    filename = f"letters.{fmt}"
+    if penpal_name:
+        filename = f"letters-{secure_filename(penpal_name) or 'penpal'}.{fmt}"
+    chunks = export_chunks(letter_manager.iter_records(penpal_name), fmt)
+    mimetype = MIMETYPES[fmt]
+    if request.args.get('gzip') == '1':
+        chunks, mimetype, filename = gzip_chunks(chunks), 'application/gzip', filename + '.gz'
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# JSON API (v1). Responses carry strong ETags built from penpal versions
+# and answer a matching If-None-Match with 304 before reading any letters.
+
+def api_penpal_version(penpal_name):
+    return letter_manager.get_versions(penpal_name).get(penpal_name)
+
+def api_not_found():
+    return jsonify({"error": "Penpal not found"}), 404
+
+def api_limit(default):
+    return min(max(request.args.get('limit', default, type=int), 1), 100)
+
+@app.route('/api/v1/penpals')
+def api_penpals():
+    versions = letter_manager.get_versions()
+    
+    def render():
+        penpals = letter_manager.get_all_penpals()
+        for penpal in penpals:
+            penpal["version"] = versions.get(penpal["name"], {}).get("version")
+        return jsonify({"penpals": penpals})
+    
+    etag, last_modified = archive_validators(versions, 'api-penpals')
+    return conditional(etag, last_modified, render)
+
+@app.route('/api/v1/penpals/<path:penpal_name>/letters')
+def api_letters(penpal_name):
+    version = api_penpal_version(penpal_name)
+    if version is None:
+        return api_not_found()
+    cursor = request.args.get('cursor')
+    limit = api_limit(LETTERS_PAGE_SIZE)
+    etag, last_modified = penpal_validators(penpal_name, version, 'api-letters', cursor, limit)
+    return conditional(etag, last_modified,
+                       lambda: jsonify(letter_manager.get_letters_page(penpal_name, limit, cursor)))
+
+@app.route('/api/v1/penpals/<path:penpal_name>/notes')
+def api_notes(penpal_name):
+    version = api_penpal_version(penpal_name)
+    if version is None:
+        return api_not_found()
+    etag, last_modified = penpal_validators(penpal_name, version, 'api-notes')
+    return conditional(etag, last_modified,
+                       lambda: jsonify({"notes": letter_manager.get_notes(penpal_name) or []}))
+
+@app.route('/api/v1/penpals/<path:penpal_name>')
+def api_penpal(penpal_name):
+    version = api_penpal_version(penpal_name)
+    if version is None:
+        return api_not_found()
+    
+    def render():
+        penpal = letter_manager.get_penpal_header(penpal_name)
+        if penpal is None:
+            return api_not_found()
+        return jsonify(dict(penpal, version=version["version"]))
+    
+    etag, last_modified = penpal_validators(penpal_name, version, 'api-penpal')
+    return conditional(etag, last_modified, render)
+
+@app.route('/api/v1/search')
+def api_search():
+    query = request.args.get('q', '')
+    cursor = request.args.get('cursor')
+    limit = api_limit(SEARCH_PAGE_SIZE)
+    etag, last_modified = archive_validators(letter_manager.get_versions(), 'api-search', query, cursor, limit)
+    return conditional(etag, last_modified,
+                       lambda: jsonify(letter_manager.search_letters_page(query, limit, cursor)))
+
+@app.route('/api/v1/stats')
+def api_stats():
+    etag, last_modified = archive_validators(letter_manager.get_versions(), 'api-stats')
+    return conditional(etag, last_modified, lambda: jsonify(letter_manager.get_stats()))
+
+@app.route('/extraction_cache')
+def extraction_cache_stats():
+    """Hit/miss counters for the extraction cache"""
+    return jsonify(extraction_cache.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics for this process"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/startup')
+def startup_timings():
+    """Cold-start timings for this process"""
+    return jsonify(startup.timings())
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Status of a background extraction job, polled by the penpal page"""
+    job = extraction_jobs.status(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,60 @@
+"""Maintenance commands for the letters store.
+
+    python manage.py rebuild-summary
+    python manage.py compression-stats
+    python manage.py recompress
+"""
+import argparse
+import json
+
+
+def rebuild_summary(letter_manager, args):
+    """Recompute the penpal summary counts used by the index page"""
+    rebuilt = letter_manager.rebuild_penpal_summary()
+    if rebuilt is False:
+        return 1
+    print(f"Rebuilt summary for {rebuilt} penpals")
+    return 0
+
+
+def compression_stats(letter_manager, args):
+    """Report how much space letter bodies take at rest, and the compression ratio"""
+    stats = letter_manager.compression_stats()
+    if stats is None:
+        return 1
+    print(json.dumps(stats))
+    return 0
+
+
+def recompress(letter_manager, args):
+    """Re-store every letter body under the current LETTER_COMPRESSION settings (stop the app first)"""
+    rewritten = letter_manager.recompress_letters()
+    if rewritten is None:
+        print(f"{letter_manager.engine.name} storage doesn't compress letter bodies itself")
+        return 1
+    if rewritten is False:
+        return 1
+    print(f"Rewrote {rewritten} letters")
+    return compression_stats(letter_manager, args)
+
+
+COMMANDS = {
+    'rebuild-summary': rebuild_summary,
+    'compression-stats': compression_stats,
+    'recompress': recompress,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance commands for the letters store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, command in COMMANDS.items():
+        subparsers.add_parser(name, help=command.__doc__)
+    args = parser.parse_args(argv)
+
+    from letters import LetterManager
+    return COMMANDS[args.command](LetterManager(), args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,267 @@
+"""In-process metrics in the Prometheus text format.
+
+Counters and histograms are kept per process and rendered by ``render()``
+for /metrics; there is no dependency on prometheus_client. The metrics
+the app records are defined at the bottom of this module.
+
+SLOW_QUERY_MS enables a log line for every SQL statement slower than that
+many milliseconds. PROFILE_SAMPLE_RATE (0 to 1) runs cProfile over that
+share of requests; see SamplingProfiler.
+"""
+import cProfile
+import inspect
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '0'))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{format_labels(self.labels, key)} {value}"]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [cumulative bucket counts, sum, count]
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = [
+            f"{self.name}_bucket{format_labels(self.labels, key, [('le', bound)])} {counts[i]}"
+            for i, bound in enumerate(self.buckets)
+        ]
+        lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+        lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+render = REGISTRY.render
+
+HTTP_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', "Request latency by route", ('method', 'route', 'status'))
+MANAGER_SECONDS = REGISTRY.histogram(
+    'letter_manager_call_duration_seconds', "LetterManager method latency", ('method',))
+MANAGER_ERRORS = REGISTRY.counter(
+    'letter_manager_errors_total', "LetterManager calls that raised", ('method',))
+SQL_SECONDS = REGISTRY.histogram(
+    'db_statement_duration_seconds', "SQL statement latency", ('engine', 'statement'))
+DB_CONNECTIONS = REGISTRY.counter(
+    'db_connections_opened_total', "Database connections opened", ('engine',))
+FILE_SECONDS = REGISTRY.histogram(
+    'file_store_duration_seconds', "Data file load and save latency", ('store', 'op'))
+FILE_BYTES = REGISTRY.counter(
+    'file_store_bytes_total', "Bytes read and written by the file stores", ('store', 'op'))
+LETTER_BODY_BYTES = REGISTRY.counter(
+    'letter_body_bytes_total', "Letter body bytes written, as text and as stored", ('codec', 'state'))
+RESPONSE_BYTES = REGISTRY.counter(
+    'http_response_bytes_total', "Compressible response bytes, before and after compression", ('encoding', 'state'))
+LLM_SECONDS = REGISTRY.histogram(
+    'llm_request_duration_seconds', "Gemini request latency", ('model',),
+    buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+LLM_TOKENS = REGISTRY.counter(
+    'llm_tokens_total', "Estimated prompt and response tokens", ('model', 'direction'))
+LLM_ERRORS = REGISTRY.counter(
+    'llm_errors_total', "Gemini requests that raised", ('model',))
+
+
+@lru_cache(maxsize=1024)
+def statement_label(sql):
+    """Drop a statement's comments, collapse its whitespace and cut it down to a label"""
+    sql = re.sub(r'\s+', ' ', re.sub(r'--[^\n]*', '', sql)).strip()
+    return sql if len(sql) <= 120 else sql[:117] + '...'
+
+
+@contextmanager
+def timed_statement(engine, sql):
+    """Time one SQL statement, logging it if SLOW_QUERY_MS is set and exceeded"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        SQL_SECONDS.observe(elapsed, engine=engine, statement=statement_label(sql))
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            print(f"Slow query ({elapsed * 1000:.1f}ms, {engine}): {statement_label(sql)}")
+
+
+def instrument_methods(cls):
+    """Class decorator timing every public method into MANAGER_SECONDS"""
+    for name, method in list(vars(cls).items()):
+        if name.startswith('_') or not callable(method):
+            continue
+        setattr(cls, name, timed_method(name, method))
+    return cls
+
+
+def timed_method(name, method):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            MANAGER_ERRORS.inc(method=name)
+            MANAGER_SECONDS.observe(time.perf_counter() - started, method=name)
+            raise
+        if inspect.isgenerator(result):
+            # Streaming methods do their work as they are consumed
+            return timed_generator(name, result, time.perf_counter() - started)
+        MANAGER_SECONDS.observe(time.perf_counter() - started, method=name)
+        return result
+    return wrapper
+
+
+def timed_generator(name, generator, elapsed=0.0):
+    """Yield from ``generator``, observing the time spent inside it once it is exhausted or closed.
+
+    Time the consumer spends between items (such as writing them to the
+    client) is not counted.
+    """
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            except Exception:
+                MANAGER_ERRORS.inc(method=name)
+                raise
+            finally:
+                elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        generator.close()
+        MANAGER_SECONDS.observe(elapsed, method=name)
+
+
+class SamplingProfiler:
+    """Profile a random sample of requests with cProfile.
+
+    Each sampled request's stats are dumped to ``directory`` as
+    ``<time>-<name>.prof`` for snakeviz or pstats. A rate of 0 disables it.
+    """
+
+    def __init__(self, rate, directory):
+        self.rate = rate
+        self.directory = directory
+
+    @classmethod
+    def from_env(cls):
+        return cls(float(os.getenv('PROFILE_SAMPLE_RATE', '0')), os.getenv('PROFILE_DIR', 'profiles'))
+
+    def start(self):
+        """A running profiler if this request is sampled, else None"""
+        if not self.rate or random.random() >= self.rate:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this process
+            return None
+        return profiler
+
+    def stop(self, profiler, name):
+        profiler.disable()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') or 'request'
+            path = os.path.join(self.directory, f"{time.time():.6f}-{safe_name}.prof")
+            profiler.dump_stats(path)
+            print(f"Profiled {name} to {path}")
+        except OSError as e:
+            print(f"Could not save profile: {e}")
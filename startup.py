@@ -0,0 +1,37 @@
+import time
+
+
+class StartupTimer:
+    """Wall-clock time spent in each cold-start phase.
+
+    ``mark`` closes the current phase. ``report`` closes the last one,
+    prints the timings once and returns them.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = {}
+        self.reported = False
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self._last) * 1000, 1)
+        self._last = now
+
+    def timings(self):
+        return {"phases_ms": dict(self.phases), "total_ms": round(sum(self.phases.values()), 1)}
+
+    def report(self, phase=None, elapsed=None):
+        """Record ``phase`` (taking ``elapsed`` seconds if given) and print the timings once"""
+        if self.reported:
+            return self.timings()
+        if elapsed is not None:
+            self.phases[phase] = round(elapsed * 1000, 1)
+        elif phase:
+            self.mark(phase)
+        self.reported = True
+        timings = self.timings()
+        phases = ', '.join(f"{name} {ms}ms" for name, ms in timings["phases_ms"].items())
+        print(f"Startup: {phases} (total {timings['total_ms']}ms)")
+        return timings
@@ -0,0 +1,57 @@
+import os
+import threading
+import time
+
+from storage import StatsUnavailable
+
+# Other instances' writes never invalidate this cache, so entries expire
+DEFAULT_TTL = 30.0
+
+
+class StatsCache:
+    """In-process cache of the dashboard stats.
+
+    ``load`` computes fresh stats. LetterManager calls ``invalidate`` after
+    every write that can change them, so a single process always sees
+    current numbers. Other processes' writes are only picked up when an
+    entry expires after ``ttl`` seconds; ``None`` keeps entries until
+    invalidated, which only suits a single process. Stats the engine could
+    not read (``StatsUnavailable``) are returned but not cached.
+    """
+
+    def __init__(self, load, ttl=None):
+        self.load = load
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = None
+        self._loaded_at = 0.0
+        self._generation = 0
+
+    @classmethod
+    def from_env(cls, load):
+        """Build a cache expiring after STATS_CACHE_TTL seconds (0 never expires)"""
+        ttl = float(os.getenv('STATS_CACHE_TTL', str(DEFAULT_TTL)))
+        return cls(load, ttl=ttl or None)
+
+    def get(self):
+        with self._lock:
+            fresh = self._stats is not None and (
+                self.ttl is None or time.monotonic() - self._loaded_at < self.ttl
+            )
+            if fresh:
+                return dict(self._stats)
+            generation = self._generation
+
+        stats = self.load()
+        with self._lock:
+            # Don't cache a failed read or a result computed across a
+            # concurrent write
+            if generation == self._generation and not isinstance(stats, StatsUnavailable):
+                self._stats = stats
+                self._loaded_at = time.monotonic()
+        return dict(stats)
+
+    def invalidate(self):
+        with self._lock:
+            self._stats = None
+            self._generation += 1
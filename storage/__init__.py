@@ -0,0 +1,45 @@
+import os
+
+from .base import LETTERS_PAGE_SIZE, SEARCH_PAGE_SIZE, StatsUnavailable, StorageEngine, empty_stats
+
+DATA_FILE = 'letters_data.json'
+INDEX_DIR = 'letters_index'
+JOURNAL_DIR = 'letters_journal'
+SHARD_DIR = 'letters_shards'
+# Journal and sharded stores keep their search index inside their own directory
+STORE_INDEX_DIR = 'index'
+SQLITE_FILE = 'letters.db'
+
+
+def create_engine():
+    """Pick the storage engine from the environment.
+
+    POSTGRES_URL selects Postgres. Otherwise LETTERS_STORAGE chooses between
+    'sqlite', 'journal', 'sharded' and the default 'json' document file.
+    """
+    db_url = os.getenv('POSTGRES_URL')
+    if db_url:
+        from .postgres import PostgresEngine
+        return PostgresEngine(db_url)
+
+    storage = os.getenv('LETTERS_STORAGE', 'json')
+    if storage == 'sqlite':
+        from .sqlite import SQLiteEngine
+        return SQLiteEngine(os.getenv('SQLITE_PATH', SQLITE_FILE))
+
+    from .files import FileEngine
+    if storage == 'journal':
+        from .journal import JournalStore
+        # Append-only journal, seeded from letters_data.json on first use
+        return FileEngine(JournalStore.from_env(JOURNAL_DIR, seed_path=DATA_FILE),
+                          os.path.join(JOURNAL_DIR, STORE_INDEX_DIR))
+    if storage == 'sharded':
+        from .sharded import ShardedStore
+        # One file per penpal, seeded from letters_data.json on first use, and
+        # one index segment per penpal beside the shards
+        return FileEngine(ShardedStore(SHARD_DIR, seed_path=DATA_FILE), os.path.join(SHARD_DIR, STORE_INDEX_DIR))
+    from .filestore import JsonDocumentStore
+    return FileEngine(JsonDocumentStore(DATA_FILE), INDEX_DIR)
+
+
+__all__ = ['LETTERS_PAGE_SIZE', 'SEARCH_PAGE_SIZE', 'StatsUnavailable', 'StorageEngine', 'create_engine', 'empty_stats']
@@ -0,0 +1,280 @@
+import hashlib
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+from .codec import compression_summary
+
+SEARCH_PAGE_SIZE = 20
+LETTERS_PAGE_SIZE = 10
+
+
+def empty_stats():
+    return {"total_penpals": 0, "total_letters": 0, "countries": 0, "country_list": []}
+
+
+class StatsUnavailable(dict):
+    """The empty stats an engine returns when it could not read them; never cached"""
+
+
+def unavailable_stats():
+    return StatsUnavailable(empty_stats())
+
+
+def letters_cursor(letter):
+    """Keyset cursor pointing just past ``letter`` in newest-first order"""
+    return f"{letter['date_received']}|{letter['id']}"
+
+
+def schema_cache_path(key):
+    directory = os.getenv('LETTERS_SCHEMA_CACHE_DIR', tempfile.gettempdir())
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(directory, f'slowly_letters_schema_{digest}')
+
+
+def cached_schema_version(key):
+    """Schema version this host last verified for ``key`` (a database URL), or None"""
+    try:
+        with open(schema_cache_path(key), 'r', encoding='utf-8') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def cache_schema_version(key, version):
+    try:
+        with open(schema_cache_path(key), 'w', encoding='utf-8') as f:
+            f.write(str(version))
+    except OSError as e:
+        print(f"Could not cache schema version: {e}")
+
+
+def parse_utc(value):
+    """datetime from an ISO timestamp stored as UTC (naive or not); None passes through"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value) if isinstance(value, str) else value
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def search_cursor(rank, letter_id):
+    """Keyset cursor pointing just past a search result"""
+    return f"{rank!r}:{letter_id}"
+
+
+def parse_search_cursor(cursor):
+    """Split a search cursor into (rank, id); None if malformed"""
+    try:
+        rank_part, id_part = cursor.split(':', 1)
+        return float(rank_part), int(id_part)
+    except ValueError:
+        return None
+
+
+def parse_letters_cursor(cursor):
+    """Split a letters cursor into (date_received, id); None if malformed"""
+    date_received, _, letter_id = (cursor or '').rpartition('|')
+    if not date_received or not letter_id.isdigit():
+        return None
+    return date_received, int(letter_id)
+
+
+class StorageEngine:
+    """Interface implemented by every LetterManager storage backend.
+
+    Methods mirror LetterManager's public API and follow its conventions:
+    writes return True or False, and reads return None or an empty result
+    on failure instead of raising.
+    """
+
+    name = None
+    # Records per import_batch call; None imports a whole file in one batch
+    import_batch_size = 5000
+
+    _schema_lock = threading.RLock()
+    _schema_ready = False
+    _schema_running = False
+
+    def init_schema(self):
+        """Create whatever tables or files the engine needs; False on failure"""
+
+    def ensure_schema(self):
+        """Run init_schema once, on first use rather than at startup.
+
+        Engines call this before handing out a connection. A failed
+        bootstrap is retried on the next call; the re-entrant call made by
+        init_schema's own connection returns immediately.
+        """
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if self._schema_ready or self._schema_running:
+                return
+            self._schema_running = True
+            try:
+                self._schema_ready = self.init_schema() is not False
+            finally:
+                self._schema_running = False
+
+    def add_penpal(self, name, country):
+        raise NotImplementedError
+
+    def add_letter(self, penpal_name, content, date_received=None):
+        raise NotImplementedError
+
+    def get_letter(self, penpal_name, letter_id):
+        """One letter by id, or None"""
+        raise NotImplementedError
+
+    def delete_letter(self, penpal_name, letter_id):
+        raise NotImplementedError
+
+    def update_letter(self, penpal_name, letter_id, content=None, date_received=None):
+        """Change a letter's content and/or received date; None leaves a field as is"""
+        raise NotImplementedError
+
+    def add_note(self, penpal_name, note):
+        raise NotImplementedError
+
+    def add_notes(self, penpal_name, notes):
+        """Add several notes at once; engines override this to batch the writes"""
+        return all([self.add_note(penpal_name, note) for note in notes])
+
+    def delete_note(self, penpal_name, note_id):
+        raise NotImplementedError
+
+    def update_note(self, penpal_name, note_id, note):
+        raise NotImplementedError
+
+    def import_batch(self, penpals, letters, notes):
+        """Write a batch of imported records in one transaction.
+
+        ``penpals`` are {"name", "country", "created_date"} dicts; ``letters``
+        ({"penpal", "content", "date_received", "date_added"}) and ``notes``
+        ({"penpal", "note", "date_added"}) name their penpal, which must exist
+        or be in ``penpals``. Penpals whose name is taken are left alone.
+        Returns {"penpals": n, "letters": n, "notes": n} written, or None on
+        failure (nothing is written).
+        """
+        raise NotImplementedError
+
+    def get_penpal(self, name):
+        raise NotImplementedError
+
+    def get_penpal_header(self, name):
+        """Penpal details, notes and letter count without any letter bodies"""
+        penpal = self.get_penpal(name)
+        if penpal is None:
+            return None
+        header = {key: value for key, value in penpal.items() if key != "letters"}
+        header["letter_count"] = len(penpal["letters"])
+        return header
+
+    def get_penpal_page(self, name, limit=LETTERS_PAGE_SIZE):
+        """get_penpal_header plus the first page of letters, or None.
+
+        The header gains "letters" and "next_cursor" as get_letters_page
+        returns them. Engines override this to read both at once.
+        """
+        penpal = self.get_penpal_header(name)
+        if penpal is None:
+            return None
+        page = self.get_letters_page(name, limit)
+        return dict(penpal, letters=page["letters"], next_cursor=page["next_cursor"])
+
+    def get_letters_page(self, penpal_name, limit=LETTERS_PAGE_SIZE, cursor=None):
+        """One page of a penpal's letters, newest first.
+
+        Returns {"letters": [...], "next_cursor": str or None}; letters are
+        ordered by (date_received, id) descending.
+        """
+        raise NotImplementedError
+
+    def get_notes(self, penpal_name):
+        """Notes for a penpal without loading letters; engines override this with a narrower read"""
+        penpal = self.get_penpal(penpal_name)
+        return penpal["notes"] if penpal else None
+
+    def get_all_penpals(self):
+        raise NotImplementedError
+
+    def iter_records(self, penpal_name=None):
+        """Yield export records: every penpal, then their letters, then their notes.
+
+        Records have the shape ``importer`` reads back: a "type" of "penpal",
+        "letter" or "note", with letters and notes naming their "penpal".
+        ``penpal_name`` limits the export to one penpal. Unlike the other
+        reads, errors propagate, so a broken export can't pass for a
+        complete one. This default loads every penpal up front; engines
+        override it to stream.
+        """
+        if penpal_name is None:
+            names = [penpal["name"] for penpal in self.get_all_penpals()]
+        else:
+            names = [penpal_name]
+        penpals = [penpal for penpal in map(self.get_penpal, names) if penpal]
+        for penpal in penpals:
+            yield {"type": "penpal", "name": penpal["name"], "country": penpal["country"],
+                   "created_date": penpal["created_date"]}
+        for kind in ("letters", "notes"):
+            for penpal in penpals:
+                for item in penpal[kind]:
+                    yield dict(item, type=kind[:-1], penpal=penpal["name"])
+
+    def get_versions(self, penpal_name=None):
+        """Version of every penpal (or just ``penpal_name``), without reading letters.
+
+        Returns {name: {"version": int, "updated_at": datetime or None}}.
+        Every write to a penpal's letters or notes increases its version;
+        updated_at is timezone-aware UTC.
+        """
+        raise NotImplementedError
+
+    def rebuild_penpal_summary(self):
+        """Recompute the per-penpal counts behind get_all_penpals; returns the penpal count"""
+        raise NotImplementedError
+
+    def compression_stats(self):
+        """Letter body sizes at rest, or None on failure.
+
+        Returns {"letters", "compressed", "raw_bytes", "stored_bytes",
+        "ratio"}, with ratio as text bytes per stored byte. This default
+        walks every letter and counts bodies as stored uncompressed;
+        engines that compress override it.
+        """
+        letters = raw_bytes = 0
+        try:
+            for record in self.iter_records():
+                if record["type"] == "letter":
+                    letters += 1
+                    raw_bytes += len(record["content"].encode('utf-8'))
+        except Exception as e:
+            print(f"Error measuring letter sizes: {e}")
+            return None
+        return compression_summary(letters, 0, raw_bytes, raw_bytes)
+
+    def recompress_letters(self):
+        """Re-store every letter body under the current LETTER_COMPRESSION settings.
+
+        Returns the number of letters rewritten, False on failure, or None if
+        the engine doesn't compress bodies itself.
+        """
+        return None
+
+    def search_letters_page(self, query, limit=SEARCH_PAGE_SIZE, cursor=None):
+        """One page of ranked search results, the same shape from every engine.
+
+        Returns {"results": [...], "next_cursor": str or None, "total": int
+        or None}. Each result is {"penpal_name", "country", "letter": {"id",
+        "date_received", "date_added"}, "rank", "preview"}, where preview is
+        HTML whose only markup is <mark>. Results are ordered by rank, then
+        id, both descending; higher ranks are better. ``next_cursor`` is a
+        ``search_cursor`` keyset. ``total`` counts every match of the query,
+        not just this page; it is None when the engine can't tell, as when
+        a SQL engine's cursor runs past the last match.
+        """
+        raise NotImplementedError
+
+    def get_stats(self):
+        raise NotImplementedError
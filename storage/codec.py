@@ -0,0 +1,101 @@
+"""Optional compression of letter bodies at rest, for the file backends.
+
+LETTER_COMPRESSION picks the codec: 'zlib', or 'zstd' when the zstandard
+package is installed. Unset (or 'none') stores bodies as plain text.
+Bodies shorter than LETTER_COMPRESSION_MIN_BYTES (default 1024) are always
+stored as text, as is any body that compression would not shrink.
+
+A compressed body is stored as ``{"codec": "zlib", "data": "<base64>"}``
+in place of the content string. ``decode_body`` accepts either form, so an
+archive can mix both and compression can be turned off again at any time.
+"""
+import base64
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from metrics import LETTER_BODY_BYTES
+
+CODEC = os.getenv('LETTER_COMPRESSION', '').lower()
+MIN_BYTES = int(os.getenv('LETTER_COMPRESSION_MIN_BYTES', '1024'))
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+
+if CODEC in ('', 'none'):
+    CODEC = None
+elif CODEC == 'zstd' and zstandard is None:
+    print("LETTER_COMPRESSION=zstd needs the zstandard package; using zlib")
+    CODEC = 'zlib'
+elif CODEC not in ('zlib', 'zstd'):
+    print(f"Unknown LETTER_COMPRESSION {CODEC!r}; letters are stored uncompressed")
+    CODEC = None
+
+
+def compress(data, codec):
+    if codec == 'zlib':
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError(f"Unknown codec {codec!r}")
+
+
+def decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("A letter is zstd-compressed; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown codec {codec!r}")
+
+
+def encode_body(text, codec=CODEC, min_bytes=MIN_BYTES):
+    """Stored form of a letter body: ``text`` itself, or a compressed dict if that is smaller"""
+    raw = text.encode('utf-8')
+    if codec is None or len(raw) < min_bytes:
+        LETTER_BODY_BYTES.inc(len(raw), codec='none', state='raw')
+        LETTER_BODY_BYTES.inc(len(raw), codec='none', state='stored')
+        return text
+    data = base64.b64encode(compress(raw, codec)).decode('ascii')
+    if len(data) >= len(raw):
+        LETTER_BODY_BYTES.inc(len(raw), codec='none', state='raw')
+        LETTER_BODY_BYTES.inc(len(raw), codec='none', state='stored')
+        return text
+    LETTER_BODY_BYTES.inc(len(raw), codec=codec, state='raw')
+    LETTER_BODY_BYTES.inc(len(data), codec=codec, state='stored')
+    return {"codec": codec, "data": data}
+
+
+def decode_body(value):
+    """The text of a stored letter body, in either form"""
+    if isinstance(value, str):
+        return value
+    return decompress(base64.b64decode(value["data"]), value["codec"]).decode('utf-8')
+
+
+def plain_letter(letter):
+    """Copy of a stored letter with its body as text"""
+    return dict(letter, content=decode_body(letter["content"]))
+
+
+def body_sizes(value):
+    """(text bytes, stored bytes) of a stored letter body"""
+    if isinstance(value, str):
+        size = len(value.encode('utf-8'))
+        return size, size
+    return len(decode_body(value).encode('utf-8')), len(value["data"])
+
+
+def compression_summary(letters, compressed, raw_bytes, stored_bytes):
+    """The dict ``compression_stats`` returns"""
+    return {
+        "letters": letters,
+        "compressed": compressed,
+        "raw_bytes": raw_bytes,
+        "stored_bytes": stored_bytes,
+        "ratio": round(raw_bytes / stored_bytes, 3) if stored_bytes else None
+    }
@@ -0,0 +1,383 @@
+from datetime import datetime, timezone
+
+from .base import (LETTERS_PAGE_SIZE, SEARCH_PAGE_SIZE, StorageEngine, letters_cursor, parse_letters_cursor,
+                   parse_search_cursor, parse_utc, search_cursor, unavailable_stats)
+from .codec import body_sizes, compression_summary, decode_body, encode_body, plain_letter
+from .filestore import find_by_id, letters_touched
+from .search_index import InvertedIndex, SearchIndex, search_segments, snippet
+
+
+def letter_order(letter):
+    return (letter.get("date_received") or '', letter["id"])
+
+
+def changed_letters(op, result, penpal_name):
+    """(removed letter ids, [(letter id, stored content)] added or rewritten) for ``penpal_name``"""
+    kind = op["op"]
+    if kind == "add_letter":
+        return [], [(result["id"], result["content"])]
+    if kind == "delete_letter":
+        return [result["id"]], []
+    if kind == "update_letter" and "content" in op["fields"]:
+        return [], [(result["id"], result["content"])]
+    if kind == "import":
+        return [], [(record["id"], record["content"]) for record in op["letters"]
+                    if record["penpal"] == penpal_name and "id" in record]
+    return [], []
+
+
+class FileEngine(StorageEngine):
+    """File storage: a document store plus a per-penpal search index.
+
+    ``store`` is a ``filestore.JsonDocumentStore``, a
+    ``journal.JournalStore`` or a ``sharded.ShardedStore``; all apply
+    mutation ops to a cached document. Letter bodies may be stored
+    compressed (see ``codec``); they are decoded only in the letters a read
+    returns.
+
+    The search index in ``index_dir`` has one segment per penpal (see
+    ``search_index.SearchIndex``). A write updates the segments of the
+    penpals whose letters it changed while the store still holds its write
+    lock; a search rebuilds any segment whose version is behind the
+    penpal's ``letters_version``, such as after a crash between the two.
+    """
+
+    # Every save rewrites the whole document, so imports go in one batch
+    import_batch_size = None
+
+    def __init__(self, store, index_dir):
+        self.store = store
+        self.search_index = SearchIndex(index_dir)
+        self.name = type(store).__name__
+    
+    def load_data(self):
+        """Load data from file (cached until the file changes on disk)"""
+        try:
+            return self.store.load()
+        except Exception as e:
+            print(f"Error loading from file: {e}")
+        return {"penpals": {}}
+    
+    def save_data(self, data):
+        """Save data to file"""
+        try:
+            self.store.replace(data)
+            return True
+        except Exception as e:
+            print(f"Error saving to file: {e}")
+            return False
+    
+    def apply(self, op):
+        """Apply one mutation to the cached document and persist it"""
+        # Stamped here rather than in apply_op so journal replay reproduces it
+        op["at"] = datetime.now(timezone.utc).isoformat()
+        try:
+            return self.store.apply(op, lambda data, result: self.index_op(op, data, result))
+        except Exception as e:
+            print(f"Error saving to file: {e}")
+            return None
+    
+    def index_op(self, op, data, result):
+        """Record an applied op in the index segments of the penpals whose letters it changed"""
+        try:
+            for name in letters_touched(op, result):
+                penpal = data["penpals"][name]
+                removed, added = changed_letters(op, result, name)
+                self.search_index.update(
+                    name, penpal.get("letters_version", 0), removed,
+                    [(letter_id, decode_body(content)) for letter_id, content in added],
+                    lambda: InvertedIndex.build(penpal["letters"], penpal.get("letters_version", 0)))
+        except Exception as e:
+            # The segment is rebuilt when a search finds it behind
+            print(f"Error saving search index: {e}")
+    
+    def fresh_segments(self):
+        """Every penpal's index segment, rebuilding any that are missing or out of date"""
+        cache = self.store.cache()
+        segments = {}
+        for name, summary in list(cache.summaries.items()):
+            segment = self.search_index.get(name)
+            if segment is None or segment.version != summary.get("letters_version", 0):
+                penpal = cache.data["penpals"][name]
+                # Version read before the letters, so a concurrent write
+                # leaves the segment looking older than it is, never newer
+                version = penpal.get("letters_version", 0)
+                segment = InvertedIndex.build(list(penpal["letters"]), version)
+                try:
+                    self.search_index.save(name, segment)
+                except Exception as e:
+                    print(f"Error saving search index: {e}")
+            segments[name] = segment
+        return segments
+    
+    # Engine API
+    def add_penpal(self, name, country):
+        return bool(self.apply({
+            "op": "add_penpal",
+            "name": name,
+            "country": country,
+            "created_date": datetime.now().isoformat()
+        }))
+    
+    def add_letter(self, penpal_name, content, date_received=None):
+        data = self.load_data()
+        if penpal_name in data["penpals"]:
+            if date_received is None:
+                date_received = datetime.now().isoformat()
+            
+            letter = {
+                "content": encode_body(content),
+                "date_received": date_received,
+                "date_added": datetime.now().isoformat()
+            }
+            return bool(self.apply({"op": "add_letter", "penpal": penpal_name, "letter": letter}))
+        return False
+    
+    def get_letter(self, penpal_name, letter_id):
+        penpal_data = self.load_data()["penpals"].get(penpal_name)
+        if penpal_data is None:
+            return None
+        i = find_by_id(penpal_data["letters"], letter_id)
+        return plain_letter(penpal_data["letters"][i]) if i is not None else None
+    
+    def delete_letter(self, penpal_name, letter_id):
+        data = self.load_data()
+        if penpal_name in data["penpals"]:
+            return bool(self.apply({"op": "delete_letter", "penpal": penpal_name, "id": letter_id}))
+        return False
+    
+    def update_letter(self, penpal_name, letter_id, content=None, date_received=None):
+        fields = {}
+        if content is not None:
+            fields["content"] = encode_body(content)
+        if date_received is not None:
+            fields["date_received"] = date_received
+        return bool(self.apply({"op": "update_letter", "penpal": penpal_name, "id": letter_id, "fields": fields}))
+    
+    def add_note(self, penpal_name, note):
+        note_data = {
+            "note": note,
+            "date_added": datetime.now().isoformat()
+        }
+        return bool(self.apply({"op": "add_note", "penpal": penpal_name, "note": note_data}))
+    
+    def add_notes(self, penpal_name, notes):
+        now = datetime.now().isoformat()
+        return bool(self.apply({
+            "op": "add_notes",
+            "penpal": penpal_name,
+            "notes": [{"note": note, "date_added": now} for note in notes]
+        }))
+    
+    def delete_note(self, penpal_name, note_id):
+        return bool(self.apply({"op": "delete_note", "penpal": penpal_name, "id": note_id}))
+    
+    def update_note(self, penpal_name, note_id, note):
+        return bool(self.apply({"op": "update_note", "penpal": penpal_name, "id": note_id, "note": note}))
+    
+    def import_batch(self, penpals, letters, notes):
+        stored = [dict(letter, content=encode_body(letter["content"])) for letter in letters]
+        op = {"op": "import", "penpals": penpals, "letters": stored, "notes": notes}
+        result = self.apply(op)
+        if not result:
+            return None
+        return {kind: result[kind] for kind in ("penpals", "letters", "notes")}
+    
+    def get_penpal(self, name):
+        data = self.load_data()
+        penpal_data = data["penpals"].get(name)
+        if penpal_data is None:
+            return None
+        # Copies so callers can't reach into the cached document
+        return dict(penpal_data, name=name, letters=[plain_letter(letter) for letter in penpal_data["letters"]])
+    
+    def get_penpal_header(self, name):
+        try:
+            cache = self.store.cache()
+        except Exception as e:
+            print(f"Error loading from file: {e}")
+            return None
+        penpal_data = cache.data["penpals"].get(name)
+        if penpal_data is None:
+            return None
+        return {
+            "name": name,
+            "country": penpal_data["country"],
+            "notes": list(penpal_data["notes"]),
+            "created_date": penpal_data.get("created_date"),
+            "letter_count": cache.summaries[name]["letter_count"]
+        }
+    
+    def get_letters_page(self, penpal_name, limit=LETTERS_PAGE_SIZE, cursor=None):
+        empty = {"letters": [], "next_cursor": None}
+        penpal_data = self.load_data()["penpals"].get(penpal_name)
+        if penpal_data is None:
+            return empty
+        
+        letters = sorted(penpal_data["letters"], key=letter_order, reverse=True)
+        if cursor:
+            after = parse_letters_cursor(cursor)
+            if after is None:
+                return empty
+            letters = [letter for letter in letters if letter_order(letter) < after]
+        
+        next_cursor = None
+        if limit and len(letters) > limit:
+            letters = letters[:limit]
+            next_cursor = letters_cursor(letters[-1])
+        return {"letters": [plain_letter(letter) for letter in letters], "next_cursor": next_cursor}
+    
+    def get_notes(self, penpal_name):
+        penpal_data = self.load_data()["penpals"].get(penpal_name)
+        if penpal_data is None:
+            return None
+        return list(penpal_data.get("notes", []))
+    
+    def get_versions(self, penpal_name=None):
+        try:
+            summaries = self.store.cache().summaries
+        except Exception as e:
+            print(f"Error loading from file: {e}")
+            return {}
+        names = [penpal_name] if penpal_name is not None else list(summaries)
+        return {
+            name: {"version": summaries[name]["version"],
+                   "updated_at": parse_utc(summaries[name]["updated_at"])}
+            for name in names if name in summaries
+        }
+    
+    def rebuild_penpal_summary(self):
+        try:
+            self.store.rebuild_summaries()
+            return len(self.store.cache().summaries)
+        except Exception as e:
+            print(f"Error loading from file: {e}")
+            return False
+    
+    def compression_stats(self):
+        letters = compressed = raw_bytes = stored_bytes = 0
+        try:
+            for penpal_data in self.store.load()["penpals"].values():
+                for letter in penpal_data["letters"]:
+                    raw, stored = body_sizes(letter["content"])
+                    letters += 1
+                    compressed += not isinstance(letter["content"], str)
+                    raw_bytes += raw
+                    stored_bytes += stored
+        except Exception as e:
+            print(f"Error measuring letter sizes: {e}")
+            return None
+        return compression_summary(letters, compressed, raw_bytes, stored_bytes)
+    
+    def recompress_letters(self):
+        """Rewrite the document with every body encoded under the current settings.
+
+        The document is saved whole, so writes made while this runs can be lost.
+        """
+        try:
+            # Not load_data, whose empty fallback would be saved over the archive
+            data = self.store.load()
+            penpals = {
+                name: dict(penpal_data, letters=[
+                    dict(letter, content=encode_body(decode_body(letter["content"])))
+                    for letter in penpal_data["letters"]
+                ])
+                for name, penpal_data in data["penpals"].items()
+            }
+            self.store.replace({"penpals": penpals, "next_id": data["next_id"]})
+        except Exception as e:
+            print(f"Error recompressing letters: {e}")
+            return False
+        return sum(len(penpal_data["letters"]) for penpal_data in penpals.values())
+    
+    def get_all_penpals(self):
+        try:
+            cache = self.store.cache()
+        except Exception as e:
+            print(f"Error loading from file: {e}")
+            return []
+        penpals = []
+        for name, summary in cache.summaries.items():
+            penpals.append({
+                "name": name,
+                "country": summary["country"],
+                "letter_count": summary["letter_count"],
+                "note_count": summary["note_count"],
+                "last_letter": summary["last_letter"]
+            })
+        
+        penpals.sort(key=lambda x: x["last_letter"] or "0000-00-00", reverse=True)
+        return penpals
+    
+    def iter_records(self, penpal_name=None):
+        """Walk the cached document; lists are copied per penpal so concurrent writes can't shift them"""
+        penpals = self.load_data()["penpals"]
+        if penpal_name is None:
+            names = sorted(penpals)
+        else:
+            names = [penpal_name] if penpal_name in penpals else []
+        for name in names:
+            penpal = penpals[name]
+            yield {"type": "penpal", "name": name, "country": penpal["country"],
+                   "created_date": penpal.get("created_date")}
+        for kind in ("letters", "notes"):
+            for name in names:
+                for item in list(penpals[name][kind]):
+                    if kind == "letters":
+                        item = plain_letter(item)
+                    yield dict(item, type=kind[:-1], penpal=name)
+    
+    def search_letters_page(self, query, limit=SEARCH_PAGE_SIZE, cursor=None):
+        data = self.load_data()
+        matches = search_segments(query, self.fresh_segments())
+        total = len(matches)
+        
+        # Keyset cursor on (score, id), like the SQL engines' (rank, id)
+        if cursor:
+            after = parse_search_cursor(cursor)
+            if after is None:
+                return {"results": [], "next_cursor": None, "total": None}
+            matches = [match for match in matches if match[:2] < after]
+        
+        next_cursor = None
+        if limit and len(matches) > limit:
+            matches = matches[:limit]
+            next_cursor = search_cursor(matches[-1][0], matches[-1][1])
+        
+        results = []
+        for score, letter_id, penpal_name in matches:
+            penpal_data = data["penpals"].get(penpal_name)
+            i = find_by_id(penpal_data["letters"], letter_id) if penpal_data else None
+            if i is None:
+                # The segment disagrees with the letters; rebuild it next time
+                self.search_index.discard(penpal_name)
+                continue
+            letter = penpal_data["letters"][i]
+            results.append({
+                "penpal_name": penpal_name,
+                "country": penpal_data["country"],
+                "letter": {
+                    "id": letter_id,
+                    "date_received": letter.get("date_received"),
+                    "date_added": letter.get("date_added")
+                },
+                "rank": score,
+                "preview": snippet(decode_body(letter["content"]), query, 200)
+            })
+        
+        return {"results": results, "next_cursor": next_cursor, "total": total}
+    
+    def get_stats(self):
+        try:
+            cache = self.store.cache()
+        except Exception as e:
+            print(f"Error loading from file: {e}")
+            return unavailable_stats()
+        countries = sorted(country for country, count in cache.countries.items() if count > 0)
+        
+        return {
+            "total_penpals": len(cache.summaries),
+            "total_letters": cache.total_letters,
+            "countries": len(countries),
+            "country_list": countries
+        }
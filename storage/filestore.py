@@ -0,0 +1,381 @@
+import json
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+from metrics import FILE_BYTES, FILE_SECONDS
+
+
+def empty_document():
+    return {"penpals": {}, "next_id": 1}
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive advisory lock on ``path`` to serialise writers across processes"""
+    with open(path, 'a') as lock_fh:
+        if fcntl:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+def write_atomic(path, text):
+    """Write ``text`` to a temp file and rename it over ``path``; returns the bytes written.
+
+    Readers see either the old file or the new one, never a partial write.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+
+def apply_op(data, op):
+    """Apply one mutation record to ``data`` in place.
+
+    Returns the added, updated or removed item, or None if the op did not
+    apply (unknown penpal, duplicate name, unknown id). Each penpal the op
+    changes gets its version bumped and, if the op carries an "at"
+    timestamp, its updated_at set; penpals whose letters it changed also
+    get their letters_version bumped, which the search index keys on.
+    """
+    result = apply_change(data, op)
+    if result is not None:
+        letters_changed = letters_touched(op, result)
+        for name in touched_penpals(op, result):
+            penpal = data["penpals"][name]
+            penpal["version"] = penpal.get("version", 0) + 1
+            if name in letters_changed:
+                penpal["letters_version"] = penpal.get("letters_version", 0) + 1
+            if op.get("at"):
+                penpal["updated_at"] = op["at"]
+    return result
+
+
+def touched_penpals(op, result):
+    """Names of the penpals an applied op changed"""
+    return result["touched"] if op["op"] == "import" else [op.get("penpal", op.get("name"))]
+
+
+def letters_touched(op, result):
+    """Names of the penpals whose letters an applied op changed"""
+    if op["op"] == "import":
+        # Only letters that were written have an id recorded
+        return {record["penpal"] for record in op["letters"] if "id" in record}
+    if op["op"] in ("add_letter", "delete_letter", "update_letter"):
+        return {op["penpal"]}
+    return set()
+
+
+def apply_change(data, op):
+    kind = op["op"]
+    penpals = data["penpals"]
+
+    if kind == "add_penpal":
+        if op["name"] in penpals:
+            return None
+        penpals[op["name"]] = {
+            "country": op["country"],
+            "letters": [],
+            "notes": [],
+            "created_date": op["created_date"]
+        }
+        return penpals[op["name"]]
+    if kind == "import":
+        return import_records(data, op)
+
+    penpal = penpals.get(op["penpal"])
+    if penpal is None:
+        return None
+
+    if kind == "add_letter":
+        penpal["letters"].append(with_id(data, op["letter"]))
+        return op["letter"]
+    if kind == "delete_letter":
+        i = find_by_id(penpal["letters"], op["id"])
+        return penpal["letters"].pop(i) if i is not None else None
+    if kind == "update_letter":
+        i = find_by_id(penpal["letters"], op["id"])
+        if i is None:
+            return None
+        penpal["letters"][i] = dict(penpal["letters"][i], **op["fields"])
+        return penpal["letters"][i]
+    if kind == "add_note":
+        penpal["notes"].append(with_id(data, op["note"]))
+        return op["note"]
+    if kind == "add_notes":
+        penpal["notes"].extend(with_id(data, note) for note in op["notes"])
+        return op["notes"]
+    if kind == "delete_note":
+        if "index" in op:
+            # Positional form written by older versions, kept for journal replay
+            if 0 <= op["index"] < len(penpal["notes"]):
+                return penpal["notes"].pop(op["index"])
+            return None
+        i = find_by_id(penpal["notes"], op["id"])
+        return penpal["notes"].pop(i) if i is not None else None
+    if kind == "update_note":
+        i = find_by_id(penpal["notes"], op["id"])
+        if i is None:
+            return None
+        penpal["notes"][i] = dict(penpal["notes"][i], note=op["note"])
+        return penpal["notes"][i]
+    raise ValueError(f"Unknown op {kind!r}")
+
+
+def import_records(data, op):
+    """Apply a bulk "import" op: penpals first, then letters and notes.
+
+    Taken penpal names, and letters or notes for unknown penpals, are
+    skipped. Returns the counts written and the names touched.
+    """
+    penpals = data["penpals"]
+    result = {"penpals": 0, "letters": 0, "notes": 0, "touched": set()}
+    for penpal in op["penpals"]:
+        if penpal["name"] in penpals:
+            continue
+        penpals[penpal["name"]] = {
+            "country": penpal["country"],
+            "letters": [],
+            "notes": [],
+            "created_date": penpal["created_date"]
+        }
+        result["penpals"] += 1
+        result["touched"].add(penpal["name"])
+    for kind in ("letters", "notes"):
+        for record in op[kind]:
+            penpal = penpals.get(record["penpal"])
+            if penpal is None:
+                continue
+            item = {key: value for key, value in record.items() if key != "penpal"}
+            penpal[kind].append(with_id(data, item))
+            # Record the id so journal replay assigns the same one
+            record["id"] = item["id"]
+            result[kind] += 1
+            result["touched"].add(record["penpal"])
+    return result
+
+
+def with_id(data, item):
+    """Give a new letter or note the next id unless it already has one.
+
+    Ids are assigned while applying the op so they are recorded in the op
+    itself; letters and notes share one counter.
+    """
+    if item.get("id") is None:
+        item["id"] = data.get("next_id", 1)
+    data["next_id"] = max(data.get("next_id", 1), item["id"] + 1)
+    return item
+
+
+def find_by_id(items, item_id):
+    for i, item in enumerate(items):
+        if item.get("id") == item_id:
+            return i
+    return None
+
+
+def summarize_penpal(penpal_data):
+    last_letter = None
+    for letter in penpal_data["letters"]:
+        received = letter.get("date_received")
+        if received and (last_letter is None or received > last_letter):
+            last_letter = received
+    return {
+        "country": penpal_data["country"],
+        "letter_count": len(penpal_data["letters"]),
+        "note_count": len(penpal_data["notes"]),
+        "last_letter": last_letter,
+        "version": penpal_data.get("version", 0),
+        "letters_version": penpal_data.get("letters_version", 0),
+        "updated_at": penpal_data.get("updated_at")
+    }
+
+
+class DocumentCache:
+    """Parsed document plus summaries derived from it.
+
+    Summaries (per-penpal country, counts, last letter date and version,
+    total letters and the country multiset) are updated per op so index,
+    stats and version reads never walk the letters themselves.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.summaries = {name: summarize_penpal(p) for name, p in data["penpals"].items()}
+        self.total_letters = sum(s["letter_count"] for s in self.summaries.values())
+        self.countries = Counter(p["country"] for p in data["penpals"].values())
+
+    def apply(self, op):
+        result = apply_op(self.data, op)
+        if result is None:
+            return None
+        self._summarize(op, result)
+        for name in touched_penpals(op, result):
+            penpal = self.data["penpals"][name]
+            self.summaries[name]["version"] = penpal["version"]
+            self.summaries[name]["letters_version"] = penpal.get("letters_version", 0)
+            self.summaries[name]["updated_at"] = penpal.get("updated_at")
+        return result
+
+    def _summarize(self, op, result):
+        kind = op["op"]
+        if kind == "add_penpal":
+            self.summaries[op["name"]] = summarize_penpal(result)
+            self.countries[op["country"]] += 1
+            return
+        if kind == "import":
+            for name in result["touched"]:
+                if name not in self.summaries:
+                    self.countries[self.data["penpals"][name]["country"]] += 1
+                self.summaries[name] = summarize_penpal(self.data["penpals"][name])
+            self.total_letters += result["letters"]
+            return
+
+        summary = self.summaries[op["penpal"]]
+        if kind == "add_letter":
+            summary["letter_count"] += 1
+            self.total_letters += 1
+            received = result.get("date_received")
+            if received and (summary["last_letter"] is None or received > summary["last_letter"]):
+                summary["last_letter"] = received
+        elif kind in ("delete_letter", "update_letter"):
+            # Only this penpal's letters are walked to find the new latest one
+            self.summaries[op["penpal"]] = summarize_penpal(self.data["penpals"][op["penpal"]])
+            if kind == "delete_letter":
+                self.total_letters -= 1
+        elif kind == "add_note":
+            summary["note_count"] += 1
+        elif kind == "add_notes":
+            summary["note_count"] += len(result)
+        elif kind == "delete_note":
+            summary["note_count"] -= 1
+
+
+class JsonDocumentStore:
+    """letters_data.json behind an in-process cache.
+
+    The file is only re-parsed when its mtime, size or inode changes (another
+    process wrote it). Writes are applied to the cached copy and then the
+    document is saved, so the next read is served from memory. Writers hold
+    an advisory lock on ``<path>.lock`` and catch up with the file first, so
+    workers sharing it don't lose each other's updates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.lock = threading.RLock()
+        self._cache = None
+        self._signature = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _parse(self):
+        if not os.path.exists(self.path):
+            return empty_document()
+        with FILE_SECONDS.time(store='json', op='load'), open(self.path, 'r', encoding='utf-8') as f:
+            FILE_BYTES.inc(os.fstat(f.fileno()).st_size, store='json', op='load')
+            return json.load(f)
+
+    def cache(self):
+        """Return the current DocumentCache, re-parsing only if the file changed"""
+        with self.lock:
+            signature = self._stat()
+            if self._cache is None or signature != self._signature:
+                data = self._parse()
+                if assign_ids(data):
+                    self._write(data)
+                    signature = self._stat()
+                self._cache = DocumentCache(data)
+                self._signature = signature
+            return self._cache
+
+    def load(self):
+        return self.cache().data
+
+    def invalidate(self):
+        with self.lock:
+            self._cache = None
+            self._signature = None
+
+    def apply(self, op, after=None):
+        """Apply ``op`` to the cached document and persist it.
+
+        Returns the op's result, or None if it did not apply. If saving fails
+        the cache is dropped so the next read comes from disk again. Once
+        the op is saved, ``after(data, result)`` is called with the locks
+        still held, so side files it maintains change in write order.
+        """
+        with file_lock(self.lock_path), self.lock:
+            cache = self.cache()
+            result = cache.apply(op)
+            if result is None:
+                return None
+            try:
+                self._write(cache.data)
+            except Exception:
+                self.invalidate()
+                raise
+            self._signature = self._stat()
+            if after:
+                after(cache.data, result)
+            return result
+
+    def replace(self, data):
+        """Save a whole new document"""
+        with file_lock(self.lock_path), self.lock:
+            try:
+                self._write(data)
+            finally:
+                self.invalidate()
+
+    def rebuild_summaries(self):
+        """Recompute the summaries from the document"""
+        self.invalidate()
+
+    def _write(self, data):
+        with FILE_SECONDS.time(store='json', op='save'):
+            size = write_atomic(self.path, json.dumps(data, indent=2, ensure_ascii=False))
+        FILE_BYTES.inc(size, store='json', op='save')
+
+
+def assign_ids(data):
+    """Give letters and notes from older data files a stable id; True if any changed"""
+    items = [
+        item for penpal in data["penpals"].values()
+        for item in penpal["letters"] + penpal["notes"]
+    ]
+    if all("id" in item for item in items) and "next_id" in data:
+        return False
+    next_id = max([item.get("id", 0) for item in items] + [data.get("next_id", 1) - 1]) + 1
+    for item in items:
+        if "id" not in item:
+            item["id"] = next_id
+            next_id += 1
+    data["next_id"] = next_id
+    return True
@@ -0,0 +1,309 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import FILE_BYTES, FILE_SECONDS
+
+from .filestore import DocumentCache, assign_ids, empty_document, file_lock
+
+SNAPSHOT_FILE = 'snapshot.json'
+JOURNAL_FILE = 'journal.ndjson'
+LOCK_FILE = 'journal.lock'
+
+
+class JournalStore:
+    """Append-only storage engine for the file backend.
+
+    Every mutation op is appended to ``journal.ndjson`` as one JSON line with
+    a sequence number. State is rebuilt by loading ``snapshot.json`` and
+    replaying journal records newer than the snapshot's sequence number.
+    Once ``compact_every`` records have accumulated, a background thread
+    writes a fresh snapshot and truncates the journal.
+
+    Appends are flushed to the OS immediately; ``fsync`` is batched so that
+    at most ``fsync_interval`` seconds of writes are exposed to a power loss
+    (0 fsyncs every append). An advisory lock serialises writers across
+    processes, and each writer catches up with the journal tail first, so
+    several workers can share one journal directory. The file lock is always
+    taken before ``self.lock``.
+
+    Exposes the same interface as ``filestore.JsonDocumentStore``.
+    """
+
+    def __init__(self, directory, seed_path=None, fsync_interval=0.05, compact_every=1000):
+        self.directory = directory
+        self.seed_path = seed_path
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+
+        self.lock = threading.RLock()
+        self._cache = None
+        self._seq = 0
+        self._snapshot_seq = 0
+        self._snapshot_sig = None
+        self._journal_ino = None
+        self._offset = 0
+        self._fh = None
+
+        self._dirty = False
+        self._last_sync = time.monotonic()
+        self._wake = threading.Event()
+        self._worker = None
+        atexit.register(self.flush)
+
+    @classmethod
+    def from_env(cls, directory, seed_path=None):
+        return cls(
+            directory,
+            seed_path=seed_path,
+            fsync_interval=float(os.getenv('JOURNAL_FSYNC_INTERVAL', '0.05')),
+            compact_every=int(os.getenv('JOURNAL_COMPACT_EVERY', '1000')),
+        )
+
+    # Locking
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self.lock_path):
+            yield
+
+    # Loading and replay
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _bootstrap(self):
+        """Create the journal directory, seeding it from the JSON data file"""
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.snapshot_path):
+            return
+        data = empty_document()
+        if self.seed_path and os.path.exists(self.seed_path):
+            with open(self.seed_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            assign_ids(data)
+        self._write_snapshot(json.dumps({"seq": 0, "data": data}, ensure_ascii=False))
+
+    def _full_load(self):
+        self._bootstrap()
+        with FILE_SECONDS.time(store='journal', op='load'), \
+                open(self.snapshot_path, 'r', encoding='utf-8') as f:
+            FILE_BYTES.inc(os.fstat(f.fileno()).st_size, store='journal', op='load')
+            snapshot = json.load(f)
+        self._snapshot_sig = self._stat(self.snapshot_path)
+        self._snapshot_seq = self._seq = snapshot["seq"]
+        # Older snapshots have notes without ids; every process assigns the
+        # same ones since they follow document order
+        assign_ids(snapshot["data"])
+        self._cache = DocumentCache(snapshot["data"])
+        self._journal_ino = None
+        self._offset = 0
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+        self._replay_tail()
+
+    def _replay_tail(self):
+        """Apply journal records written since our last read"""
+        journal_sig = self._stat(self.journal_path)
+        if journal_sig is None:
+            return
+        self._journal_ino = journal_sig[2]
+        if journal_sig[1] <= self._offset:
+            return
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        # A torn final line (crash mid-append) is ignored until completed
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["seq"] <= self._seq:
+                continue
+            self._cache.apply(record)
+            self._seq = record["seq"]
+        self._offset += end
+
+    def _refresh(self):
+        if (self._cache is None or
+                self._stat(self.snapshot_path) != self._snapshot_sig or
+                (self._stat(self.journal_path) or (0, 0, None))[2] not in (self._journal_ino, None)):
+            self._full_load()
+        else:
+            self._replay_tail()
+
+    def cache(self):
+        with self.lock:
+            self._refresh()
+            return self._cache
+
+    def load(self):
+        return self.cache().data
+
+    def invalidate(self):
+        with self.lock:
+            self._cache = None
+
+    def rebuild_summaries(self):
+        """Recompute the summaries by reloading the snapshot and replaying the journal"""
+        self.invalidate()
+
+    # Writing
+
+    def _append(self, line):
+        if self._fh is None:
+            self._fh = open(self.journal_path, 'ab')
+            self._journal_ino = os.fstat(self._fh.fileno()).st_ino
+        # Drop a torn line left by a crashed writer so ours starts cleanly
+        size = os.fstat(self._fh.fileno()).st_size
+        if size > self._offset:
+            self._fh.truncate(self._offset)
+        with FILE_SECONDS.time(store='journal', op='append'):
+            self._fh.write(line)
+            self._fh.flush()
+        FILE_BYTES.inc(len(line), store='journal', op='append')
+        self._offset += len(line)
+        self._dirty = True
+        if time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._sync()
+        else:
+            self._start_worker()
+
+    def _sync(self):
+        if self._fh and self._dirty:
+            os.fsync(self._fh.fileno())
+        self._dirty = False
+        self._last_sync = time.monotonic()
+
+    def apply(self, op, after=None):
+        """Apply ``op`` and append it to the journal; returns the op's result or None.
+
+        ``after(data, result)`` is called once the op is appended, as in
+        ``JsonDocumentStore.apply``.
+        """
+        with self._file_lock(), self.lock:
+            try:
+                self._refresh()
+            except Exception:
+                self.invalidate()
+                raise
+            result = self._cache.apply(op)
+            if result is None:
+                return None
+            record = dict(op, seq=self._seq + 1)
+            line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+            try:
+                self._append(line)
+            except Exception:
+                self.invalidate()
+                raise
+            self._seq += 1
+            if self._seq - self._snapshot_seq >= self.compact_every:
+                self._start_worker()
+            if after:
+                after(self._cache.data, result)
+            return result
+
+    def replace(self, data):
+        """Replace the whole document with a new snapshot and an empty journal"""
+        with self._file_lock(), self.lock:
+            self._refresh()
+            self._seq += 1
+            self._write_snapshot(json.dumps({"seq": self._seq, "data": data}, ensure_ascii=False))
+            self._rewrite_journal(b'')
+            self.invalidate()
+
+    def flush(self):
+        """fsync any appends still waiting for the next batch"""
+        with self.lock:
+            if self._dirty:
+                self._sync()
+
+    # Compaction
+
+    def _write_snapshot(self, text):
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with FILE_SECONDS.time(store='journal', op='snapshot'), open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+            FILE_BYTES.inc(f.tell(), store='journal', op='snapshot')
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _rewrite_journal(self, tail):
+        tmp_path = f"{self.journal_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+        self._offset = len(tail)
+        self._journal_ino = self._stat(self.journal_path)[2]
+        self._dirty = False
+
+    def compact(self):
+        """Write a snapshot of the current state and drop the journal records it covers"""
+        # Writers are held off by the file lock for the whole compaction, but
+        # readers only wait for the in-memory steps, not the snapshot write.
+        with self._file_lock():
+            with self.lock:
+                self._refresh()
+                seq, offset = self._seq, self._offset
+                text = json.dumps({"seq": seq, "data": self._cache.data}, ensure_ascii=False)
+
+            self._write_snapshot(text)
+
+            with self.lock:
+                # Not _refresh(): it would see the new snapshot and reload it
+                # before the journal below is cut down to match
+                self._replay_tail()
+                tail = b''
+                if self._offset > offset:
+                    with open(self.journal_path, 'rb') as f:
+                        f.seek(offset)
+                        tail = f.read(self._offset - offset)
+                self._rewrite_journal(tail)
+                self._snapshot_seq = seq
+                self._snapshot_sig = self._stat(self.snapshot_path)
+
+    def _start_worker(self):
+        self._wake.set()
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run_worker, name='journal-maintenance', daemon=True)
+            self._worker.start()
+
+    def _run_worker(self):
+        """Background fsync batching and compaction; sleeps until an append wakes it"""
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                with self.lock:
+                    delay = self._last_sync + self.fsync_interval - time.monotonic() if self._dirty else 0
+                # Appends made meanwhile share this fsync
+                if delay > 0:
+                    time.sleep(delay)
+                self.flush()
+                with self.lock:
+                    due = self._seq - self._snapshot_seq >= self.compact_every
+                if due:
+                    self.compact()
+            except Exception as e:
+                print(f"Journal maintenance error: {e}")
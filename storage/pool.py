@@ -0,0 +1,312 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+from metrics import DB_CONNECTIONS, timed_statement
+
+# Imported on first connect so processes that never query (or cold starts
+# that haven't yet) don't pay for loading libpq
+psycopg2 = None
+
+
+def load_psycopg2():
+    global psycopg2
+    if psycopg2 is None:
+        import psycopg2.extensions  # binds the global declared above
+    return psycopg2
+
+
+_timed_cursor = None
+
+
+def timed_cursor():
+    """psycopg2 cursor class that records each statement's latency in metrics.
+
+    Built on first use since psycopg2 itself is only imported then.
+    """
+    global _timed_cursor
+    if _timed_cursor is None:
+        class TimedCursor(load_psycopg2().extensions.cursor):
+            def execute(self, query, vars=None):
+                with timed_statement('postgres', query):
+                    return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                with timed_statement('postgres', query):
+                    return super().executemany(query, vars_list)
+
+            def copy_expert(self, sql, file, size=8192):
+                with timed_statement('postgres', sql):
+                    return super().copy_expert(sql, file, size)
+
+        _timed_cursor = TimedCursor
+    return _timed_cursor
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out in time"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of Postgres connections.
+
+    ``min_size`` connections are opened when the pool is created so the first
+    requests don't pay for connection setup; the rest are opened on demand,
+    and a pool with ``min_size=0`` costs nothing until the first query. No
+    background threads are started, which keeps the pool safe to create on
+    serverless platforms where the process may be frozen between requests:
+    stale connections are detected by the health check on checkout and
+    replaced transparently.
+    """
+
+    def __init__(self, db_url, min_size=0, max_size=5, timeout=10.0,
+                 max_idle=300.0, max_lifetime=1800.0, check_after=30.0):
+        self.db_url = db_url
+        self.min_size = min_size
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # (conn, created_at, last_used), most recently used last
+        self._born = {}  # id(conn) -> created_at for checked-out connections
+        self._size = 0
+        self._pid = os.getpid()
+        self._prefill()
+
+    @classmethod
+    def from_env(cls, db_url):
+        """Build a pool using the PG_POOL_* environment variables"""
+        return cls(
+            db_url,
+            min_size=int(os.getenv('PG_POOL_MIN', '0')),
+            max_size=int(os.getenv('PG_POOL_MAX', '5')),
+            timeout=float(os.getenv('PG_POOL_TIMEOUT', '10')),
+            max_idle=float(os.getenv('PG_POOL_MAX_IDLE', '300')),
+            max_lifetime=float(os.getenv('PG_POOL_MAX_LIFETIME', '1800')),
+            check_after=float(os.getenv('PG_POOL_CHECK_AFTER', '30')),
+        )
+
+    def _connect(self):
+        parsed = urlparse(self.db_url)
+        conn = load_psycopg2().connect(
+            host=parsed.hostname,
+            port=parsed.port,
+            database=parsed.path[1:],  # Remove leading slash
+            user=parsed.username,
+            password=parsed.password,
+            # TLS unless the URL says otherwise (?sslmode=disable for a local server)
+            sslmode=parse_qs(parsed.query).get('sslmode', ['require'])[0],
+            connect_timeout=max(1, int(self.timeout)),
+            cursor_factory=timed_cursor()
+        )
+        DB_CONNECTIONS.inc(engine='postgres')
+        return conn
+
+    def _prefill(self):
+        """Open ``min_size`` idle connections up front.
+
+        A database that is down at startup is not fatal: the pool just falls
+        back to opening connections on checkout.
+        """
+        for _ in range(min(self.min_size, self.max_size)):
+            try:
+                conn = self._connect()
+            except Exception as e:
+                print(f"Could not pre-open pool connection: {e}")
+                return
+            now = time.monotonic()
+            with self._cond:
+                self._idle.append((conn, now, now))
+                self._size += 1
+
+    def _check_fork(self):
+        # A forked worker must not share sockets with its parent; forget the
+        # inherited connections without closing them.
+        if os.getpid() != self._pid:
+            self._idle = []
+            self._born = {}
+            self._size = 0
+            self._pid = os.getpid()
+
+    def _expired(self, created_at, last_used, now):
+        return (now - created_at > self.max_lifetime or
+                now - last_used > self.max_idle)
+
+    def _prune(self, now):
+        """Drop idle connections past their idle or lifetime limit.
+
+        Returns the dropped connections; the caller closes them once it has
+        released the pool lock so other threads don't wait on the sockets.
+        """
+        keep, expired = [], []
+        for entry in self._idle:
+            conn, created_at, last_used = entry
+            if self._size > self.min_size and self._expired(created_at, last_used, now):
+                expired.append(conn)
+                self._size -= 1
+            else:
+                keep.append(entry)
+        self._idle = keep
+        return expired
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, last_used, now):
+        if conn.closed:
+            return False
+        if now - last_used < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """Check out a connection, waiting up to ``timeout`` seconds"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            expired = []
+            conn, create = None, False
+            with self._cond:
+                self._check_fork()
+                while True:
+                    now = time.monotonic()
+                    expired += self._prune(now)
+                    if self._idle:
+                        conn, created_at, last_used = self._idle.pop()
+                        create = False
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        break
+                    if expired:
+                        # Close those before waiting rather than after
+                        break
+                    self._cond.wait(remaining)
+
+            for stale in expired:
+                self._close(stale)
+            if conn is None and not create:
+                if time.monotonic() < deadline:
+                    continue
+                raise PoolTimeout(
+                    f"No connection available after {self.timeout}s "
+                    f"(max_size={self.max_size})"
+                )
+
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                created_at = time.monotonic()
+            elif not self._healthy(conn, last_used, time.monotonic()):
+                self._close(conn)
+                with self._cond:
+                    self._size -= 1
+                continue
+
+            with self._cond:
+                self._born[id(conn)] = created_at
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, closing it if it is unusable"""
+        if not discard and not conn.closed:
+            try:
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            if os.getpid() != self._pid:
+                return
+            created_at = self._born.pop(id(conn), time.monotonic())
+            if discard or conn.closed:
+                self._close(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks out a connection and always returns it.
+
+        Any exception rolls back the open transaction; connection-level errors
+        also discard the connection instead of returning it to the pool.
+        """
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def closeall(self):
+        """Close every idle connection"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_url):
+    """Return the process-wide pool for ``db_url``, creating it on first use.
+
+    Keeping pools at module level lets warm serverless invocations reuse
+    connections opened by earlier requests in the same process.
+    """
+    with _pools_lock:
+        pool = _pools.get(db_url)
+        if pool is None:
+            pool = _pools[db_url] = ConnectionPool.from_env(db_url)
+        return pool
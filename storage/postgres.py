@@ -0,0 +1,969 @@
+import csv
+import io
+from contextlib import contextmanager
+from datetime import datetime
+
+from .base import (LETTERS_PAGE_SIZE, SEARCH_PAGE_SIZE, StorageEngine, cache_schema_version,
+                   cached_schema_version, letters_cursor, parse_letters_cursor, parse_search_cursor,
+                   search_cursor, unavailable_stats)
+from .codec import compression_summary
+from .pool import get_pool
+from .search_index import highlight_markup
+
+# penpal_summary holds one row per penpal with its letter and note counts
+# and latest letter date. Triggers keep it current inside the same
+# transaction as every letter or note write.
+SUMMARY_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS penpal_summary (
+        penpal_id INTEGER PRIMARY KEY REFERENCES penpals(id) ON DELETE CASCADE,
+        letter_count INTEGER NOT NULL DEFAULT 0,
+        note_count INTEGER NOT NULL DEFAULT 0,
+        last_letter TIMESTAMP
+    );
+
+    CREATE OR REPLACE FUNCTION penpal_summary_penpals() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO penpal_summary (penpal_id) VALUES (NEW.id) ON CONFLICT DO NOTHING;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION penpal_summary_letters() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE penpal_summary
+            SET letter_count = letter_count + 1,
+                last_letter = GREATEST(last_letter, NEW.date_received)
+            WHERE penpal_id = NEW.penpal_id;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE penpal_summary
+            SET letter_count = letter_count - 1,
+                last_letter = (SELECT MAX(date_received) FROM letters WHERE penpal_id = OLD.penpal_id)
+            WHERE penpal_id = OLD.penpal_id;
+        ELSE
+            UPDATE penpal_summary
+            SET last_letter = (SELECT MAX(date_received) FROM letters WHERE penpal_id = NEW.penpal_id)
+            WHERE penpal_id = NEW.penpal_id;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION penpal_summary_notes() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE penpal_summary SET note_count = note_count + 1 WHERE penpal_id = NEW.penpal_id;
+        ELSE
+            UPDATE penpal_summary SET note_count = note_count - 1 WHERE penpal_id = OLD.penpal_id;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS penpal_summary_penpals ON penpals;
+    CREATE TRIGGER penpal_summary_penpals AFTER INSERT ON penpals
+        FOR EACH ROW EXECUTE FUNCTION penpal_summary_penpals();
+    DROP TRIGGER IF EXISTS penpal_summary_letters ON letters;
+    CREATE TRIGGER penpal_summary_letters AFTER INSERT OR DELETE OR UPDATE OF date_received ON letters
+        FOR EACH ROW EXECUTE FUNCTION penpal_summary_letters();
+    DROP TRIGGER IF EXISTS penpal_summary_notes ON notes;
+    CREATE TRIGGER penpal_summary_notes AFTER INSERT OR DELETE ON notes
+        FOR EACH ROW EXECUTE FUNCTION penpal_summary_notes();
+'''
+
+# Every letter or note write bumps its penpal's version, which the web
+# layer turns into ETags without reading the letters themselves
+VERSION_SCHEMA = '''
+    CREATE OR REPLACE FUNCTION penpal_version_bump() RETURNS trigger AS $$
+    BEGIN
+        UPDATE penpal_summary
+        SET version = version + 1, updated_at = now()
+        WHERE penpal_id = CASE WHEN TG_OP = 'DELETE' THEN OLD.penpal_id ELSE NEW.penpal_id END;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS penpal_version_letters ON letters;
+    CREATE TRIGGER penpal_version_letters AFTER INSERT OR UPDATE OR DELETE ON letters
+        FOR EACH ROW EXECUTE FUNCTION penpal_version_bump();
+    DROP TRIGGER IF EXISTS penpal_version_notes ON notes;
+    CREATE TRIGGER penpal_version_notes AFTER INSERT OR UPDATE OR DELETE ON notes
+        FOR EACH ROW EXECUTE FUNCTION penpal_version_bump();
+'''
+
+# Bulk imports set this for their transaction, and the per-row summary and
+# version triggers skip themselves; the import recomputes them once instead
+BULK_IMPORT_SETTING = 'slowly_letters.bulk_import'
+ROW_TRIGGER_GUARD = f"WHEN (current_setting('{BULK_IMPORT_SETTING}', true) IS DISTINCT FROM 'on')"
+BULK_IMPORT_TRIGGERS = f'''
+    DROP TRIGGER IF EXISTS penpal_summary_letters ON letters;
+    CREATE TRIGGER penpal_summary_letters AFTER INSERT OR DELETE OR UPDATE OF date_received ON letters
+        FOR EACH ROW {ROW_TRIGGER_GUARD} EXECUTE FUNCTION penpal_summary_letters();
+    DROP TRIGGER IF EXISTS penpal_summary_notes ON notes;
+    CREATE TRIGGER penpal_summary_notes AFTER INSERT OR DELETE ON notes
+        FOR EACH ROW {ROW_TRIGGER_GUARD} EXECUTE FUNCTION penpal_summary_notes();
+    DROP TRIGGER IF EXISTS penpal_version_letters ON letters;
+    CREATE TRIGGER penpal_version_letters AFTER INSERT OR UPDATE OR DELETE ON letters
+        FOR EACH ROW {ROW_TRIGGER_GUARD} EXECUTE FUNCTION penpal_version_bump();
+    DROP TRIGGER IF EXISTS penpal_version_notes ON notes;
+    CREATE TRIGGER penpal_version_notes AFTER INSERT OR UPDATE OR DELETE ON notes
+        FOR EACH ROW {ROW_TRIGGER_GUARD} EXECUTE FUNCTION penpal_version_bump();
+'''
+
+# Recomputes summary rows from the base tables; {where} narrows it to
+# penpals that have no row yet
+REBUILD_SUMMARY_SQL = '''
+    INSERT INTO penpal_summary (penpal_id, letter_count, note_count, last_letter)
+    SELECT
+        p.id,
+        (SELECT COUNT(*) FROM letters l WHERE l.penpal_id = p.id),
+        (SELECT COUNT(*) FROM notes n WHERE n.penpal_id = p.id),
+        (SELECT MAX(l.date_received) FROM letters l WHERE l.penpal_id = p.id)
+    FROM penpals p
+    {where}
+    ON CONFLICT (penpal_id) DO UPDATE SET
+        letter_count = EXCLUDED.letter_count,
+        note_count = EXCLUDED.note_count,
+        last_letter = EXCLUDED.last_letter
+'''
+
+# Ordered schema migrations: (version, description, statements). Each
+# runs once, recorded in schema_version; steps use IF NOT EXISTS so
+# databases created before versioning adopt them cleanly. Append new
+# steps, never edit applied ones.
+MIGRATIONS = [
+    (1, "penpals, letters and notes tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS penpals (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255) UNIQUE NOT NULL,
+            country VARCHAR(255) NOT NULL,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS letters (
+            id SERIAL PRIMARY KEY,
+            penpal_id INTEGER REFERENCES penpals(id) ON DELETE CASCADE,
+            content TEXT NOT NULL,
+            date_received TIMESTAMP NOT NULL,
+            date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS notes (
+            id SERIAL PRIMARY KEY,
+            penpal_id INTEGER REFERENCES penpals(id) ON DELETE CASCADE,
+            note TEXT NOT NULL,
+            date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, "full-text search vector and GIN index", [
+        # Generated tsvector kept in sync by Postgres
+        '''
+        ALTER TABLE letters ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', content)) STORED
+        ''',
+        "CREATE INDEX IF NOT EXISTS letters_search_idx ON letters USING GIN (search_vector)",
+    ]),
+    (3, "per-penpal indexes on letters and notes", [
+        # Serves letter pages, per-penpal lookups and deletes
+        "CREATE INDEX IF NOT EXISTS letters_penpal_page_idx ON letters (penpal_id, date_received DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS notes_penpal_added_idx ON notes (penpal_id, date_added, id)",
+    ]),
+    (4, "penpal_summary table and triggers", [
+        SUMMARY_SCHEMA,
+        # Fill in rows for penpals created before the summary existed
+        REBUILD_SUMMARY_SQL.format(
+            where="WHERE NOT EXISTS (SELECT 1 FROM penpal_summary s WHERE s.penpal_id = p.id)"
+        ),
+    ]),
+    (5, "per-penpal version counter for conditional requests", [
+        "ALTER TABLE penpal_summary ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1",
+        "ALTER TABLE penpal_summary ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+        VERSION_SCHEMA,
+    ]),
+    (6, "lz4 compression for letter bodies", [
+        # Postgres already compresses bodies over ~2kB in TOAST, where the
+        # generated search_vector and ts_headline can still read them; lz4
+        # (Postgres 14+, if built in) decompresses several times faster than
+        # the default pglz. It applies to bodies written from now on.
+        '''
+        DO $$
+        BEGIN
+            IF current_setting('server_version_num')::int >= 140000 THEN
+                ALTER TABLE letters ALTER COLUMN content SET COMPRESSION lz4;
+            END IF;
+        EXCEPTION WHEN feature_not_supported THEN
+            RAISE NOTICE 'lz4 is not available; letters keep pglz compression';
+        END
+        $$
+        ''',
+    ]),
+    (7, "let bulk imports skip the per-row summary triggers", [
+        BULK_IMPORT_TRIGGERS,
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+# pg_advisory_lock key serializing migrations across processes
+SCHEMA_LOCK_ID = 7_301_001
+
+# Rows fetched per round trip by the export's server-side cursors
+EXPORT_BATCH_SIZE = 2000
+
+HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15, MaxFragments=2'
+
+# Penpal reads fetch the penpal row with its letters and notes aggregated
+# to JSON, in one statement. Timestamps inside the JSON are formatted with
+# ISO_FORMAT and passed through iso() to match datetime.isoformat().
+ISO_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS.US'
+LETTER_JSON = f'''json_build_object(
+    'id', l.id, 'content', l.content,
+    'date_received', to_char(l.date_received, '{ISO_FORMAT}'),
+    'date_added', to_char(l.date_added, '{ISO_FORMAT}'))'''
+NOTES_JSON = f'''COALESCE((
+    SELECT json_agg(json_build_object(
+        'id', n.id, 'note', n.note, 'date_added', to_char(n.date_added, '{ISO_FORMAT}'))
+        ORDER BY n.date_added, n.id)
+    FROM notes n WHERE n.penpal_id = p.id), '[]')'''
+PENPAL_SQL = f'''
+    SELECT
+        p.name, p.country, p.created_date,
+        COALESCE((
+            SELECT json_agg({LETTER_JSON} ORDER BY l.date_received DESC, l.id DESC)
+            FROM letters l WHERE l.penpal_id = p.id), '[]'),
+        {NOTES_JSON}
+    FROM penpals p
+    WHERE p.name = %(name)s
+'''
+# The newest %(limit)s letters (all of them for NULL) come from
+# letters_penpal_page_idx, like get_letters_page's first page
+PENPAL_PAGE_SQL = f'''
+    SELECT
+        p.name, p.country, p.created_date, COALESCE(s.letter_count, 0),
+        {NOTES_JSON},
+        COALESCE((
+            SELECT json_agg({LETTER_JSON} ORDER BY l.date_received DESC, l.id DESC)
+            FROM (
+                SELECT id, content, date_received, date_added FROM letters
+                WHERE penpal_id = p.id
+                ORDER BY date_received DESC, id DESC
+                LIMIT %(limit)s
+            ) l), '[]')
+    FROM penpals p
+    LEFT JOIN penpal_summary s ON s.penpal_id = p.id
+    WHERE p.name = %(name)s
+'''
+
+
+def iso(value):
+    return datetime.fromisoformat(value).isoformat()
+
+
+def letters_from_json(letters):
+    return [dict(letter, date_received=iso(letter["date_received"]), date_added=iso(letter["date_added"]))
+            for letter in letters]
+
+
+def notes_from_json(notes):
+    return [dict(note, date_added=iso(note["date_added"])) for note in notes]
+
+
+def copy_buffer(rows):
+    """CSV text for ``COPY ... FROM STDIN WITH (FORMAT csv)``.
+
+    Every value is quoted, so an empty string stays an empty string rather
+    than becoming NULL.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+    buffer.seek(0)
+    return buffer
+
+
+class PostgresEngine(StorageEngine):
+    """Postgres storage behind a pooled connection"""
+
+    name = 'Postgres'
+
+    def __init__(self, db_url):
+        self.db_url = db_url
+        self.pool = get_pool(db_url)
+    
+    def connection(self):
+        """Check out a pooled database connection (context manager)"""
+        self.ensure_schema()
+        return self.pool.connection()
+    
+    @contextmanager
+    def single_statement(self):
+        """Check out a connection in autocommit mode, for methods that run one statement.
+        
+        Otherwise psycopg2 sends a BEGIN before the statement and a COMMIT
+        or the pool's ROLLBACK follows it, three round trips instead of one.
+        A single statement (with its triggers) is atomic on its own.
+        """
+        with self.connection() as conn:
+            conn.autocommit = True
+            try:
+                yield conn
+            finally:
+                if not conn.closed:
+                    conn.autocommit = False
+    
+    def schema_version(self, cur):
+        """Highest applied migration, or 0 before the first one"""
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return 0
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return cur.fetchone()[0]
+    
+    def init_schema(self):
+        """Apply any pending migrations.
+        
+        Skipped without a query when this host has already verified the
+        current version (see ``cached_schema_version``). A process that finds
+        the schema current issues no DDL. Otherwise it takes a session
+        advisory lock so concurrent starts apply each migration exactly once,
+        each in its own transaction.
+        """
+        if cached_schema_version(self.db_url) == SCHEMA_VERSION:
+            return True
+        try:
+            with self.connection() as conn, conn.cursor() as cur:
+                if self.schema_version(cur) >= SCHEMA_VERSION:
+                    conn.rollback()
+                    cache_schema_version(self.db_url, SCHEMA_VERSION)
+                    return True
+                
+                cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+                try:
+                    cur.execute('''
+                        CREATE TABLE IF NOT EXISTS schema_version (
+                            version INTEGER PRIMARY KEY,
+                            description TEXT NOT NULL,
+                            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    ''')
+                    conn.commit()
+                    # Re-read under the lock: another process may have migrated
+                    current = self.schema_version(cur)
+                    for version, description, statements in MIGRATIONS:
+                        if version <= current:
+                            continue
+                        for statement in statements:
+                            cur.execute(statement)
+                        cur.execute(
+                            "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                            (version, description)
+                        )
+                        conn.commit()
+                        print(f"Applied migration {version}: {description}")
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+                    conn.commit()
+                print("Database tables initialized successfully")
+            cache_schema_version(self.db_url, SCHEMA_VERSION)
+            return True
+                
+        except Exception as e:
+            print(f"Error initializing database: {e}")
+            return False
+    
+    def add_penpal(self, name, country):
+        """Add a new penpal"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO penpals (name, country) VALUES (%s, %s)",
+                    (name, country)
+                )
+                print(f"Added penpal {name} from {country}")
+                return True
+            
+        except Exception as e:
+            # SQLSTATE class 23 is an integrity violation: the name is taken
+            if (getattr(e, 'pgcode', None) or '').startswith('23'):
+                print(f"Penpal {name} already exists")
+            else:
+                print(f"Error adding penpal: {e}")
+            return False
+    
+    def add_letter(self, penpal_name, content, date_received=None):
+        """Add a letter from a penpal"""
+        if date_received is None:
+            date_received = datetime.now()
+        elif isinstance(date_received, str):
+            date_received = datetime.fromisoformat(date_received.replace('Z', '+00:00'))
+        
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                # The penpal's id is resolved inside the INSERT; no row means no such penpal
+                cur.execute(
+                    "INSERT INTO letters (penpal_id, content, date_received) "
+                    "SELECT id, %s, %s FROM penpals WHERE name = %s",
+                    (content, date_received, penpal_name)
+                )
+                if cur.rowcount == 0:
+                    print(f"Penpal {penpal_name} not found")
+                    return False
+                print(f"Added letter for {penpal_name}")
+                return True
+            
+        except Exception as e:
+            print(f"Error adding letter: {e}")
+            return False
+            
+    def get_letter(self, penpal_name, letter_id):
+        """Get one of a penpal's letters by id"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(
+                    '''
+                    SELECT l.id, l.content, l.date_received, l.date_added
+                    FROM letters l JOIN penpals p ON p.id = l.penpal_id
+                    WHERE l.id = %s AND p.name = %s
+                    ''',
+                    (letter_id, penpal_name)
+                )
+                row = cur.fetchone()
+                if not row:
+                    return None
+                return {
+                    "id": row[0],
+                    "content": row[1],
+                    "date_received": row[2].isoformat(),
+                    "date_added": row[3].isoformat()
+                }
+            
+        except Exception as e:
+            print(f"Error getting letter: {e}")
+            return None
+    
+    def delete_letter(self, penpal_name, letter_id):
+        """Delete a letter by id (scoped to the penpal)"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM letters l USING penpals p WHERE l.id = %s AND p.id = l.penpal_id AND p.name = %s",
+                    (letter_id, penpal_name)
+                )
+                return cur.rowcount == 1
+        except Exception as e:
+            print(f"Error deleting letter: {e}")
+            return False
+    
+    def update_letter(self, penpal_name, letter_id, content=None, date_received=None):
+        """Edit a letter's content and/or received date"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(
+                    '''
+                    UPDATE letters l
+                    SET content = COALESCE(%s, l.content),
+                        date_received = COALESCE(%s, l.date_received)
+                    FROM penpals p
+                    WHERE l.id = %s AND p.id = l.penpal_id AND p.name = %s
+                    ''',
+                    (content, date_received, letter_id, penpal_name)
+                )
+                return cur.rowcount == 1
+        except Exception as e:
+            print(f"Error updating letter: {e}")
+            return False
+    
+    def add_note(self, penpal_name, note):
+        """Add a note about a penpal"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO notes (penpal_id, note) SELECT id, %s FROM penpals WHERE name = %s",
+                    (note, penpal_name)
+                )
+                if cur.rowcount == 0:
+                    print(f"Penpal {penpal_name} not found")
+                    return False
+                print(f"Added note for {penpal_name}: {note[:50]}...")
+                return True
+            
+        except Exception as e:
+            print(f"Error adding note: {e}")
+            return False
+    
+    def add_notes(self, penpal_name, notes):
+        """Add several notes about a penpal in one statement"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                # One INSERT for the whole list (executemany would be a round
+                # trip per note); ids follow the list order
+                cur.execute(
+                    '''
+                    INSERT INTO notes (penpal_id, note)
+                    SELECT p.id, n.note
+                    FROM penpals p, unnest(%s::text[]) WITH ORDINALITY AS n(note, ord)
+                    WHERE p.name = %s
+                    ORDER BY n.ord
+                    ''',
+                    (list(notes), penpal_name)
+                )
+                if cur.rowcount == 0:
+                    print(f"Penpal {penpal_name} not found")
+                    return False
+                print(f"Added {len(notes)} notes for {penpal_name}")
+                return True
+            
+        except Exception as e:
+            print(f"Error adding notes: {e}")
+            return False
+    
+    def import_batch(self, penpals, letters, notes):
+        """Write imported records in one transaction, streaming letters and notes through COPY.
+
+        The per-row summary and version triggers are switched off for the
+        transaction, and the affected penpals' summaries are recomputed
+        and their versions bumped once at the end.
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cur:
+                cur.execute(f"SET LOCAL {BULK_IMPORT_SETTING} = 'on'")
+                added_penpals = 0
+                for penpal in penpals:
+                    cur.execute(
+                        "INSERT INTO penpals (name, country, created_date) VALUES (%s, %s, %s) "
+                        "ON CONFLICT (name) DO NOTHING",
+                        (penpal["name"], penpal["country"], penpal["created_date"])
+                    )
+                    added_penpals += cur.rowcount
+                
+                names = list({record["penpal"] for record in letters + notes})
+                cur.execute("SELECT name, id FROM penpals WHERE name = ANY(%s)", (names,))
+                ids = dict(cur.fetchall())
+                
+                letter_rows = [(ids[l["penpal"]], l["content"], l["date_received"], l["date_added"])
+                               for l in letters if l["penpal"] in ids]
+                note_rows = [(ids[n["penpal"]], n["note"], n["date_added"])
+                             for n in notes if n["penpal"] in ids]
+                if letter_rows:
+                    cur.copy_expert(
+                        "COPY letters (penpal_id, content, date_received, date_added) FROM STDIN WITH (FORMAT csv)",
+                        copy_buffer(letter_rows)
+                    )
+                if note_rows:
+                    cur.copy_expert(
+                        "COPY notes (penpal_id, note, date_added) FROM STDIN WITH (FORMAT csv)",
+                        copy_buffer(note_rows)
+                    )
+                touched = sorted({row[0] for row in letter_rows + note_rows})
+                if touched:
+                    cur.execute(REBUILD_SUMMARY_SQL.format(where="WHERE p.id = ANY(%s)"), (touched,))
+                    cur.execute(
+                        "UPDATE penpal_summary SET version = version + 1, updated_at = now() "
+                        "WHERE penpal_id = ANY(%s)", (touched,)
+                    )
+                conn.commit()
+                return {"penpals": added_penpals, "letters": len(letter_rows), "notes": len(note_rows)}
+            
+        except Exception as e:
+            print(f"Error importing batch: {e}")
+            return None
+    
+    def delete_note(self, penpal_name, note_id):
+        """Delete a note about a penpal by id"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(
+                    '''
+                    DELETE FROM notes n USING penpals p
+                    WHERE n.id = %s AND p.id = n.penpal_id AND p.name = %s
+                    RETURNING n.note
+                    ''',
+                    (note_id, penpal_name)
+                )
+                deleted = cur.fetchone()
+                if not deleted:
+                    print(f"Note {note_id} not found for {penpal_name}")
+                    return False
+                print(f"Deleted note for {penpal_name}: {deleted[0][:50]}...")
+                return True
+                
+        except Exception as e:
+            print(f"Error deleting note: {e}")
+            return False
+    
+    def update_note(self, penpal_name, note_id, note):
+        """Edit a note about a penpal"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE notes n SET note = %s FROM penpals p WHERE n.id = %s AND p.id = n.penpal_id AND p.name = %s",
+                    (note, note_id, penpal_name)
+                )
+                return cur.rowcount == 1
+        except Exception as e:
+            print(f"Error updating note: {e}")
+            return False
+    
+    def get_penpal(self, name):
+        """Get penpal data with every letter and note, in one statement"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(PENPAL_SQL, {"name": name})
+                row = cur.fetchone()
+            if not row:
+                return None
+            penpal_name, country, created_date, letters, notes = row
+            return {
+                "name": penpal_name,
+                "country": country,
+                "letters": letters_from_json(letters),
+                "notes": notes_from_json(notes),
+                "created_date": created_date.isoformat()
+            }
+            
+        except Exception as e:
+            print(f"Error getting penpal: {e}")
+            return None
+    
+    def _penpal_page_row(self, name, letter_limit):
+        """PENPAL_PAGE_SQL's row for ``name`` with up to ``letter_limit`` letters (None: all)"""
+        with self.single_statement() as conn, conn.cursor() as cur:
+            cur.execute(PENPAL_PAGE_SQL, {"name": name, "limit": letter_limit})
+            return cur.fetchone()
+    
+    def get_penpal_page(self, name, limit=LETTERS_PAGE_SIZE):
+        """Get penpal details, notes, letter count and newest letters, in one statement"""
+        try:
+            row = self._penpal_page_row(name, (limit + 1) if limit else None)
+        except Exception as e:
+            print(f"Error getting penpal: {e}")
+            return None
+        if not row:
+            return None
+        penpal_name, country, created_date, letter_count, notes, letters = row
+        
+        letters = letters_from_json(letters)
+        next_cursor = None
+        if limit and len(letters) > limit:
+            letters = letters[:limit]
+            next_cursor = letters_cursor(letters[-1])
+        return {
+            "name": penpal_name,
+            "country": country,
+            "notes": notes_from_json(notes),
+            "created_date": created_date.isoformat(),
+            "letter_count": letter_count,
+            "letters": letters,
+            "next_cursor": next_cursor
+        }
+    
+    def get_penpal_header(self, name):
+        """Get penpal details and notes with a letter count, skipping letter bodies"""
+        try:
+            row = self._penpal_page_row(name, 0)
+        except Exception as e:
+            print(f"Error getting penpal: {e}")
+            return None
+        if not row:
+            return None
+        penpal_name, country, created_date, letter_count, notes, _ = row
+        return {
+            "name": penpal_name,
+            "country": country,
+            "notes": notes_from_json(notes),
+            "created_date": created_date.isoformat(),
+            "letter_count": letter_count
+        }
+    
+    def get_letters_page(self, penpal_name, limit=LETTERS_PAGE_SIZE, cursor=None):
+        """Get one page of a penpal's letters, newest first"""
+        empty = {"letters": [], "next_cursor": None}
+        after = (None, None)
+        if cursor:
+            after = parse_letters_cursor(cursor)
+            if after is None:
+                return empty
+        
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                # Row comparison lets Postgres seek straight to the cursor
+                # position in letters_penpal_page_idx
+                cur.execute(
+                    '''
+                    SELECT l.id, l.content, l.date_received, l.date_added
+                    FROM letters l
+                    JOIN penpals p ON p.id = l.penpal_id
+                    WHERE p.name = %(name)s
+                      AND (%(after_id)s IS NULL
+                           OR (l.date_received, l.id) < (%(after_date)s::timestamp, %(after_id)s))
+                    ORDER BY l.date_received DESC, l.id DESC
+                    LIMIT %(limit)s
+                    ''',
+                    {
+                        "name": penpal_name,
+                        "after_date": after[0],
+                        "after_id": after[1],
+                        "limit": (limit + 1) if limit else None
+                    }
+                )
+                rows = cur.fetchall()
+            
+        except Exception as e:
+            print(f"Error getting letters: {e}")
+            return empty
+        
+        letters = [
+            {
+                "id": letter_id,
+                "content": content,
+                "date_received": date_received.isoformat(),
+                "date_added": date_added.isoformat()
+            }
+            for letter_id, content, date_received, date_added in rows
+        ]
+        next_cursor = None
+        if limit and len(letters) > limit:
+            letters = letters[:limit]
+            next_cursor = letters_cursor(letters[-1])
+        return {"letters": letters, "next_cursor": next_cursor}
+    
+    def get_notes(self, penpal_name):
+        """Get a penpal's notes without loading their letters"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(f"SELECT {NOTES_JSON} FROM penpals p WHERE p.name = %s", (penpal_name,))
+                row = cur.fetchone()
+            return notes_from_json(row[0]) if row else None
+            
+        except Exception as e:
+            print(f"Error getting notes: {e}")
+            return []
+    
+    def get_versions(self, penpal_name=None):
+        """Penpal versions from penpal_summary, kept current by triggers"""
+        where, params = ("WHERE p.name = %s", (penpal_name,)) if penpal_name else ("", ())
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "SELECT p.name, s.version, s.updated_at "
+                    f"FROM penpals p JOIN penpal_summary s ON s.penpal_id = p.id {where}", params
+                )
+                return {
+                    name: {"version": version, "updated_at": updated_at}
+                    for name, version, updated_at in cur.fetchall()
+                }
+        except Exception as e:
+            print(f"Error getting penpal versions: {e}")
+            return {}
+    
+    def rebuild_penpal_summary(self):
+        """Recompute every penpal_summary row from the letters and notes tables"""
+        try:
+            with self.connection() as conn, conn.cursor() as cur:
+                cur.execute(REBUILD_SUMMARY_SQL.format(where=''))
+                rebuilt = cur.rowcount
+                # Counts may have changed, so cached representations are stale
+                cur.execute("UPDATE penpal_summary SET version = version + 1, updated_at = now()")
+                conn.commit()
+                return rebuilt
+        except Exception as e:
+            print(f"Error rebuilding penpal summary: {e}")
+            return False
+    
+    def compression_stats(self):
+        """Body sizes as Postgres stores them: octet_length is the text, pg_column_size the TOAST datum"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                cur.execute('''
+                    SELECT
+                        COUNT(*),
+                        COUNT(*) FILTER (WHERE pg_column_size(content) < octet_length(content)),
+                        COALESCE(SUM(octet_length(content)), 0),
+                        COALESCE(SUM(pg_column_size(content)), 0)
+                    FROM letters
+                ''')
+                letters, compressed, raw_bytes, stored_bytes = cur.fetchone()
+                return compression_summary(letters, compressed, int(raw_bytes), int(stored_bytes))
+        except Exception as e:
+            print(f"Error measuring letter sizes: {e}")
+            return None
+    
+    def get_all_penpals(self):
+        """Get all penpals with summary info"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                # One summary row per penpal instead of aggregating letters x notes
+                cur.execute('''
+                    SELECT 
+                        p.name,
+                        p.country,
+                        COALESCE(s.letter_count, 0),
+                        COALESCE(s.note_count, 0),
+                        s.last_letter
+                    FROM penpals p
+                    LEFT JOIN penpal_summary s ON s.penpal_id = p.id
+                    ORDER BY s.last_letter DESC NULLS LAST
+                ''')
+                
+                penpals = []
+                for name, country, letter_count, note_count, last_letter in cur.fetchall():
+                    penpals.append({
+                        "name": name,
+                        "country": country,
+                        "letter_count": letter_count,
+                        "note_count": note_count,
+                        "last_letter": last_letter.isoformat() if last_letter else None
+                    })
+                
+                return penpals
+            
+        except Exception as e:
+            print(f"Error getting all penpals: {e}")
+            return []
+    
+    def iter_records(self, penpal_name=None):
+        """Stream export records.
+        
+        Letters and notes are read through named (server-side) cursors that
+        fetch EXPORT_BATCH_SIZE rows per round trip, so memory stays flat
+        however large the archive. The pooled connection is held until the
+        generator finishes or is closed.
+        """
+        where, params = ("WHERE p.name = %s", (penpal_name,)) if penpal_name else ("", ())
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT name, country, created_date FROM penpals p {where} ORDER BY name", params)
+                for name, country, created_date in cur:
+                    yield {"type": "penpal", "name": name, "country": country,
+                           "created_date": created_date.isoformat()}
+            
+            with conn.cursor(name='export_letters') as cur:
+                cur.itersize = EXPORT_BATCH_SIZE
+                cur.execute(
+                    "SELECT p.name, l.id, l.content, l.date_received, l.date_added "
+                    f"FROM letters l JOIN penpals p ON p.id = l.penpal_id {where} "
+                    "ORDER BY p.name, l.date_received, l.id", params
+                )
+                for name, letter_id, content, date_received, date_added in cur:
+                    yield {"type": "letter", "penpal": name, "id": letter_id, "content": content,
+                           "date_received": date_received.isoformat(), "date_added": date_added.isoformat()}
+            
+            with conn.cursor(name='export_notes') as cur:
+                cur.itersize = EXPORT_BATCH_SIZE
+                cur.execute(
+                    "SELECT p.name, n.id, n.note, n.date_added "
+                    f"FROM notes n JOIN penpals p ON p.id = n.penpal_id {where} "
+                    "ORDER BY p.name, n.date_added, n.id", params
+                )
+                for name, note_id, note, date_added in cur:
+                    yield {"type": "note", "penpal": name, "id": note_id, "note": note,
+                           "date_added": date_added.isoformat()}
+    
+    def search_letters_page(self, query, limit=SEARCH_PAGE_SIZE, cursor=None):
+        """Ranked full-text search returning one page of results.
+        
+        Returns {"results": [...], "next_cursor": str or None, "total": int
+        or None}. Pass the cursor back in to fetch the following page.
+        """
+        if not query.strip():
+            return {"results": [], "next_cursor": None, "total": 0}
+        empty = {"results": [], "next_cursor": None, "total": None}
+        
+        # Keyset cursor on (rank, id) so deep pages cost the same as the first
+        after_rank, after_id = None, None
+        if cursor:
+            after = parse_search_cursor(cursor)
+            if after is None:
+                return empty
+            after_rank, after_id = after
+        
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                # Rank every match via the GIN index, but only build headlines
+                # for the rows on the requested page.
+                cur.execute('''
+                    WITH q AS (SELECT websearch_to_tsquery('english', %(query)s) AS query),
+                    matches AS (
+                        SELECT l.id, ts_rank(l.search_vector, q.query) AS rank
+                        FROM letters l, q
+                        WHERE l.search_vector @@ q.query
+                    )
+                    SELECT
+                        page.id,
+                        page.rank,
+                        p.name,
+                        p.country,
+                        l.date_received,
+                        l.date_added,
+                        ts_headline('english', l.content, q.query, %(headline)s),
+                        (SELECT COUNT(*) FROM matches)
+                    FROM (
+                        SELECT id, rank FROM matches
+                        WHERE %(after_id)s::integer IS NULL
+                           OR (rank, id) < (%(after_rank)s::real, %(after_id)s::integer)
+                        ORDER BY rank DESC, id DESC
+                        LIMIT %(limit)s
+                    ) page
+                    JOIN letters l ON l.id = page.id
+                    JOIN penpals p ON l.penpal_id = p.id
+                    CROSS JOIN q
+                    ORDER BY page.rank DESC, page.id DESC
+                ''', {
+                    "query": query,
+                    "headline": HEADLINE_OPTIONS,
+                    "after_rank": after_rank,
+                    "after_id": after_id,
+                    "limit": (limit + 1) if limit else None,
+                })
+                rows = cur.fetchall()
+            
+            next_cursor = None
+            if limit and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = search_cursor(rows[-1][1], rows[-1][0])
+            
+            results = []
+            for letter_id, rank, name, country, date_received, date_added, headline, _ in rows:
+                results.append({
+                    "penpal_name": name,
+                    "country": country,
+                    "letter": {
+                        "id": letter_id,
+                        "date_received": date_received.isoformat(),
+                        "date_added": date_added.isoformat()
+                    },
+                    "rank": rank,
+                    "preview": highlight_markup(headline)
+                })
+            
+            total = rows[0][7] if rows else (None if cursor else 0)
+            return {"results": results, "next_cursor": next_cursor, "total": total}
+            
+        except Exception as e:
+            print(f"Error searching letters: {e}")
+            return empty
+    
+    def get_stats(self):
+        """Get statistics about the letters"""
+        try:
+            with self.single_statement() as conn, conn.cursor() as cur:
+                # One round trip; the letter total comes from penpal_summary
+                # rather than counting the letters table
+                cur.execute('''
+                    SELECT
+                        (SELECT COUNT(*) FROM penpals),
+                        (SELECT COALESCE(SUM(letter_count), 0) FROM penpal_summary),
+                        ARRAY(SELECT DISTINCT country FROM penpals ORDER BY country)
+                ''')
+                total_penpals, total_letters, countries = cur.fetchone()
+                
+                return {
+                    "total_penpals": total_penpals,
+                    "total_letters": total_letters,
+                    "countries": len(countries),
+                    "country_list": countries
+                }
+            
+        except Exception as e:
+            print(f"Error getting stats: {e}")
+            return unavailable_stats()
@@ -0,0 +1,383 @@
+import json
+import math
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+from markupsafe import escape
+
+from .codec import decode_body
+from .filestore import file_lock, write_atomic
+from .sharded import shard_file as segment_file
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+PHRASE_RE = re.compile(r'"([^"]*)"|(\S+)')
+LOCK_FILE = 'index.lock'
+# Log lines a segment gathers before they are folded into its base file
+COMPACT_EVERY = 64
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """Lowercase word tokens of ``text``"""
+    return TOKEN_RE.findall(text.lower())
+
+
+def parse_query(query):
+    """Split a query into a list of phrases, each a list of tokens.
+
+    Quoted text becomes one phrase; every other word is its own phrase of
+    length one. All phrases must match for a letter to be returned.
+    """
+    phrases = []
+    for quoted, word in PHRASE_RE.findall(query):
+        tokens = tokenize(quoted if quoted else word)
+        if quoted and tokens:
+            phrases.append(tokens)
+        else:
+            phrases.extend([token] for token in tokens)
+    return phrases
+
+
+class InvertedIndex:
+    """Token -> letter postings for one penpal's letters.
+
+    ``postings`` maps each token to ``{letter_id: [positions]}`` and ``docs``
+    maps each letter id to its token count. Letter ids are stored as strings
+    because they round-trip through JSON object keys. ``version`` is the
+    penpal's ``letters_version`` the segment reflects.
+    """
+
+    def __init__(self, version=0):
+        self.version = version
+        self.postings = {}
+        self.docs = {}
+        self.total_length = 0
+
+    @classmethod
+    def load(cls, path):
+        """Load a segment from ``path``; returns None if it is missing or unreadable"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+            index = cls(raw["version"])
+            index.postings = raw["postings"]
+            index.docs = raw["docs"]
+            index.total_length = raw["total_length"]
+            return index
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @classmethod
+    def build(cls, letters, version):
+        """Build a fresh segment from a penpal's stored letters"""
+        index = cls(version)
+        for letter in letters:
+            index.add(letter["id"], decode_body(letter["content"]))
+        return index
+
+    def dumps(self):
+        # dumps rather than dump: dump streams through the pure-Python
+        # encoder, which is several times slower
+        return json.dumps({
+            "version": self.version,
+            "postings": self.postings,
+            "docs": self.docs,
+            "total_length": self.total_length
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    def add(self, letter_id, content):
+        """Index a new letter; only for segments no reader has been given yet"""
+        doc_id = str(letter_id)
+        tokens = tokenize(content)
+        for position, token in enumerate(tokens):
+            self.postings.setdefault(token, {}).setdefault(doc_id, []).append(position)
+        self.docs[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def changed(self, version, removed=(), added=()):
+        """A copy at ``version`` with the ``removed`` letter ids dropped and ``added`` (id, text) pairs indexed.
+
+        A letter in ``added`` replaces whatever was indexed under its id.
+        Only the postings the change touches are copied, so this segment is
+        left intact for searches still reading it.
+        """
+        segment = InvertedIndex(version)
+        segment.postings = dict(self.postings)
+        segment.docs = dict(self.docs)
+        segment.total_length = self.total_length
+        copied = set()
+
+        def own(token):
+            if token not in copied:
+                segment.postings[token] = dict(segment.postings.get(token, {}))
+                copied.add(token)
+            return segment.postings[token]
+
+        for doc_id in {str(letter_id) for letter_id in removed} | {str(letter_id) for letter_id, _ in added}:
+            length = segment.docs.pop(doc_id, None)
+            if length is None:
+                continue
+            segment.total_length -= length
+            for token in [token for token, postings in segment.postings.items() if doc_id in postings]:
+                del own(token)[doc_id]
+        for letter_id, content in added:
+            doc_id = str(letter_id)
+            tokens = tokenize(content)
+            for position, token in enumerate(tokens):
+                own(token).setdefault(doc_id, []).append(position)
+            segment.docs[doc_id] = len(tokens)
+            segment.total_length += len(tokens)
+        for token in copied:
+            if not segment.postings[token]:
+                del segment.postings[token]
+        return segment
+
+    def _phrase_positions(self, doc_id, phrase):
+        """Positions in ``doc_id`` where ``phrase`` starts"""
+        starts = set(self.postings[phrase[0]][doc_id])
+        for offset, token in enumerate(phrase[1:], 1):
+            positions = set(self.postings[token][doc_id])
+            starts = {p for p in starts if p + offset in positions}
+            if not starts:
+                break
+        return starts
+
+    def matches(self, terms, phrases):
+        """Ids of the letters in this segment that match every phrase"""
+        if any(term not in self.postings for term in terms):
+            return set()
+
+        # Intersect starting from the rarest term so work tracks the match count
+        ordered = sorted(terms, key=lambda t: len(self.postings[t]))
+        candidates = set(self.postings[ordered[0]])
+        for term in ordered[1:]:
+            candidates.intersection_update(self.postings[term])
+            if not candidates:
+                return candidates
+
+        multi_word = [phrase for phrase in phrases if len(phrase) > 1]
+        if multi_word:
+            candidates = {
+                doc_id for doc_id in candidates
+                if all(self._phrase_positions(doc_id, phrase) for phrase in multi_word)
+            }
+        return candidates
+
+    def score(self, doc_id, idf, avg_length):
+        length = self.docs[doc_id]
+        norm = K1 * (1 - B + B * length / avg_length) if avg_length else K1
+        score = 0.0
+        for term, weight in idf.items():
+            tf = len(self.postings[term][doc_id])
+            score += weight * tf * (K1 + 1) / (tf + norm)
+        return score
+
+
+def search_segments(query, segments):
+    """Return ``[(score, letter_id, penpal_name)]`` for letters matching every phrase.
+
+    ``segments`` maps penpal names to their InvertedIndex; document
+    frequencies and lengths are summed across all of them, so scores are
+    the same as from a single archive-wide index. Results are ordered by
+    score, then id, both descending.
+    """
+    phrases = parse_query(query)
+    if not phrases:
+        return []
+
+    terms = {token for phrase in phrases for token in phrase}
+    df = {term: sum(len(segment.postings.get(term, ())) for segment in segments.values()) for term in terms}
+    if not all(df.values()):
+        return []
+
+    n_docs = sum(len(segment.docs) for segment in segments.values())
+    total_length = sum(segment.total_length for segment in segments.values())
+    avg_length = total_length / n_docs if n_docs else 0
+    idf = {term: math.log(1 + (n_docs - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+
+    results = []
+    for penpal_name, segment in segments.items():
+        for doc_id in segment.matches(terms, phrases):
+            results.append((segment.score(doc_id, idf, avg_length), int(doc_id), penpal_name))
+
+    results.sort(key=lambda r: (-r[0], -r[1]))
+    return results
+
+
+class SearchIndex:
+    """The file backend's search index: one InvertedIndex segment per penpal.
+
+    Each segment is a base file plus an append-only log of changes, one
+    JSON line per write, so a write costs as much as the letters it
+    changed. Once a log holds COMPACT_EVERY lines it is folded into a new
+    base. Every line carries the penpal's ``letters_version`` after the
+    change, and lines are only replayed in order, so a reader that misses
+    one is left with an old version and rebuilds the segment.
+
+    Segments are cached in memory and only the new log lines are read when
+    another process appends. A cached segment is never changed in place;
+    changes publish a new copy (see ``InvertedIndex.changed``). Files are
+    only changed under an advisory lock on ``index.lock``, taken after any
+    store lock and never while waiting for one.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+        self.lock = threading.RLock()
+        # penpal name -> (base file signature, log bytes read, log lines read, segment)
+        self._segments = {}
+
+    def paths(self, penpal_name):
+        """(base file, log file) of a penpal's segment"""
+        base = os.path.join(self.directory, segment_file(penpal_name))
+        return base, base[:-len('.json')] + '.log'
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self.lock_path):
+            yield
+
+    def _refresh(self, penpal_name):
+        """Bring the cached copy of a segment up to date with its files; returns the cache entry or None"""
+        base_path, log_path = self.paths(penpal_name)
+        with self.lock:
+            base_sig = self._stat(base_path)
+            entry = self._segments.get(penpal_name)
+            log_size = (self._stat(log_path) or (0, 0, None))[1]
+            if entry is None or entry[0] != base_sig or log_size < entry[1]:
+                segment = InvertedIndex.load(base_path) if base_sig else None
+                if segment is None:
+                    self._segments.pop(penpal_name, None)
+                    return None
+                entry = (base_sig, 0, 0, segment)
+            if log_size > entry[1]:
+                entry = self._replay(log_path, entry)
+            self._segments[penpal_name] = entry
+            return entry
+
+    @staticmethod
+    def _replay(log_path, entry):
+        base_sig, offset, lines, segment = entry
+        try:
+            with open(log_path, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return entry
+        # A torn final line (crash mid-append) is left for the next writer to drop
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            change = json.loads(line)
+            if change["version"] == segment.version + 1:
+                segment = segment.changed(change["version"], change["remove"], change["add"])
+            lines += 1
+        return (base_sig, offset + end, lines, segment)
+
+    def get(self, penpal_name):
+        """A penpal's current segment, or None if there isn't a readable one"""
+        entry = self._refresh(penpal_name)
+        return entry[3] if entry else None
+
+    def _write_base(self, penpal_name, segment):
+        """Replace a segment's base file and drop its log; call with the file lock held"""
+        base_path, log_path = self.paths(penpal_name)
+        write_atomic(base_path, segment.dumps())
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        with self.lock:
+            self._segments[penpal_name] = (self._stat(base_path), 0, 0, segment)
+
+    def save(self, penpal_name, segment):
+        """Store a freshly built segment, unless the files already hold that version"""
+        with self._file_lock():
+            entry = self._refresh(penpal_name)
+            if entry is None or entry[3].version != segment.version:
+                self._write_base(penpal_name, segment)
+
+    def update(self, penpal_name, version, removed, added, rebuild):
+        """Record a change that took a penpal's letters to ``version``.
+
+        ``removed`` are letter ids and ``added`` (id, text) pairs. If the
+        segment isn't at ``version - 1`` the change can't be appended, so
+        ``rebuild()`` is called for a whole new segment instead.
+        """
+        base_path, log_path = self.paths(penpal_name)
+        with self._file_lock():
+            entry = self._refresh(penpal_name)
+            if entry is None or entry[3].version != version - 1:
+                self._write_base(penpal_name, rebuild())
+                return
+            base_sig, offset, lines, segment = entry
+            segment = segment.changed(version, removed, added)
+            if lines + 1 >= COMPACT_EVERY:
+                self._write_base(penpal_name, segment)
+                return
+            line = json.dumps({"version": version, "remove": list(removed), "add": list(added)},
+                              ensure_ascii=False) + '\n'
+            with open(log_path, 'ab') as f:
+                # Drop a torn line left by a crashed writer so ours starts cleanly
+                f.truncate(offset)
+                f.write(line.encode('utf-8'))
+                offset = f.tell()
+            with self.lock:
+                self._segments[penpal_name] = (base_sig, offset, lines + 1, segment)
+
+    def discard(self, penpal_name):
+        """Delete a penpal's segment so the next search rebuilds it"""
+        with self._file_lock():
+            for path in self.paths(penpal_name):
+                if os.path.exists(path):
+                    os.remove(path)
+            with self.lock:
+                self._segments.pop(penpal_name, None)
+
+
+def snippet(text, query, max_length=200):
+    """HTML preview of ``text`` around the first query term, with terms in <mark>"""
+    terms = {token for phrase in parse_query(query) for token in phrase}
+    matches = [m for m in TOKEN_RE.finditer(text) if m.group().lower() in terms]
+
+    if matches:
+        start = max(0, matches[0].start() - max_length // 2)
+    else:
+        start = 0
+    end = min(len(text), start + max_length)
+
+    parts = []
+    cursor = start
+    for match in matches:
+        if match.start() < start or match.end() > end:
+            continue
+        parts.append(str(escape(text[cursor:match.start()])))
+        parts.append('<mark>' + str(escape(match.group())) + '</mark>')
+        cursor = match.end()
+    parts.append(str(escape(text[cursor:end])))
+
+    preview = ''.join(parts)
+    if start > 0:
+        preview = "..." + preview
+    if end < len(text):
+        preview = preview + "..."
+    return preview
+
+
+def highlight_markup(snippet_html):
+    """Escape a database-built snippet, keeping only its <mark> tags as HTML"""
+    return (str(escape(snippet_html))
+            .replace('&lt;mark&gt;', '<mark>')
+            .replace('&lt;/mark&gt;', '</mark>'))
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import threading
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+
+from metrics import FILE_BYTES, FILE_SECONDS
+
+from .filestore import apply_op, assign_ids, empty_document, file_lock, summarize_penpal, touched_penpals, write_atomic
+
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = 'store.lock'
+SHARD_DIR = 'penpals'
+# Parsed shards kept in memory; exports and searches walk every penpal, so
+# the cache holds only the most recently used ones
+SHARD_CACHE_SIZE = 64
+
+
+def shard_file(name):
+    """File name of a penpal's shard; hashed so any penpal name is a safe file name"""
+    return hashlib.sha256(name.encode('utf-8')).hexdigest()[:32] + '.json'
+
+
+def referenced_penpals(op):
+    """Names of every penpal an op may change, known before it is applied"""
+    if op["op"] == "add_penpal":
+        return {op["name"]}
+    if op["op"] == "import":
+        return ({penpal["name"] for penpal in op["penpals"]} |
+                {record["penpal"] for record in op["letters"] + op["notes"]})
+    return {op["penpal"]}
+
+
+class ShardMap(Mapping):
+    """Read-only ``data["penpals"]`` that loads a penpal's shard when it is looked up"""
+
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+
+    def __getitem__(self, name):
+        entry = self.manifest["penpals"].get(name)
+        if entry is None:
+            raise KeyError(name)
+        return self.store.read_shard(entry["file"])
+
+    def __contains__(self, name):
+        return name in self.manifest["penpals"]
+
+    def __iter__(self):
+        return iter(self.manifest["penpals"])
+
+    def __len__(self):
+        return len(self.manifest["penpals"])
+
+
+class ShardedCache:
+    """The manifest's summaries, plus the penpals themselves loaded on demand.
+
+    Has the attributes of ``filestore.DocumentCache`` that ``FileEngine``
+    reads; ``summaries`` are the manifest entries themselves.
+    """
+
+    def __init__(self, store, manifest):
+        self.manifest = manifest
+        self.summaries = manifest["penpals"]
+        self.total_letters = sum(s["letter_count"] for s in self.summaries.values())
+        self.countries = Counter(s["country"] for s in self.summaries.values())
+        self.data = {"penpals": ShardMap(store, manifest), "next_id": manifest["next_id"]}
+
+
+class ShardedStore:
+    """File storage with one JSON file per penpal.
+
+    ``penpals/<hash>.json`` holds one penpal's letters and notes, and
+    ``manifest.json`` holds each penpal's summary (country, counts, last
+    letter date, version) and shard file name plus the shared id counter.
+    Index, stats and version reads only need the manifest; a penpal page
+    parses that penpal's shard, and a write rewrites that shard and the
+    manifest, so neither depends on the size of the rest of the archive.
+    Only the ``cache_size`` most recently used shards stay parsed in
+    memory, so walking every penpal doesn't hold the whole archive.
+    ``create_engine`` puts the search index in ``index/`` beside the
+    shards; it too has one segment per penpal.
+
+    Every file is replaced atomically (temp file plus ``os.replace``).
+    Writers hold an advisory lock on ``store.lock`` and re-read the manifest
+    and the shards they touch under it, so several worker processes can
+    share one directory. Shards are written before the manifest, which
+    makes the manifest the commit point: a crash in between leaves the
+    manifest describing the previous state, and ``rebuild_summaries``
+    re-derives it from the shards. The file lock is always taken before
+    ``self.lock``.
+
+    Exposes the same interface as ``filestore.JsonDocumentStore``.
+    """
+
+    def __init__(self, directory, seed_path=None, cache_size=SHARD_CACHE_SIZE):
+        self.directory = directory
+        self.seed_path = seed_path
+        self.cache_size = cache_size
+        self.manifest_path = os.path.join(directory, MANIFEST_FILE)
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+        self.shard_dir = os.path.join(directory, SHARD_DIR)
+
+        self.lock = threading.RLock()
+        self._cache = None
+        self._signature = None
+        self._shards = OrderedDict()  # file name -> (signature, penpal), least recently used first
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    # Reading
+
+    def _bootstrap(self):
+        """Create the store directory, splitting the JSON data file into shards.
+
+        Called before taking the file lock or ``self.lock``, so ``cache()``
+        never needs the file lock while a writer in this process holds it.
+        """
+        if os.path.exists(self.manifest_path):
+            return
+        os.makedirs(self.shard_dir, exist_ok=True)
+        with file_lock(self.lock_path):
+            if os.path.exists(self.manifest_path):
+                return
+            data = empty_document()
+            if self.seed_path and os.path.exists(self.seed_path):
+                with open(self.seed_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                assign_ids(data)
+            self._write_document(data)
+
+    def _read_json(self, path, op):
+        with FILE_SECONDS.time(store='sharded', op=op), open(path, 'r', encoding='utf-8') as f:
+            FILE_BYTES.inc(os.fstat(f.fileno()).st_size, store='sharded', op=op)
+            return json.load(f)
+
+    def cache(self):
+        """Return the current ShardedCache, re-reading the manifest only if it changed"""
+        self._bootstrap()
+        with self.lock:
+            signature = self._stat(self.manifest_path)
+            if self._cache is None or signature != self._signature:
+                self._cache = ShardedCache(self, self._read_json(self.manifest_path, 'manifest_load'))
+                self._signature = signature
+            return self._cache
+
+    def load(self):
+        return self.cache().data
+
+    def read_shard(self, file_name):
+        """A penpal's data, re-parsed only if its shard changed since we last read it"""
+        path = os.path.join(self.shard_dir, file_name)
+        with self.lock:
+            signature = self._stat(path)
+            cached = self._shards.get(file_name)
+            if cached is None or cached[0] != signature:
+                shard = self._read_json(path, 'shard_load')
+                cached = (signature, shard["penpal"])
+            self._remember(file_name, cached)
+            return cached[1]
+
+    def _remember(self, file_name, entry):
+        self._shards[file_name] = entry
+        self._shards.move_to_end(file_name)
+        while len(self._shards) > self.cache_size:
+            self._shards.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self._cache = None
+            self._signature = None
+            self._shards.clear()
+
+    # Writing
+
+    def _write_shard(self, file_name, name, penpal):
+        path = os.path.join(self.shard_dir, file_name)
+        with FILE_SECONDS.time(store='sharded', op='shard_save'):
+            size = write_atomic(path, json.dumps({"name": name, "penpal": penpal}, ensure_ascii=False))
+        FILE_BYTES.inc(size, store='sharded', op='shard_save')
+        self._remember(file_name, (self._stat(path), penpal))
+
+    def _write_manifest(self, manifest):
+        with FILE_SECONDS.time(store='sharded', op='manifest_save'):
+            size = write_atomic(self.manifest_path, json.dumps(manifest, ensure_ascii=False))
+        FILE_BYTES.inc(size, store='sharded', op='manifest_save')
+        self._cache = ShardedCache(self, manifest)
+        self._signature = self._stat(self.manifest_path)
+
+    def _write_document(self, data):
+        """Write every penpal's shard and a manifest for them, dropping shards of removed penpals"""
+        os.makedirs(self.shard_dir, exist_ok=True)
+        manifest = {"next_id": data.get("next_id", 1), "penpals": {}}
+        for name, penpal in data["penpals"].items():
+            file_name = shard_file(name)
+            self._write_shard(file_name, name, penpal)
+            manifest["penpals"][name] = dict(summarize_penpal(penpal), file=file_name)
+        self._write_manifest(manifest)
+        kept = {entry["file"] for entry in manifest["penpals"].values()}
+        for file_name in os.listdir(self.shard_dir):
+            if file_name.endswith('.json') and file_name not in kept:
+                os.remove(os.path.join(self.shard_dir, file_name))
+                self._shards.pop(file_name, None)
+
+    def apply(self, op, after=None):
+        """Apply ``op`` to the shards it touches and persist them and the manifest.
+
+        Returns the op's result, or None if it did not apply. If saving fails
+        the caches are dropped so the next read comes from disk again.
+        ``after(data, result)`` is called once the manifest is written, as in
+        ``JsonDocumentStore.apply``; ``data`` holds only the penpals the op
+        could touch.
+        """
+        self._bootstrap()
+        with file_lock(self.lock_path), self.lock:
+            manifest = self.cache().manifest
+            # A private document holding only the penpals this op can touch;
+            # lists are copied so the cached shards are left as they were
+            penpals = {}
+            for name in referenced_penpals(op):
+                entry = manifest["penpals"].get(name)
+                if entry is not None:
+                    penpal = self.read_shard(entry["file"])
+                    penpals[name] = dict(penpal, letters=list(penpal["letters"]), notes=list(penpal["notes"]))
+            data = {"penpals": penpals, "next_id": manifest["next_id"]}
+            result = apply_op(data, op)
+            if result is None:
+                return None
+
+            updated = {"next_id": data["next_id"], "penpals": dict(manifest["penpals"])}
+            try:
+                for name in touched_penpals(op, result):
+                    file_name = shard_file(name)
+                    self._write_shard(file_name, name, data["penpals"][name])
+                    updated["penpals"][name] = dict(summarize_penpal(data["penpals"][name]), file=file_name)
+                self._write_manifest(updated)
+            except Exception:
+                self.invalidate()
+                raise
+            if after:
+                after(data, result)
+            return result
+
+    def replace(self, data):
+        """Save a whole new document"""
+        self._bootstrap()
+        with file_lock(self.lock_path), self.lock:
+            try:
+                self._write_document(data)
+            finally:
+                self.invalidate()
+
+    def rebuild_summaries(self):
+        """Re-derive the manifest from the shard files"""
+        self._bootstrap()
+        with file_lock(self.lock_path), self.lock:
+            next_id = self.cache().manifest["next_id"]
+            manifest = {"next_id": next_id, "penpals": {}}
+            for file_name in sorted(os.listdir(self.shard_dir)):
+                if not file_name.endswith('.json'):
+                    continue
+                shard = self._read_json(os.path.join(self.shard_dir, file_name), 'shard_load')
+                penpal = shard["penpal"]
+                manifest["penpals"][shard["name"]] = dict(summarize_penpal(penpal), file=file_name)
+                ids = [item["id"] for item in penpal["letters"] + penpal["notes"]]
+                manifest["next_id"] = max([manifest["next_id"]] + [i + 1 for i in ids])
+            self._write_manifest(manifest)
+            self._shards.clear()
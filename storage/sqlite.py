@@ -0,0 +1,728 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import DB_CONNECTIONS, timed_statement
+
+from .base import (LETTERS_PAGE_SIZE, SEARCH_PAGE_SIZE, StorageEngine, letters_cursor, parse_letters_cursor,
+                   parse_search_cursor, parse_utc, search_cursor, unavailable_stats)
+from .search_index import highlight_markup, parse_query
+
+# Recomputes summary rows from the base tables; {where} narrows it to
+# penpals that have no row yet. It upserts rather than replacing rows so
+# other columns (the version counter) survive. SQLite needs a WHERE clause
+# before ON CONFLICT in INSERT ... SELECT, hence 'WHERE true' for all rows.
+REBUILD_SUMMARY_SQL = '''
+    INSERT INTO penpal_summary (penpal_id, letter_count, note_count, last_letter)
+    SELECT
+        p.id,
+        (SELECT COUNT(*) FROM letters l WHERE l.penpal_id = p.id),
+        (SELECT COUNT(*) FROM notes n WHERE n.penpal_id = p.id),
+        (SELECT MAX(l.date_received) FROM letters l WHERE l.penpal_id = p.id)
+    FROM penpals p
+    {where}
+    ON CONFLICT (penpal_id) DO UPDATE SET
+        letter_count = excluded.letter_count,
+        note_count = excluded.note_count,
+        last_letter = excluded.last_letter
+'''
+
+# Ordered schema migrations: (version, description, script). Each runs
+# once, recorded in schema_version; scripts use IF NOT EXISTS so databases
+# created before versioning adopt them cleanly. Append new steps, never
+# edit applied ones.
+MIGRATIONS = [
+    (1, "penpals, letters and notes tables", '''
+    CREATE TABLE IF NOT EXISTS penpals (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        country TEXT NOT NULL,
+        created_date TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS letters (
+        id INTEGER PRIMARY KEY,
+        penpal_id INTEGER REFERENCES penpals(id) ON DELETE CASCADE,
+        content TEXT NOT NULL,
+        date_received TEXT NOT NULL,
+        date_added TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS notes (
+        id INTEGER PRIMARY KEY,
+        penpal_id INTEGER REFERENCES penpals(id) ON DELETE CASCADE,
+        note TEXT NOT NULL,
+        date_added TEXT NOT NULL
+    );
+'''),
+    (2, "FTS5 letter index and sync triggers", '''
+    -- FTS5 index over letters.content, kept in sync by triggers
+    CREATE VIRTUAL TABLE IF NOT EXISTS letters_fts USING fts5(
+        content, content='letters', content_rowid='id', tokenize='porter unicode61'
+    );
+    CREATE TRIGGER IF NOT EXISTS letters_fts_insert AFTER INSERT ON letters BEGIN
+        INSERT INTO letters_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS letters_fts_delete AFTER DELETE ON letters BEGIN
+        INSERT INTO letters_fts (letters_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS letters_fts_update AFTER UPDATE OF content ON letters BEGIN
+        INSERT INTO letters_fts (letters_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO letters_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+    -- Index letters stored before the FTS table existed
+    INSERT INTO letters_fts (letters_fts) VALUES ('rebuild');
+'''),
+    (3, "per-penpal indexes on letters and notes", '''
+    -- Serves the keyset-paginated letter archive (replaces letters_penpal_received_idx)
+    DROP INDEX IF EXISTS letters_penpal_received_idx;
+    CREATE INDEX IF NOT EXISTS letters_penpal_page_idx ON letters (penpal_id, date_received DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS notes_penpal_added_idx ON notes (penpal_id, date_added);
+'''),
+    (4, "penpal_summary table and triggers", '''
+    -- One row per penpal with counts and latest letter date, kept current
+    -- by triggers in the same transaction as each write
+    CREATE TABLE IF NOT EXISTS penpal_summary (
+        penpal_id INTEGER PRIMARY KEY REFERENCES penpals(id) ON DELETE CASCADE,
+        letter_count INTEGER NOT NULL DEFAULT 0,
+        note_count INTEGER NOT NULL DEFAULT 0,
+        last_letter TEXT
+    );
+    CREATE TRIGGER IF NOT EXISTS penpal_summary_penpal_insert AFTER INSERT ON penpals BEGIN
+        INSERT OR IGNORE INTO penpal_summary (penpal_id) VALUES (new.id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS penpal_summary_letter_insert AFTER INSERT ON letters BEGIN
+        UPDATE penpal_summary
+        SET letter_count = letter_count + 1,
+            last_letter = CASE WHEN last_letter IS NULL OR new.date_received > last_letter
+                               THEN new.date_received ELSE last_letter END
+        WHERE penpal_id = new.penpal_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS penpal_summary_letter_delete AFTER DELETE ON letters BEGIN
+        UPDATE penpal_summary
+        SET letter_count = letter_count - 1,
+            last_letter = (SELECT MAX(date_received) FROM letters WHERE penpal_id = old.penpal_id)
+        WHERE penpal_id = old.penpal_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS penpal_summary_letter_update AFTER UPDATE OF date_received ON letters BEGIN
+        UPDATE penpal_summary
+        SET last_letter = (SELECT MAX(date_received) FROM letters WHERE penpal_id = new.penpal_id)
+        WHERE penpal_id = new.penpal_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS penpal_summary_note_insert AFTER INSERT ON notes BEGIN
+        UPDATE penpal_summary SET note_count = note_count + 1 WHERE penpal_id = new.penpal_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS penpal_summary_note_delete AFTER DELETE ON notes BEGIN
+        UPDATE penpal_summary SET note_count = note_count - 1 WHERE penpal_id = old.penpal_id;
+    END;
+''' + REBUILD_SUMMARY_SQL.format(
+        # Fill in rows for penpals created before the summary existed
+        where="WHERE NOT EXISTS (SELECT 1 FROM penpal_summary s WHERE s.penpal_id = p.id)"
+    )),
+    (5, "per-penpal version counter for conditional requests", '''
+    -- Every letter or note write bumps its penpal's version, which the web
+    -- layer turns into ETags without reading the letters themselves.
+    -- updated_at is UTC.
+    ALTER TABLE penpal_summary ADD COLUMN version INTEGER NOT NULL DEFAULT 1;
+    ALTER TABLE penpal_summary ADD COLUMN updated_at TEXT;
+    UPDATE penpal_summary SET updated_at = strftime('%Y-%m-%dT%H:%M:%f', 'now');
+    CREATE TRIGGER IF NOT EXISTS penpal_version_summary_insert AFTER INSERT ON penpal_summary BEGIN
+        UPDATE penpal_summary SET updated_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE penpal_id = new.penpal_id;
+    END;
+''' + ''.join(f'''
+    CREATE TRIGGER IF NOT EXISTS penpal_version_{table}_{event} AFTER {event.upper()} ON {table} BEGIN
+        UPDATE penpal_summary
+        SET version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE penpal_id = {'old' if event == 'delete' else 'new'}.penpal_id;
+    END;
+''' for table in ('letters', 'notes') for event in ('insert', 'update', 'delete'))),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Statements are kept as module constants so sqlite3's per-connection
+# statement cache always gets a hit and never re-prepares them.
+PENPAL_ID_SQL = "SELECT id FROM penpals WHERE name = ?"
+LETTERS_PAGE_SQL = '''
+    SELECT id, content, date_received, date_added
+    FROM letters
+    WHERE penpal_id = :penpal_id
+      AND (:after_id IS NULL OR (date_received, id) < (:after_date, :after_id))
+    ORDER BY date_received DESC, id DESC
+    LIMIT :limit
+'''
+SEARCH_SQL = '''
+    SELECT
+        l.id,
+        letters_fts.rank,
+        p.name,
+        p.country,
+        l.date_received,
+        l.date_added,
+        snippet(letters_fts, 0, '<mark>', '</mark>', '...', 32),
+        (SELECT COUNT(*) FROM letters_fts WHERE letters_fts MATCH :query)
+    FROM letters_fts
+    JOIN letters l ON l.id = letters_fts.rowid
+    JOIN penpals p ON p.id = l.penpal_id
+    WHERE letters_fts MATCH :query
+      AND (:after_id IS NULL
+           OR letters_fts.rank > :after_rank
+           OR (letters_fts.rank = :after_rank AND l.id < :after_id))
+    ORDER BY letters_fts.rank, l.id DESC
+    LIMIT :limit
+'''
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that records each statement's latency in metrics"""
+
+    def execute(self, sql, parameters=()):
+        with timed_statement('sqlite', sql):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        with timed_statement('sqlite', sql):
+            return super().executemany(sql, parameters)
+
+
+def split_statements(script):
+    """Split a SQL script into statements (trigger bodies stay whole)"""
+    statements, buffer = [], ''
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ''
+    if buffer.strip():
+        statements.append(buffer.strip())
+    return statements
+
+
+def fts_query(query):
+    """Translate a user query into FTS5 syntax: every term and quoted phrase must match"""
+    return ' '.join('"' + ' '.join(phrase) + '"' for phrase in parse_query(query))
+
+
+class SQLiteEngine(StorageEngine):
+    """Single-file SQLite storage in WAL mode.
+
+    WAL lets readers proceed while a write is in progress, so several
+    threads or worker processes can share the database. Each thread keeps
+    its own connection.
+    """
+
+    name = 'SQLite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, cached_statements=256, factory=TimedConnection)
+            DB_CONNECTIONS.inc(engine='sqlite')
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Yield this thread's connection, rolling back on error"""
+        self.ensure_schema()
+        conn = self._connect()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+
+    def schema_version(self, conn):
+        """Highest applied migration, or 0 before the first one"""
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+        ).fetchone()
+        if not exists:
+            return 0
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    def init_schema(self):
+        """Apply any pending migrations.
+
+        A process that finds the schema current issues no DDL. Otherwise the
+        pending steps run in one IMMEDIATE transaction, which holds SQLite's
+        write lock so concurrent starts apply each migration exactly once.
+        """
+        try:
+            with self.connection() as conn:
+                if self.schema_version(conn) >= SCHEMA_VERSION:
+                    return True
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TEXT NOT NULL
+                    )
+                ''')
+                # Re-read under the lock: another process may have migrated
+                current = self.schema_version(conn)
+                for version, description, script in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for statement in split_statements(script):
+                        conn.execute(statement)
+                    conn.execute(
+                        "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                        (version, description, datetime.now().isoformat())
+                    )
+                    print(f"Applied migration {version}: {description}")
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"Error initializing database: {e}")
+            return False
+
+    def _penpal_id(self, conn, penpal_name):
+        row = conn.execute(PENPAL_ID_SQL, (penpal_name,)).fetchone()
+        return row[0] if row else None
+
+    def add_penpal(self, name, country):
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    "INSERT INTO penpals (name, country, created_date) VALUES (?, ?, ?)",
+                    (name, country, datetime.now().isoformat())
+                )
+                conn.commit()
+                print(f"Added penpal {name} from {country}")
+                return True
+        except sqlite3.IntegrityError:
+            print(f"Penpal {name} already exists")
+            return False
+        except Exception as e:
+            print(f"Error adding penpal: {e}")
+            return False
+
+    def add_letter(self, penpal_name, content, date_received=None):
+        if date_received is None:
+            date_received = datetime.now().isoformat()
+        try:
+            with self.connection() as conn:
+                penpal_id = self._penpal_id(conn, penpal_name)
+                if penpal_id is None:
+                    print(f"Penpal {penpal_name} not found")
+                    return False
+                conn.execute(
+                    "INSERT INTO letters (penpal_id, content, date_received, date_added) VALUES (?, ?, ?, ?)",
+                    (penpal_id, content, date_received, datetime.now().isoformat())
+                )
+                conn.commit()
+                print(f"Added letter for {penpal_name}")
+                return True
+        except Exception as e:
+            print(f"Error adding letter: {e}")
+            return False
+
+    def get_letter(self, penpal_name, letter_id):
+        try:
+            with self.connection() as conn:
+                row = conn.execute(
+                    "SELECT id, content, date_received, date_added FROM letters "
+                    "WHERE id = ? AND penpal_id = (SELECT id FROM penpals WHERE name = ?)",
+                    (letter_id, penpal_name)
+                ).fetchone()
+            if not row:
+                return None
+            return {"id": row[0], "content": row[1], "date_received": row[2], "date_added": row[3]}
+        except Exception as e:
+            print(f"Error getting letter: {e}")
+            return None
+
+    def delete_letter(self, penpal_name, letter_id):
+        try:
+            with self.connection() as conn:
+                cur = conn.execute(
+                    "DELETE FROM letters WHERE id = ? AND penpal_id = (SELECT id FROM penpals WHERE name = ?)",
+                    (letter_id, penpal_name)
+                )
+                conn.commit()
+                return cur.rowcount == 1
+        except Exception as e:
+            print(f"Error deleting letter: {e}")
+            return False
+
+    def update_letter(self, penpal_name, letter_id, content=None, date_received=None):
+        try:
+            with self.connection() as conn:
+                cur = conn.execute(
+                    "UPDATE letters SET content = COALESCE(?, content), date_received = COALESCE(?, date_received) "
+                    "WHERE id = ? AND penpal_id = (SELECT id FROM penpals WHERE name = ?)",
+                    (content, date_received, letter_id, penpal_name)
+                )
+                conn.commit()
+                return cur.rowcount == 1
+        except Exception as e:
+            print(f"Error updating letter: {e}")
+            return False
+
+    def add_note(self, penpal_name, note):
+        try:
+            with self.connection() as conn:
+                penpal_id = self._penpal_id(conn, penpal_name)
+                if penpal_id is None:
+                    print(f"Penpal {penpal_name} not found")
+                    return False
+                conn.execute(
+                    "INSERT INTO notes (penpal_id, note, date_added) VALUES (?, ?, ?)",
+                    (penpal_id, note, datetime.now().isoformat())
+                )
+                conn.commit()
+                print(f"Added note for {penpal_name}: {note[:50]}...")
+                return True
+        except Exception as e:
+            print(f"Error adding note: {e}")
+            return False
+
+    def add_notes(self, penpal_name, notes):
+        try:
+            with self.connection() as conn:
+                penpal_id = self._penpal_id(conn, penpal_name)
+                if penpal_id is None:
+                    print(f"Penpal {penpal_name} not found")
+                    return False
+                now = datetime.now().isoformat()
+                conn.executemany(
+                    "INSERT INTO notes (penpal_id, note, date_added) VALUES (?, ?, ?)",
+                    [(penpal_id, note, now) for note in notes]
+                )
+                conn.commit()
+                print(f"Added {len(notes)} notes for {penpal_name}")
+                return True
+        except Exception as e:
+            print(f"Error adding notes: {e}")
+            return False
+
+    def delete_note(self, penpal_name, note_id):
+        try:
+            with self.connection() as conn:
+                cur = conn.execute(
+                    "DELETE FROM notes WHERE id = ? AND penpal_id = (SELECT id FROM penpals WHERE name = ?)",
+                    (note_id, penpal_name)
+                )
+                conn.commit()
+                if cur.rowcount != 1:
+                    print(f"Note {note_id} not found for {penpal_name}")
+                    return False
+                print(f"Deleted note {note_id} for {penpal_name}")
+                return True
+        except Exception as e:
+            print(f"Error deleting note: {e}")
+            return False
+
+    def update_note(self, penpal_name, note_id, note):
+        try:
+            with self.connection() as conn:
+                cur = conn.execute(
+                    "UPDATE notes SET note = ? WHERE id = ? AND penpal_id = (SELECT id FROM penpals WHERE name = ?)",
+                    (note, note_id, penpal_name)
+                )
+                conn.commit()
+                return cur.rowcount == 1
+        except Exception as e:
+            print(f"Error updating note: {e}")
+            return False
+
+    def import_batch(self, penpals, letters, notes):
+        try:
+            with self.connection() as conn:
+                cur = conn.executemany(
+                    "INSERT OR IGNORE INTO penpals (name, country, created_date) VALUES (?, ?, ?)",
+                    [(p["name"], p["country"], p["created_date"]) for p in penpals]
+                )
+                added_penpals = max(cur.rowcount, 0)
+                ids = dict(conn.execute("SELECT name, id FROM penpals"))
+                letter_rows = [(ids[l["penpal"]], l["content"], l["date_received"], l["date_added"])
+                               for l in letters if l["penpal"] in ids]
+                note_rows = [(ids[n["penpal"]], n["note"], n["date_added"])
+                             for n in notes if n["penpal"] in ids]
+                conn.executemany(
+                    "INSERT INTO letters (penpal_id, content, date_received, date_added) VALUES (?, ?, ?, ?)",
+                    letter_rows
+                )
+                conn.executemany(
+                    "INSERT INTO notes (penpal_id, note, date_added) VALUES (?, ?, ?)",
+                    note_rows
+                )
+                conn.commit()
+                return {"penpals": added_penpals, "letters": len(letter_rows), "notes": len(note_rows)}
+        except Exception as e:
+            print(f"Error importing batch: {e}")
+            return None
+
+    def get_penpal(self, name):
+        try:
+            with self.connection() as conn:
+                row = conn.execute(
+                    "SELECT id, name, country, created_date FROM penpals WHERE name = ?",
+                    (name,)
+                ).fetchone()
+                if not row:
+                    return None
+                penpal_id, penpal_name, country, created_date = row
+
+                letters = [
+                    {"id": letter_id, "content": content, "date_received": date_received, "date_added": date_added}
+                    for letter_id, content, date_received, date_added in conn.execute(
+                        "SELECT id, content, date_received, date_added FROM letters "
+                        "WHERE penpal_id = ? ORDER BY date_received DESC, id DESC",
+                        (penpal_id,)
+                    )
+                ]
+                notes = [
+                    {"id": note_id, "note": note, "date_added": date_added}
+                    for note_id, note, date_added in conn.execute(
+                        "SELECT id, note, date_added FROM notes WHERE penpal_id = ? ORDER BY date_added, id",
+                        (penpal_id,)
+                    )
+                ]
+                return {
+                    "name": penpal_name,
+                    "country": country,
+                    "letters": letters,
+                    "notes": notes,
+                    "created_date": created_date
+                }
+        except Exception as e:
+            print(f"Error getting penpal: {e}")
+            return None
+
+    def get_penpal_header(self, name):
+        try:
+            with self.connection() as conn:
+                row = conn.execute('''
+                    SELECT p.id, p.name, p.country, p.created_date, COALESCE(s.letter_count, 0)
+                    FROM penpals p LEFT JOIN penpal_summary s ON s.penpal_id = p.id
+                    WHERE p.name = ?
+                ''', (name,)).fetchone()
+                if not row:
+                    return None
+                penpal_id, penpal_name, country, created_date, letter_count = row
+                notes = [
+                    {"id": note_id, "note": note, "date_added": date_added}
+                    for note_id, note, date_added in conn.execute(
+                        "SELECT id, note, date_added FROM notes WHERE penpal_id = ? ORDER BY date_added, id",
+                        (penpal_id,)
+                    )
+                ]
+                return {
+                    "name": penpal_name,
+                    "country": country,
+                    "notes": notes,
+                    "created_date": created_date,
+                    "letter_count": letter_count
+                }
+        except Exception as e:
+            print(f"Error getting penpal: {e}")
+            return None
+
+    def get_letters_page(self, penpal_name, limit=LETTERS_PAGE_SIZE, cursor=None):
+        empty = {"letters": [], "next_cursor": None}
+        after = (None, None)
+        if cursor:
+            after = parse_letters_cursor(cursor)
+            if after is None:
+                return empty
+
+        try:
+            with self.connection() as conn:
+                penpal_id = self._penpal_id(conn, penpal_name)
+                if penpal_id is None:
+                    return empty
+                rows = conn.execute(LETTERS_PAGE_SQL, {
+                    "penpal_id": penpal_id,
+                    "after_date": after[0],
+                    "after_id": after[1],
+                    "limit": (limit + 1) if limit else -1,
+                }).fetchall()
+        except Exception as e:
+            print(f"Error getting letters: {e}")
+            return empty
+
+        letters = [
+            {"id": letter_id, "content": content, "date_received": date_received, "date_added": date_added}
+            for letter_id, content, date_received, date_added in rows
+        ]
+        next_cursor = None
+        if limit and len(letters) > limit:
+            letters = letters[:limit]
+            next_cursor = letters_cursor(letters[-1])
+        return {"letters": letters, "next_cursor": next_cursor}
+
+    def get_notes(self, penpal_name):
+        try:
+            with self.connection() as conn:
+                penpal_id = self._penpal_id(conn, penpal_name)
+                if penpal_id is None:
+                    return None
+                return [
+                    {"id": note_id, "note": note, "date_added": date_added}
+                    for note_id, note, date_added in conn.execute(
+                        "SELECT id, note, date_added FROM notes WHERE penpal_id = ? ORDER BY date_added, id",
+                        (penpal_id,)
+                    )
+                ]
+        except Exception as e:
+            print(f"Error getting notes: {e}")
+            return []
+
+    def get_versions(self, penpal_name=None):
+        where, params = ("WHERE p.name = ?", (penpal_name,)) if penpal_name else ("", ())
+        try:
+            with self.connection() as conn:
+                return {
+                    name: {"version": version, "updated_at": parse_utc(updated_at)}
+                    for name, version, updated_at in conn.execute(
+                        "SELECT p.name, s.version, s.updated_at "
+                        f"FROM penpals p JOIN penpal_summary s ON s.penpal_id = p.id {where}", params
+                    )
+                }
+        except Exception as e:
+            print(f"Error getting penpal versions: {e}")
+            return {}
+
+    def rebuild_penpal_summary(self):
+        try:
+            with self.connection() as conn:
+                rebuilt = conn.execute(REBUILD_SUMMARY_SQL.format(where='WHERE true')).rowcount
+                # Counts may have changed, so cached representations are stale
+                conn.execute(
+                    "UPDATE penpal_summary SET version = version + 1, "
+                    "updated_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+                )
+                conn.commit()
+                return rebuilt
+        except Exception as e:
+            print(f"Error rebuilding penpal summary: {e}")
+            return False
+
+    def get_all_penpals(self):
+        try:
+            with self.connection() as conn:
+                rows = conn.execute('''
+                    SELECT
+                        p.name,
+                        p.country,
+                        COALESCE(s.letter_count, 0),
+                        COALESCE(s.note_count, 0),
+                        s.last_letter
+                    FROM penpals p
+                    LEFT JOIN penpal_summary s ON s.penpal_id = p.id
+                    ORDER BY s.last_letter IS NULL, s.last_letter DESC
+                ''').fetchall()
+            return [
+                {
+                    "name": name,
+                    "country": country,
+                    "letter_count": letter_count,
+                    "note_count": note_count,
+                    "last_letter": last_letter
+                }
+                for name, country, letter_count, note_count, last_letter in rows
+            ]
+        except Exception as e:
+            print(f"Error getting all penpals: {e}")
+            return []
+
+    def iter_records(self, penpal_name=None):
+        """Stream export records straight off SQLite cursors"""
+        where, params = ("WHERE p.name = ?", (penpal_name,)) if penpal_name else ("", ())
+        with self.connection() as conn:
+            for name, country, created_date in conn.execute(
+                f"SELECT name, country, created_date FROM penpals p {where} ORDER BY name", params
+            ):
+                yield {"type": "penpal", "name": name, "country": country, "created_date": created_date}
+            for name, letter_id, content, date_received, date_added in conn.execute(
+                "SELECT p.name, l.id, l.content, l.date_received, l.date_added "
+                f"FROM letters l JOIN penpals p ON p.id = l.penpal_id {where} "
+                "ORDER BY p.name, l.date_received, l.id", params
+            ):
+                yield {"type": "letter", "penpal": name, "id": letter_id, "content": content,
+                       "date_received": date_received, "date_added": date_added}
+            for name, note_id, note, date_added in conn.execute(
+                "SELECT p.name, n.id, n.note, n.date_added "
+                f"FROM notes n JOIN penpals p ON p.id = n.penpal_id {where} "
+                "ORDER BY p.name, n.date_added, n.id", params
+            ):
+                yield {"type": "note", "penpal": name, "id": note_id, "note": note, "date_added": date_added}
+
+    def search_letters_page(self, query, limit=SEARCH_PAGE_SIZE, cursor=None):
+        match = fts_query(query)
+        if not match:
+            return {"results": [], "next_cursor": None, "total": 0}
+        empty = {"results": [], "next_cursor": None, "total": None}
+
+        # Keyset cursor on (bm25 rank, id); lower bm25 ranks are better, so
+        # the cursor carries the negated rank that results report
+        after_rank, after_id = None, None
+        if cursor:
+            after = parse_search_cursor(cursor)
+            if after is None:
+                return empty
+            after_rank, after_id = -after[0], after[1]
+
+        try:
+            with self.connection() as conn:
+                rows = conn.execute(SEARCH_SQL, {
+                    "query": match,
+                    "after_rank": after_rank,
+                    "after_id": after_id,
+                    "limit": (limit + 1) if limit else -1,
+                }).fetchall()
+        except Exception as e:
+            print(f"Error searching letters: {e}")
+            return empty
+
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = search_cursor(-rows[-1][1], rows[-1][0])
+
+        results = []
+        for letter_id, rank, name, country, date_received, date_added, headline, _ in rows:
+            results.append({
+                "penpal_name": name,
+                "country": country,
+                "letter": {
+                    "id": letter_id,
+                    "date_received": date_received,
+                    "date_added": date_added
+                },
+                "rank": -rank,
+                "preview": highlight_markup(headline)
+            })
+        total = rows[0][7] if rows else (None if cursor else 0)
+        return {"results": results, "next_cursor": next_cursor, "total": total}
+
+    def get_stats(self):
+        try:
+            with self.connection() as conn:
+                total_penpals = conn.execute("SELECT COUNT(*) FROM penpals").fetchone()[0]
+                total_letters = conn.execute(
+                    "SELECT COALESCE(SUM(letter_count), 0) FROM penpal_summary"
+                ).fetchone()[0]
+                countries = [row[0] for row in conn.execute(
+                    "SELECT DISTINCT country FROM penpals ORDER BY country"
+                )]
+            return {
+                "total_penpals": total_penpals,
+                "total_letters": total_letters,
+                "countries": len(countries),
+                "country_list": countries
+            }
+        except Exception as e:
+            print(f"Error getting stats: {e}")
+            return unavailable_stats()
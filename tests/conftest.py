@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import STORE_INDEX_DIR  # noqa: E402
+from storage.files import FileEngine  # noqa: E402
+from storage.filestore import JsonDocumentStore  # noqa: E402
+from storage.journal import JournalStore  # noqa: E402
+from storage.sharded import ShardedStore  # noqa: E402
+from storage.sqlite import SQLiteEngine  # noqa: E402
+
+ENGINES = ('sqlite', 'json', 'journal', 'sharded')
+
+
+def make_engine(kind, directory):
+    """A fresh engine of ``kind`` keeping all its files under ``directory``"""
+    directory = str(directory)
+    os.makedirs(directory, exist_ok=True)
+    if kind == 'sqlite':
+        return SQLiteEngine(os.path.join(directory, 'letters.db'))
+    if kind == 'json':
+        return FileEngine(JsonDocumentStore(os.path.join(directory, 'letters_data.json')),
+                          os.path.join(directory, 'letters_index'))
+    if kind == 'journal':
+        # fsync on every append so no maintenance thread outlives the test
+        store = JournalStore(os.path.join(directory, 'letters_journal'), fsync_interval=0)
+        return FileEngine(store, os.path.join(directory, 'letters_journal', STORE_INDEX_DIR))
+    if kind == 'sharded':
+        return FileEngine(ShardedStore(os.path.join(directory, 'letters_shards')),
+                          os.path.join(directory, 'letters_shards', STORE_INDEX_DIR))
+    raise ValueError(kind)
+
+
+@pytest.fixture(autouse=True)
+def schema_cache(tmp_path, monkeypatch):
+    """Keep the per-host schema version cache out of the real temp dir"""
+    monkeypatch.setenv('LETTERS_SCHEMA_CACHE_DIR', str(tmp_path))
+
+
+@pytest.fixture(params=ENGINES)
+def engine_kind(request):
+    return request.param
+
+
+@pytest.fixture
+def engine(engine_kind, tmp_path):
+    return make_engine(engine_kind, tmp_path)
@@ -0,0 +1,35 @@
+"""Backfill checkpoints: appended per batch and reloaded on resume"""
+import json
+
+from backfill import Checkpoint
+
+
+def test_keys_are_appended_and_reloaded(tmp_path):
+    path = str(tmp_path / 'checkpoint.log')
+    checkpoint = Checkpoint(path)
+    checkpoint.add(['a', 'b'])
+    checkpoint.add(iter(['b', 'c']))
+    checkpoint.close()
+    with open(path, encoding='utf-8') as f:
+        assert f.read() == 'a\nb\nc\n'
+    assert Checkpoint(path).done == {'a', 'b', 'c'}
+
+
+def test_torn_line_is_dropped(tmp_path):
+    path = tmp_path / 'checkpoint.log'
+    path.write_text('a\nb\nhalf-writ', encoding='utf-8')
+    checkpoint = Checkpoint(str(path))
+    assert checkpoint.done == {'a', 'b'}
+    checkpoint.add(['c'])
+    checkpoint.close()
+    assert path.read_text(encoding='utf-8') == 'a\nb\nc\n'
+
+
+def test_older_json_checkpoint_is_converted(tmp_path):
+    path = tmp_path / 'checkpoint.json'
+    path.write_text(json.dumps({"done": ["b", "a"]}), encoding='utf-8')
+    checkpoint = Checkpoint(str(path))
+    assert checkpoint.done == {'a', 'b'}
+    checkpoint.add(['c'])
+    checkpoint.close()
+    assert Checkpoint(str(path)).done == {'a', 'b', 'c'}
@@ -0,0 +1,190 @@
+"""The StorageEngine contract, checked against every backend that runs without a server"""
+from conftest import make_engine
+
+
+def add_penpal_with_letters(engine, name, letters, country='France'):
+    assert engine.add_penpal(name, country)
+    for content, date_received in letters:
+        assert engine.add_letter(name, content, date_received)
+
+
+def test_add_and_read_penpal(engine):
+    assert engine.add_penpal('Ana', 'Brazil')
+    assert not engine.add_penpal('Ana', 'Brazil')
+    assert engine.add_letter('Ana', 'Greetings from Recife', '2024-03-01')
+    assert not engine.add_letter('Nobody', 'Lost letter', '2024-03-01')
+
+    penpal = engine.get_penpal('Ana')
+    assert penpal['name'] == 'Ana'
+    assert penpal['country'] == 'Brazil'
+    assert [letter['content'] for letter in penpal['letters']] == ['Greetings from Recife']
+    assert engine.get_penpal('Nobody') is None
+
+    letter_id = penpal['letters'][0]['id']
+    assert engine.get_letter('Ana', letter_id)['date_received'] == '2024-03-01'
+    assert engine.get_letter('Ana', letter_id + 1000) is None
+
+
+def test_update_and_delete_letter(engine):
+    add_penpal_with_letters(engine, 'Ana', [('First draft', '2024-03-01')])
+    letter_id = engine.get_penpal('Ana')['letters'][0]['id']
+
+    assert engine.update_letter('Ana', letter_id, content='Second draft')
+    letter = engine.get_letter('Ana', letter_id)
+    assert letter['content'] == 'Second draft'
+    assert letter['date_received'] == '2024-03-01'
+
+    assert engine.update_letter('Ana', letter_id, date_received='2024-04-02')
+    assert engine.get_letter('Ana', letter_id)['date_received'] == '2024-04-02'
+
+    assert engine.delete_letter('Ana', letter_id)
+    assert not engine.delete_letter('Ana', letter_id)
+    assert engine.get_penpal('Ana')['letters'] == []
+
+
+def test_notes(engine):
+    engine.add_penpal('Ana', 'Brazil')
+    assert engine.add_note('Ana', 'Loves tea')
+    assert engine.add_notes('Ana', ['Has a cat', 'Plays chess'])
+    notes = engine.get_notes('Ana')
+    assert [note['note'] for note in notes] == ['Loves tea', 'Has a cat', 'Plays chess']
+
+    assert engine.update_note('Ana', notes[0]['id'], 'Loves green tea')
+    assert engine.delete_note('Ana', notes[1]['id'])
+    assert not engine.delete_note('Ana', notes[1]['id'])
+    assert [note['note'] for note in engine.get_notes('Ana')] == ['Loves green tea', 'Plays chess']
+
+
+def test_index_and_stats(engine):
+    add_penpal_with_letters(engine, 'Ana', [('One', '2024-01-01'), ('Two', '2024-02-01')], 'Brazil')
+    add_penpal_with_letters(engine, 'Ben', [('Three', '2024-01-15')], 'Canada')
+
+    penpals = {penpal['name']: penpal for penpal in engine.get_all_penpals()}
+    assert penpals['Ana']['letter_count'] == 2
+    assert penpals['Ana']['last_letter'] == '2024-02-01'
+    assert penpals['Ben']['country'] == 'Canada'
+
+    stats = engine.get_stats()
+    assert stats['total_penpals'] == 2
+    assert stats['total_letters'] == 3
+    assert stats['countries'] == 2
+    assert sorted(stats['country_list']) == ['Brazil', 'Canada']
+
+
+def test_letters_page_is_newest_first(engine):
+    add_penpal_with_letters(engine, 'Ana', [(f'Letter {day}', f'2024-01-{day:02d}') for day in range(1, 8)])
+
+    seen, cursor = [], None
+    while True:
+        page = engine.get_letters_page('Ana', limit=3, cursor=cursor)
+        seen += [letter['date_received'] for letter in page['letters']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == [f'2024-01-{day:02d}' for day in range(7, 0, -1)]
+
+    header = engine.get_penpal_page('Ana', limit=3)
+    assert header['letter_count'] == 7
+    assert len(header['letters']) == 3
+
+
+def test_versions_bump_on_writes(engine):
+    engine.add_penpal('Ana', 'Brazil')
+    engine.add_penpal('Ben', 'Canada')
+    before = engine.get_versions()
+
+    engine.add_letter('Ana', 'Hello', '2024-01-01')
+    after = engine.get_versions()
+    assert after['Ana']['version'] > before['Ana']['version']
+    assert after['Ben']['version'] == before['Ben']['version']
+    assert after['Ana']['updated_at'].tzinfo is not None
+    assert set(engine.get_versions('Ben')) == {'Ben'}
+
+
+def test_search_pages_through_every_match(engine):
+    add_penpal_with_letters(engine, 'Ana', [
+        ('We drank tea by the river', '2024-01-01'),
+        ('More tea, and then more tea again', '2024-01-02'),
+        ('The weather was cold', '2024-01-03'),
+    ])
+    add_penpal_with_letters(engine, 'Ben', [
+        ('Tea in Canada is different', '2024-02-01'),
+        ('I prefer coffee to tea', '2024-02-02'),
+    ], 'Canada')
+
+    first = engine.search_letters_page('tea', limit=2)
+    assert first['total'] == 4
+    result = first['results'][0]
+    assert set(result) == {'penpal_name', 'country', 'letter', 'rank', 'preview'}
+    assert set(result['letter']) == {'id', 'date_received', 'date_added'}
+    assert '<mark>' in result['preview']
+
+    ids, page = [], first
+    while True:
+        ids += [result['letter']['id'] for result in page['results']]
+        if page['next_cursor'] is None:
+            break
+        page = engine.search_letters_page('tea', limit=2, cursor=page['next_cursor'])
+    assert len(ids) == len(set(ids)) == 4
+
+    ranks = [result['rank'] for result in first['results']]
+    assert ranks == sorted(ranks, reverse=True)
+    assert engine.search_letters_page('nothing-matches-this')['results'] == []
+
+
+def test_search_sees_updates_and_deletes(engine):
+    add_penpal_with_letters(engine, 'Ana', [('A letter about penguins', '2024-01-01')])
+    letter_id = engine.get_penpal('Ana')['letters'][0]['id']
+    assert engine.search_letters_page('penguins')['total'] == 1
+
+    engine.update_letter('Ana', letter_id, content='A letter about puffins')
+    assert engine.search_letters_page('penguins')['results'] == []
+    assert engine.search_letters_page('puffins')['total'] == 1
+
+    engine.delete_letter('Ana', letter_id)
+    assert engine.search_letters_page('puffins')['results'] == []
+
+
+def test_import_batch(engine):
+    engine.add_penpal('Ana', 'Brazil')
+    written = engine.import_batch(
+        [{"name": "Ana", "country": "Elsewhere", "created_date": "2024-01-01"},
+         {"name": "Ben", "country": "Canada", "created_date": "2024-01-01"}],
+        [{"penpal": "Ben", "content": "Imported hello", "date_received": "2024-01-02",
+          "date_added": "2024-01-02"}],
+        [{"penpal": "Ana", "note": "Imported note", "date_added": "2024-01-02"}],
+    )
+    assert written == {"penpals": 1, "letters": 1, "notes": 1}
+    assert engine.get_penpal('Ana')['country'] == 'Brazil'
+    assert [letter['content'] for letter in engine.get_penpal('Ben')['letters']] == ['Imported hello']
+    assert engine.search_letters_page('imported')['total'] == 1
+
+
+def test_iter_records(engine):
+    add_penpal_with_letters(engine, 'Ana', [('Hello', '2024-01-01')])
+    engine.add_note('Ana', 'Loves tea')
+
+    records = list(engine.iter_records())
+    assert [record['type'] for record in records] == ['penpal', 'letter', 'note']
+    assert records[1]['penpal'] == 'Ana'
+    assert records[1]['content'] == 'Hello'
+    assert list(engine.iter_records('Nobody')) == []
+
+
+def test_data_survives_a_new_engine(engine_kind, tmp_path):
+    engine = make_engine(engine_kind, tmp_path)
+    add_penpal_with_letters(engine, 'Ana', [('Kept on disk', '2024-01-01')])
+    engine.add_note('Ana', 'Loves tea')
+
+    reopened = make_engine(engine_kind, tmp_path)
+    penpal = reopened.get_penpal('Ana')
+    assert [letter['content'] for letter in penpal['letters']] == ['Kept on disk']
+    assert [note['note'] for note in penpal['notes']] == ['Loves tea']
+    assert reopened.search_letters_page('disk')['total'] == 1
+    assert reopened.get_versions() == engine.get_versions()
+
+
+def test_rebuild_penpal_summary(engine):
+    add_penpal_with_letters(engine, 'Ana', [('One', '2024-01-01'), ('Two', '2024-01-02')])
+    assert engine.rebuild_penpal_summary() == 1
+    assert engine.get_all_penpals()[0]['letter_count'] == 2
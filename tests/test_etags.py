@@ -0,0 +1,115 @@
+"""Conditional GETs: ETags follow penpal versions and matching requests get a 304"""
+import pytest
+
+from conftest import make_engine
+from letters import LetterManager
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    import main
+    manager = LetterManager(make_engine('sqlite', tmp_path))
+    monkeypatch.setattr(main, 'letter_manager', manager)
+    manager.add_penpal('Ana', 'Brazil')
+    manager.add_penpal('Ben', 'Canada')
+    manager.add_letter('Ana', 'Hello from Recife', '2024-01-02')
+    return manager
+
+
+@pytest.fixture
+def client(manager):
+    import main
+    return main.app.test_client()
+
+
+def test_matching_etag_gets_304(client):
+    first = client.get('/api/v1/penpals/Ana')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert first.headers['Cache-Control'] == 'private, no-cache'
+
+    cached = client.get('/api/v1/penpals/Ana', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+    assert cached.headers['ETag'] == etag
+
+    # Validators are compared strongly
+    weak = client.get('/api/v1/penpals/Ana', headers={'If-None-Match': f'W/{etag}'})
+    assert weak.status_code == 200
+
+
+def test_compressed_copy_has_its_own_strong_etag(client, manager):
+    for day in range(1, 10):
+        manager.add_letter('Ana', 'A long letter about the weather. ' * 10, f'2024-02-{day:02d}')
+    url = '/api/v1/penpals/Ana/letters'
+    plain = client.get(url)
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+    assert not compressed.headers['ETag'].startswith('W/')
+
+    cached = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': compressed.headers['ETag']})
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == compressed.headers['ETag']
+
+    cached = client.get(url, headers={'If-None-Match': plain.headers['ETag']})
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == plain.headers['ETag']
+
+
+def test_write_changes_only_that_penpals_etag(client, manager):
+    ana = client.get('/api/v1/penpals/Ana').headers['ETag']
+    ben = client.get('/api/v1/penpals/Ben').headers['ETag']
+
+    manager.add_note('Ana', 'Loves tea')
+    response = client.get('/api/v1/penpals/Ana', headers={'If-None-Match': ana})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != ana
+    assert response.get_json()['notes'][0]['note'] == 'Loves tea'
+
+    assert client.get('/api/v1/penpals/Ben', headers={'If-None-Match': ben}).status_code == 304
+
+
+def test_archive_etag_covers_every_penpal(client, manager):
+    etag = client.get('/api/v1/stats').headers['ETag']
+    assert client.get('/api/v1/stats', headers={'If-None-Match': etag}).status_code == 304
+
+    manager.add_letter('Ben', 'Hello from Toronto', '2024-01-03')
+    response = client.get('/api/v1/stats', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['total_letters'] == 2
+
+
+def test_if_modified_since(client, manager):
+    last_modified = client.get('/api/v1/penpals/Ana').headers['Last-Modified']
+    cached = client.get('/api/v1/penpals/Ana', headers={'If-Modified-Since': last_modified})
+    assert cached.status_code == 304
+
+    stale = client.get('/api/v1/penpals/Ana', headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+    assert stale.status_code == 200
+
+
+def test_query_parameters_are_part_of_the_etag(client):
+    first = client.get('/api/v1/penpals/Ana/letters?limit=1').headers['ETag']
+    second = client.get('/api/v1/penpals/Ana/letters?limit=2').headers['ETag']
+    assert first != second
+
+    search = client.get('/api/v1/search?q=recife')
+    assert search.get_json()['total'] == 1
+    assert client.get('/api/v1/search?q=recife',
+                      headers={'If-None-Match': search.headers['ETag']}).status_code == 304
+
+
+def test_html_pages_are_conditional(client):
+    page = client.get('/penpal/Ana')
+    assert page.status_code == 200
+    assert client.get('/penpal/Ana', headers={'If-None-Match': page.headers['ETag']}).status_code == 304
+
+    index = client.get('/')
+    assert client.get('/', headers={'If-None-Match': index.headers['ETag']}).status_code == 304
+
+
+def test_unknown_penpal_has_no_etag(client):
+    response = client.get('/api/v1/penpals/Nobody')
+    assert response.status_code == 404
+    assert 'ETag' not in response.headers
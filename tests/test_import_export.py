@@ -0,0 +1,100 @@
+"""An export read back through the importer reproduces the archive"""
+import gzip
+import io
+import json
+
+import pytest
+
+from conftest import make_engine
+from exporter import export_chunks, gzip_chunks
+from importer import import_records, read_records, text_stream
+from letters import LetterManager
+
+
+def fill(manager):
+    manager.add_penpal('Ana', 'Brazil')
+    manager.add_penpal('Ben', 'Canada')
+    manager.add_letter('Ana', 'Olá! Letters with "quotes", commas\nand newlines', '2024-01-02')
+    manager.add_letter('Ana', 'A second letter', '2024-02-03')
+    manager.add_letter('Ben', 'Hello from Toronto', '2024-01-05')
+    manager.add_note('Ana', 'Loves tea')
+    manager.add_note('Ben', 'Plays hockey')
+
+
+def snapshot(manager):
+    """What an archive holds, without the ids and dates each engine assigns"""
+    penpals = {}
+    for record in manager.iter_records():
+        if record["type"] == "penpal":
+            penpals[record["name"]] = {"country": record["country"], "letters": [], "notes": []}
+        elif record["type"] == "letter":
+            penpals[record["penpal"]]["letters"].append((record["content"], record["date_received"]))
+        else:
+            penpals[record["penpal"]]["notes"].append(record["note"])
+    for penpal in penpals.values():
+        penpal["letters"].sort()
+        penpal["notes"].sort()
+    return penpals
+
+
+def export_bytes(manager, fmt, gzipped):
+    chunks = export_chunks(manager.iter_records(), fmt)
+    if gzipped:
+        return b''.join(gzip_chunks(chunks))
+    return ''.join(chunks).encode('utf-8')
+
+
+@pytest.mark.parametrize('gzipped', [False, True], ids=['plain', 'gzip'])
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv', 'json'])
+def test_round_trip(engine_kind, tmp_path, fmt, gzipped):
+    source = LetterManager(make_engine(engine_kind, tmp_path / 'source'))
+    fill(source)
+    data = export_bytes(source, fmt, gzipped)
+
+    target = LetterManager(make_engine(engine_kind, tmp_path / 'target'))
+    summary = import_records(target, read_records(text_stream(io.BytesIO(data), gzipped), fmt))
+    assert summary["errors"] == 0
+    assert (summary["penpals"], summary["letters"], summary["notes"]) == (2, 3, 2)
+    assert snapshot(target) == snapshot(source)
+
+    again = import_records(target, read_records(text_stream(io.BytesIO(data), gzipped), fmt))
+    assert (again["penpals"], again["letters"], again["notes"]) == (0, 0, 0)
+    assert again["duplicates"] == 7
+    assert snapshot(target) == snapshot(source)
+
+
+def test_small_batches(tmp_path):
+    source = LetterManager(make_engine('sqlite', tmp_path / 'source'))
+    fill(source)
+    records = list(source.iter_records())
+
+    target = LetterManager(make_engine('sqlite', tmp_path / 'target'))
+    batches = []
+    summary = import_records(target, records, batch_size=2, progress=lambda s: batches.append(s["records"]))
+    assert len(batches) == 4
+    assert snapshot(target) == snapshot(source)
+    assert summary["records"] == 7
+
+
+def test_document_and_unusable_records(tmp_path):
+    manager = LetterManager(make_engine('json', tmp_path))
+    document = {"penpals": {"Ana": {
+        "country": "Brazil", "created_date": "2024-01-01",
+        "letters": [{"content": "From a data file", "date_received": "2024-01-02"}],
+        "notes": [{"note": "Loves tea"}]}}}
+    text = io.StringIO(json.dumps(document))
+    summary = import_records(manager, read_records(text, 'json'))
+    assert (summary["penpals"], summary["letters"], summary["notes"]) == (1, 1, 1)
+
+    summary = import_records(manager, [
+        {"type": "letter", "penpal": "Nobody", "content": "No such penpal"},
+        {"type": "letter", "penpal": "Ana"},
+        "not a record",
+    ])
+    assert summary["skipped"] == 3
+    assert [letter["content"] for letter in manager.get_penpal('Ana')["letters"]] == ['From a data file']
+
+
+def test_gzip_export_is_one_stream():
+    chunks = list(gzip_chunks(iter(['a' * 100, 'b' * 100])))
+    assert gzip.decompress(b''.join(chunks)) == b'a' * 100 + b'b' * 100
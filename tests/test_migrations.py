@@ -0,0 +1,85 @@
+"""Schema versioning: migrations apply in order, once, and upgrade older databases"""
+import sqlite3
+
+from storage import postgres
+from storage.base import cache_schema_version, cached_schema_version
+from storage.sqlite import MIGRATIONS, SCHEMA_VERSION, SQLiteEngine, split_statements
+
+
+def applied_versions(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    finally:
+        conn.close()
+
+
+def test_migrations_are_numbered_in_order():
+    for migrations in (MIGRATIONS, postgres.MIGRATIONS):
+        versions = [version for version, _, _ in migrations]
+        assert versions == list(range(1, len(versions) + 1))
+    assert SCHEMA_VERSION == len(MIGRATIONS)
+    assert postgres.SCHEMA_VERSION == len(postgres.MIGRATIONS)
+
+
+def test_fresh_database_gets_every_migration(tmp_path):
+    path = str(tmp_path / 'letters.db')
+    engine = SQLiteEngine(path)
+    assert engine.init_schema()
+    assert applied_versions(path) == list(range(1, SCHEMA_VERSION + 1))
+
+
+def test_current_database_is_left_alone(tmp_path):
+    path = str(tmp_path / 'letters.db')
+    assert SQLiteEngine(path).init_schema()
+
+    engine = SQLiteEngine(path)
+    assert engine.init_schema()
+    assert applied_versions(path) == list(range(1, SCHEMA_VERSION + 1))
+
+
+def test_older_database_is_upgraded(tmp_path):
+    path = str(tmp_path / 'letters.db')
+    # A database last migrated by a version of the app that stopped at 3
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL, "
+                 "applied_at TEXT NOT NULL)")
+    for version, description, script in MIGRATIONS[:3]:
+        for statement in split_statements(script):
+            conn.execute(statement)
+        conn.execute("INSERT INTO schema_version VALUES (?, ?, '2024-01-01')", (version, description))
+    conn.execute("INSERT INTO penpals (name, country, created_date) VALUES ('Ana', 'Brazil', '2024-01-01')")
+    conn.execute("INSERT INTO letters (penpal_id, content, date_received, date_added) "
+                 "VALUES (1, 'Written before the upgrade', '2024-01-02', '2024-01-02')")
+    conn.commit()
+    conn.close()
+
+    engine = SQLiteEngine(path)
+    assert applied_versions(path) == [1, 2, 3]
+    penpals = engine.get_all_penpals()
+    assert applied_versions(path) == list(range(1, SCHEMA_VERSION + 1))
+    # The summary migration backfills rows for existing penpals
+    assert penpals[0]['letter_count'] == 1
+    assert penpals[0]['last_letter'] == '2024-01-02'
+    assert engine.get_versions()['Ana']['version'] >= 1
+    assert engine.search_letters_page('upgrade')['total'] == 1
+
+
+def test_schema_version_cache(tmp_path):
+    url = 'postgresql://user@db.invalid/letters'
+    assert cached_schema_version(url) is None
+    cache_schema_version(url, 3)
+    assert cached_schema_version(url) == 3
+    assert cached_schema_version(url + '2') is None
+
+
+def test_postgres_skips_migrations_when_cached(tmp_path):
+    url = 'postgresql://user@db.invalid/letters'
+    cache_schema_version(url, postgres.SCHEMA_VERSION)
+    engine = postgres.PostgresEngine(url)
+
+    def no_connection():
+        raise AssertionError("init_schema connected despite a current cached version")
+
+    engine.connection = no_connection
+    assert engine.init_schema()
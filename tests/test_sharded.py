@@ -0,0 +1,123 @@
+"""ShardedStore's manifest, crash recovery and cross-process locking"""
+import json
+import multiprocessing
+import os
+import shutil
+
+import pytest
+
+from storage.sharded import MANIFEST_FILE, SHARD_DIR, ShardedStore, shard_file
+
+
+def add_penpal(store, name):
+    return store.apply({"op": "add_penpal", "name": name, "country": "France",
+                        "created_date": "2024-01-01"})
+
+
+def add_letter(store, name, content):
+    return store.apply({"op": "add_letter", "penpal": name,
+                        "letter": {"content": content, "date_received": "2024-01-02",
+                                   "date_added": "2024-01-02"}})
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_FILE), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_manifest_holds_summaries(tmp_path):
+    store = ShardedStore(str(tmp_path))
+    add_penpal(store, 'Ana')
+    add_penpal(store, 'Ben/../odd name')
+    add_letter(store, 'Ana', 'One')
+    add_letter(store, 'Ana', 'Two')
+
+    manifest = read_manifest(tmp_path)
+    assert manifest["next_id"] == 3
+    entry = manifest["penpals"]["Ana"]
+    assert entry["file"] == shard_file('Ana')
+    assert entry["letter_count"] == 2
+    assert entry["last_letter"] == '2024-01-02'
+    # Any penpal name maps to a plain file in the shard directory
+    assert sorted(os.listdir(tmp_path / SHARD_DIR)) == sorted([shard_file('Ana'), shard_file('Ben/../odd name')])
+
+
+def test_write_only_touches_its_shard(tmp_path):
+    store = ShardedStore(str(tmp_path))
+    add_penpal(store, 'Ana')
+    add_penpal(store, 'Ben')
+    ben_path = tmp_path / SHARD_DIR / shard_file('Ben')
+    before = os.stat(ben_path).st_mtime_ns
+
+    add_letter(store, 'Ana', 'Only Ana changes')
+    assert os.stat(ben_path).st_mtime_ns == before
+
+
+def test_parsed_shards_are_bounded(tmp_path):
+    store = ShardedStore(str(tmp_path), cache_size=2)
+    for name in ('Ana', 'Ben', 'Cy'):
+        add_penpal(store, name)
+        add_letter(store, name, f'Letter for {name}')
+    assert [entry["letters"][0]["content"] for entry in store.load()["penpals"].values()] == [
+        'Letter for Ana', 'Letter for Ben', 'Letter for Cy']
+    assert list(store._shards) == [shard_file('Ben'), shard_file('Cy')]
+
+
+def test_rebuild_summaries_after_crash_before_manifest(tmp_path):
+    store = ShardedStore(str(tmp_path))
+    add_penpal(store, 'Ana')
+    add_letter(store, 'Ana', 'One')
+    manifest_before = tmp_path / 'manifest.before'
+    shutil.copy(tmp_path / MANIFEST_FILE, manifest_before)
+
+    add_letter(store, 'Ana', 'Two')
+    # The shard was written but the process died before the manifest was
+    shutil.copy(manifest_before, tmp_path / MANIFEST_FILE)
+
+    recovered = ShardedStore(str(tmp_path))
+    assert recovered.cache().summaries['Ana']['letter_count'] == 1
+    recovered.rebuild_summaries()
+    assert recovered.cache().summaries['Ana']['letter_count'] == 2
+    assert read_manifest(tmp_path)["next_id"] == 3
+
+    add_letter(recovered, 'Ana', 'Three')
+    ids = [letter["id"] for letter in recovered.load()["penpals"]["Ana"]["letters"]]
+    assert ids == [1, 2, 3]
+
+
+def test_seeds_from_json_document(tmp_path):
+    seed = tmp_path / 'letters_data.json'
+    seed.write_text(json.dumps({"penpals": {"Ana": {
+        "country": "France", "created_date": "2024-01-01",
+        "letters": [{"content": "Seeded", "date_received": "2024-01-01", "date_added": "2024-01-01"}],
+        "notes": []}}}), encoding='utf-8')
+
+    store = ShardedStore(str(tmp_path / 'shards'), seed_path=str(seed))
+    assert store.cache().summaries['Ana']['letter_count'] == 1
+    assert store.load()["penpals"]["Ana"]["letters"][0]["content"] == 'Seeded'
+
+
+def write_letters(directory, worker, count):
+    store = ShardedStore(directory)
+    for i in range(count):
+        add_letter(store, 'Ana', f'Worker {worker} letter {i}')
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_writers_keep_every_letter(tmp_path):
+    directory = str(tmp_path)
+    add_penpal(ShardedStore(directory), 'Ana')
+
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=write_letters, args=(directory, worker, 20)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    store = ShardedStore(directory)
+    letters = store.load()["penpals"]["Ana"]["letters"]
+    assert len(letters) == 80
+    assert len({letter["id"] for letter in letters}) == 80
+    assert store.cache().summaries['Ana']['letter_count'] == 80
@@ -0,0 +1,47 @@
+"""StatsCache keeps real stats until a write or expiry, and never keeps a failed read"""
+from stats import StatsCache
+from storage.base import unavailable_stats
+
+
+def counting_loader(results):
+    calls = []
+
+    def load():
+        calls.append(1)
+        return results[min(len(calls), len(results)) - 1]
+    return load, calls
+
+
+def test_caches_until_invalidated():
+    load, calls = counting_loader([{"total_letters": 1}, {"total_letters": 2}])
+    cache = StatsCache(load)
+    assert cache.get() == {"total_letters": 1}
+    assert cache.get() == {"total_letters": 1}
+    assert len(calls) == 1
+
+    cache.invalidate()
+    assert cache.get() == {"total_letters": 2}
+
+
+def test_failed_read_is_not_cached():
+    load, calls = counting_loader([unavailable_stats(), {"total_letters": 3}])
+    cache = StatsCache(load)
+    assert cache.get()["total_letters"] == 0
+    assert cache.get() == {"total_letters": 3}
+    assert len(calls) == 2
+
+
+def test_entries_expire(monkeypatch):
+    load, calls = counting_loader([{"total_letters": 1}, {"total_letters": 2}])
+    cache = StatsCache(load, ttl=0.01)
+    cache.get()
+    now = cache._loaded_at
+    monkeypatch.setattr('stats.time.monotonic', lambda: now + 1)
+    assert cache.get() == {"total_letters": 2}
+
+
+def test_default_ttl_is_finite(monkeypatch):
+    monkeypatch.delenv('STATS_CACHE_TTL', raising=False)
+    assert StatsCache.from_env(dict).ttl
+    monkeypatch.setenv('STATS_CACHE_TTL', '0')
+    assert StatsCache.from_env(dict).ttl is None